@@ -0,0 +1,279 @@
+"""Offline benchmarks of the map update pipeline (see test_update_map.py).
+
+A synthetic Flywheel client (with a configurable latency per request) and a
+synthetic registry of N sites replace the Flywheel instance and the CSV files,
+so everything runs without network access. The time and peak memory of each
+stage are reported for each registry size, and can be saved and compared with a
+previous run to spot regressions:
+
+    python benchmark_update_map.py --sites 20 500 5000 --save bench.json
+    python benchmark_update_map.py --sites 20 500 5000 --compare bench.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing as t
+
+import numpy as np
+import pandas as pd
+from flywheel.models import ProjectListOutput
+
+import test_update_map as tum
+
+# Columns of the sites CSV files
+CSV_COLUMNS = [
+    'city', 'city_ascii', 'lat', 'lng', 'country', 'iso2', 'iso3', 'admin_name',
+    'capital', 'population', 'id', 'scans'
+]
+# Relative slowdown (time or peak memory) reported as a regression
+REGRESSION_THRESHOLD = 0.2
+
+
+class FakeProjectsFinder:
+    """Stand-in for `flywheel.Client.projects` (only `find_one`)."""
+
+    def __init__(self, client: 'FakeFlywheelClient'):
+        self._client = client
+
+    def find_one(self, query: str, exhaustive: bool = False) -> ProjectListOutput:
+        self._client.requests += 1
+        time.sleep(self._client.latency)
+        label = query.split('=', 1)[1]
+        if label not in self._client.project_index:
+            raise ValueError(f"Project not found: {label}")
+        return self._client.project_index[label]
+
+
+class FakeFlywheelClient:
+    """Synthetic Flywheel client with `n_projects` projects.
+
+    Each request (a `find_one` or a page of `get_all_projects`) sleeps for
+    `latency` seconds, and the number of requests is counted in `requests`.
+    """
+
+    def __init__(self, labels: t.List[str], latency: float = 0.01, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.latency = latency
+        self.requests = 0
+        self.project_index = {
+            label: ProjectListOutput(
+                id=f"{i:024x}",
+                label=label,
+                modified='2024-01-01T00:00:00+00:00',
+                stats={'number_of': {'sessions': int(n)}},
+            )
+            for i, (label, n) in enumerate(zip(labels, rng.integers(1, 500, len(labels))))
+        }
+        self._ids = [project['_id'] for project in self.project_index.values()]
+        self.projects = FakeProjectsFinder(self)
+
+    def get_all_projects(self, limit: int = 0, after_id: t.Optional[str] = None, **kwargs):
+        self.requests += 1
+        time.sleep(self.latency)
+        projects = list(self.project_index.values())
+        if 'filter' in kwargs:
+            ids = set(kwargs['filter'].split('[', 1)[1].rstrip(']').split(','))
+            return [project for project in projects if project['_id'] in ids]
+        start = self._ids.index(after_id) + 1 if after_id else 0
+        return projects[start:start + limit] if limit else projects[start:]
+
+
+def make_registry(
+    n_sites: int,
+    world_data_path: str,
+    seed: int = 0
+) -> t.Tuple[t.Dict[str, t.List[str]], pd.DataFrame]:
+    """Build a synthetic registry of sites.
+
+    Args:
+        n_sites (int): The number of sites (cities).
+        world_data_path (str): The path to the world data (the sites are placed
+            in its countries).
+        seed (int): The random seed.
+
+    Returns:
+        t.Tuple[t.Dict[str, t.List[str]], pd.DataFrame]: The project labels of
+            each city (1 to 3 per city), and the sites table (as in the CSV
+            files, with 10% of the cities missing, to exercise the inserts).
+    """
+    rng = np.random.default_rng(seed)
+    world_data = tum.read_world_data(world_data_path)
+    countries = world_data.sample(n_sites, replace=True, random_state=seed)
+    points = countries.geometry.representative_point()
+
+    cities_dict = {
+        f"City {i}": [f"Project {i}-{j}" for j in range(rng.integers(1, 4))]
+        for i in range(n_sites)
+    }
+    sites = pd.DataFrame({
+        'city': list(cities_dict),
+        'lat': points.y.to_numpy() + rng.normal(0, 0.5, n_sites),
+        'lng': points.x.to_numpy() + rng.normal(0, 0.5, n_sites),
+        'country': countries['name'].to_numpy(),
+        'iso3': countries['iso_a3'].to_numpy(),
+        'scans': 0,
+    }).reindex(columns=CSV_COLUMNS)
+    sites['city_ascii'] = sites['city']
+    sites = sites.sample(frac=0.9, random_state=seed).sort_index()
+    return cities_dict, sites
+
+
+def measure(func: t.Callable, *args, **kwargs) -> t.Tuple[t.Any, float, float]:
+    """Run a function, measuring its duration and the peak of Python allocations.
+
+    Returns:
+        t.Tuple[t.Any, float, float]: The result, the time (s) and the peak
+            memory (MiB).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, elapsed, peak / 2 ** 20
+
+
+def run_benchmark(
+    n_sites: int,
+    latency: float,
+    workdir: str,
+    world_data_path: str = tum.BUNDLED_WORLD_DATA
+) -> t.Dict[str, t.Dict[str, float]]:
+    """Run the pipeline stages on a synthetic registry of `n_sites` sites.
+
+    Args:
+        n_sites (int): The number of sites.
+        latency (float): The latency of each Flywheel request, in seconds.
+        workdir (str): The directory for the CSV, HTML and SVG files.
+        world_data_path (str): The path to the world data.
+
+    Returns:
+        t.Dict[str, t.Dict[str, float]]: The time (s), peak memory (MiB) and
+            number of Flywheel requests of each stage.
+    """
+    cities_dict, sites = make_registry(n_sites, world_data_path)
+    labels = [label for labels in cities_dict.values() for label in labels]
+    sites_csv_path = os.path.join(workdir, f"sites_{n_sites}.csv")
+    dev_sites_csv_path = os.path.join(workdir, f"dev_sites_{n_sites}.csv")
+    sites.to_csv(sites_csv_path, index=False)
+    # Development sites: a tenth of the sites, with their own counts
+    dev_sites = sites.head(max(1, n_sites // 10)).copy()
+    dev_sites['scans'] = np.arange(1, len(dev_sites) + 1)
+    dev_sites.to_csv(dev_sites_csv_path, index=False)
+
+    results = {}
+
+    def stage(name, func, *args, **kwargs):
+        client.requests = 0
+        result, elapsed, peak = measure(func, *args, **kwargs)
+        results[name] = {
+            'time_s': round(elapsed, 4),
+            'peak_mib': round(peak, 2),
+            'requests': client.requests,
+        }
+        return result
+
+    client = FakeFlywheelClient(labels, latency)
+    stage("fetch_concurrent", tum.fetch_projects_sessions, client, labels)
+    project_counts, _ = stage("fetch_bulk", tum.build_project_sessions_index, client, labels)
+    stage(
+        "update_csv", tum.update_number_of_scans_in_csv,
+        client, cities_dict, sites_csv_path, project_counts
+    )
+    stage(
+        "map_html", tum.update_map_figure, world_data_path, sites_csv_path,
+        dev_sites_csv_path, os.path.join(workdir, f"map_{n_sites}.html"),
+        # Fresh (cold) cache of the base layer, so that runs are comparable
+        base_cache_dir=os.path.join(workdir, f"map_base_{n_sites}")
+    )
+    stage(
+        "map_svg", tum.render_map_svg, world_data_path, sites_csv_path,
+        dev_sites_csv_path, os.path.join(workdir, f"map_{n_sites}.svg")
+    )
+    return results
+
+
+def find_regressions(
+    results: t.Dict[str, t.Dict[str, t.Dict[str, float]]],
+    baseline: t.Dict[str, t.Dict[str, t.Dict[str, float]]],
+    threshold: float = REGRESSION_THRESHOLD
+) -> t.List[str]:
+    """Compare the results with a previous run.
+
+    Args:
+        results: The results, by number of sites and stage.
+        baseline: The results of the previous run.
+        threshold (float): The relative increase reported as a regression.
+
+    Returns:
+        t.List[str]: A description of each regression.
+    """
+    regressions = []
+    for n_sites, stages in results.items():
+        for stage_name, metrics in stages.items():
+            previous = baseline.get(n_sites, {}).get(stage_name)
+            if previous is None:
+                continue
+            for metric in ('time_s', 'peak_mib'):
+                before, after = previous[metric], metrics[metric]
+                if before > 0 and (after - before) / before > threshold:
+                    regressions.append(
+                        f"{n_sites} sites, {stage_name}: {metric} {before} -> {after} "
+                        f"(+{(after - before) / before:.0%})"
+                    )
+    return regressions
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sites", type=int, nargs="+", default=[20, 500, 5000],
+                        help="Registry sizes (number of sites).")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="Latency of each Flywheel request, in seconds.")
+    parser.add_argument("--save", help="Save the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file.")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Relative increase reported as a regression.")
+    args = parser.parse_args(argv)
+
+    # Keep the pipeline offline and quiet: no stats cache, no console output
+    tum.STATS_CACHE_PATH = ""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_sites in args.sites:
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                results[str(n_sites)] = run_benchmark(n_sites, args.latency, workdir)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+    print(f"{'sites':>6} {'stage':<18} {'time (s)':>9} {'peak (MiB)':>11} {'requests':>9}")
+    for n_sites, stages in results.items():
+        for stage_name, metrics in stages.items():
+            print(f"{n_sites:>6} {stage_name:<18} {metrics['time_s']:>9.3f} "
+                  f"{metrics['peak_mib']:>11.2f} {metrics['requests']:>9}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
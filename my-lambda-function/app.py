@@ -1,122 +1,1092 @@
+import time
+
+# Module load start, for the cold start report (see startup_report)
+_INIT_START = time.perf_counter()
+
+import asyncio
+import base64
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import hmac
+import importlib
 import json
 import os
-import flywheel
-import pandas as pd
-import numpy as np
+import random
+import sqlite3
+import sys
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
-import geopandas as gpd
-import plotly.graph_objects as go
-import plotly.express as px
+try:
+    import resource
+except ImportError:  # Not available on Windows: no memory metrics
+    resource = None
 
-import csv
-import io
+# Heavy dependencies (flywheel, pandas, numpy, geopandas, plotly, requests and
+# the Google API client) are imported with lazy_import, only when the pipeline
+# stage that needs them runs.
 
-import boto3
-from boto3.dynamodb.conditions import Key
+# Maximum number of concurrent requests to the Flywheel API (1 = sequential)
+FW_MAX_WORKERS = int(os.getenv("FW_MAX_WORKERS", "8"))
+# "bulk" lists all the projects once, "concurrent" runs one query per label
+FW_FETCH_MODE = os.getenv("FW_FETCH_MODE", "bulk")
+# Number of projects per page when listing the projects in "bulk" mode
+FW_PAGE_SIZE = int(os.getenv("FW_PAGE_SIZE", "1000"))
+# Timeouts of each Flywheel request (in seconds), and retries of the transient
+# errors (see call_with_retries): maximum number and first backoff delay
+FW_REQUEST_TIMEOUT = float(os.getenv("FW_REQUEST_TIMEOUT", "10"))
+FW_CONNECT_TIMEOUT = float(os.getenv("FW_CONNECT_TIMEOUT", "5"))
+FW_MAX_RETRIES = int(os.getenv("FW_MAX_RETRIES", "3"))
+FW_RETRY_BASE_DELAY = float(os.getenv("FW_RETRY_BASE_DELAY", "0.5"))
+# Circuit breaker of the project labels (see CircuitBreaker): a label that fails
+# in FW_BREAKER_THRESHOLD runs in a row is skipped for FW_BREAKER_COOLDOWN seconds
+FW_BREAKER_THRESHOLD = int(os.getenv("FW_BREAKER_THRESHOLD", "3"))
+FW_BREAKER_COOLDOWN = float(os.getenv("FW_BREAKER_COOLDOWN", str(60 * 60)))
+# Time (in ms) kept at the end of the invocation to write and publish what is
+# complete (at most half of the time left, see Deadline)
+DEADLINE_RESERVE_MS = float(os.getenv("DEADLINE_RESERVE_MS", "20000"))
+# Counts of an unfinished run (see fetch_project_counts), resumed by the next
+# invocation if younger than CHECKPOINT_MAX_AGE seconds. Kept in the scan
+# history table (SCAN_HISTORY_TABLE) if there is one, so that any container
+# resumes it; otherwise in CHECKPOINT_PATH (only seen by a warm container)
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "/tmp/pipeline_checkpoint.json")
+CHECKPOINT_MAX_AGE = float(os.getenv("CHECKPOINT_MAX_AGE", str(60 * 60)))
+CHECKPOINT_KEY = {'pk': {'S': 'checkpoint'}, 'sk': {'S': 'fetch'}}
+# Persistent cache of the project stats, kept in /tmp so that it survives
+# between invocations of a warm container. An empty path disables the cache.
+STATS_CACHE_PATH = os.getenv("STATS_CACHE_PATH", "/tmp/unity_project_stats.sqlite")
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", str(24 * 60 * 60)))
+# Number of project ids per request when fetching the stats of changed projects
+STATS_FETCH_CHUNK = 50
+# DynamoDB table with the history of the counts (see create_scan_history_table).
+# Empty to disable. DYNAMODB_ENDPOINT_URL can point to DynamoDB Local.
+SCAN_HISTORY_TABLE = os.getenv("SCAN_HISTORY_TABLE", "")
+DYNAMODB_ENDPOINT_URL = os.getenv("DYNAMODB_ENDPOINT_URL") or None
+# Google Drive uploads: credentials, destination folder of each file (by file
+# name) and maximum number of concurrent uploads
+GOOGLE_CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH", "service-credentials-google.json")
+DRIVE_FOLDERS = {
+    'site_scans.csv': '1WVRj-wu51QmkzeOYnWeLX0yi6qwEBbqa',
+    'unity_map.html': '1WTTQb7nKgOvnhLkt6EIQ6tlHEqf09luc',
+}
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", "4"))
+# Shared store of the published files (see update_s3), read by the HTTP read
+# path of every container: S3 bucket (empty = not published to S3, the files
+# are then served from SERVE_DIR), key prefix, and S3_ENDPOINT_URL to point to
+# an S3-compatible server (e.g. MinIO)
+S3_BUCKET = os.getenv("BUCKET_NAME", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+# HTTP read path (see serve_handler): directory of the files written by the
+# pipeline (without S3_BUCKET), time (in seconds) a served file is used before
+# checking whether it changed, Cache-Control of the responses, and the files
+# served by path: (file name, content type, whether the CSV is converted to JSON)
+SERVE_DIR = os.getenv("SERVE_DIR", ".")
+SERVE_REVALIDATE = float(os.getenv("SERVE_REVALIDATE", "10"))
+SERVE_CACHE_CONTROL = os.getenv("SERVE_CACHE_CONTROL", "public, max-age=60, must-revalidate")
+SERVE_ROUTES = {
+    '/': ('unity_map.html', 'text/html; charset=utf-8', False),
+    '/unity_map.html': ('unity_map.html', 'text/html; charset=utf-8', False),
+    '/site_scans.csv': ('site_scans.csv', 'text/csv; charset=utf-8', False),
+    '/sites.json': ('site_scans.csv', 'application/json', True),
+}
+# Map output optimization: simplification tolerance of the country polygons (in
+# degrees), number of decimals of the coordinates and size budget of the HTML
+MAP_OPTIMIZE = os.getenv("MAP_OPTIMIZE", "1") == "1"
+MAP_SIMPLIFY_TOLERANCE = float(os.getenv("MAP_SIMPLIFY_TOLERANCE", "0.05"))
+MAP_COORDINATE_PRECISION = int(os.getenv("MAP_COORDINATE_PRECISION", "3"))
+MAP_BYTE_BUDGET = int(os.getenv("MAP_BYTE_BUDGET", str(500 * 1024)))
+# Cache of the base layer of the map (the countries, see load_base_figure):
+# directory of the Plotly figure JSON files (empty to disable), and version of
+# their format (to bump when build_base_figure changes)
+MAP_BASE_CACHE_DIR = os.getenv("MAP_BASE_CACHE_DIR", "/tmp")
+MAP_BASE_CACHE_VERSION = 1
+UNITY_COUNTRIES = ['United States of America', 'Pakistan', 'India', 'Zambia', 'Malawi', 'Uganda', 'Kenya', 'Botswana', 'Zimbabwe', 'Ghana', 'Ethiopia', 'South Africa', 'United Kingdom', 'Bangladesh', 'Sweden', 'Canada', 'Netherlands', 'Australia', 'Germany']
+# "sequential" runs the stages one after the other, "async" overlaps the
+# independent ones (see run_pipeline_async). The event can override it with
+# {"pipeline": "async"}.
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "sequential")
+# Maximum time (in ms) for the module initialization and the imports of a cold
+# start; startup_report flags the invocations that go over it
+COLD_START_BUDGET_MS = float(os.getenv("COLD_START_BUDGET_MS", "3000"))
+# Fingerprint of the inputs of the last successful run (see compute_fingerprint)
+FINGERPRINT_PATH = os.getenv("FINGERPRINT_PATH", "/tmp/pipeline_fingerprint.json")
+WORLD_DATA_URL = "https://naciscdn.org/naturalearth/110m/cultural/ne_110m_admin_0_countries.zip"
+# The world data is cached in /tmp and revalidated with the server (ETag /
+# Last-Modified) once the cached copy is older than WORLD_DATA_MAX_AGE seconds
+WORLD_DATA_CACHE_DIR = os.getenv("WORLD_DATA_CACHE_DIR", "/tmp")
+WORLD_DATA_MAX_AGE = float(os.getenv("WORLD_DATA_MAX_AGE", str(7 * 24 * 60 * 60)))
+# Copy of the world data used when it can't be downloaded (if packaged)
+BUNDLED_WORLD_DATA = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "ne_110m_admin_0_countries.zip"
+)
+# Compact geometry of the countries (built with build_geometry_artifact in
+# test_update_map.py): the map is built from it without geopandas, and without
+# downloading the world data. If it's missing, the world data is used instead.
+GEOMETRY_ARTIFACT_PATH = os.getenv(
+    "GEOMETRY_ARTIFACT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "countries.geojson")
+)
+# Offline gazetteer (built with build_gazetteer in test_update_map.py and
+# copied into the image), used to locate the sites that are not in
+# unitySites.csv yet
+GAZETTEER_PATH = os.getenv(
+    "GAZETTEER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.csv")
+)
+GAZETTEER_COLUMNS = [
+    'city_ascii', 'lat', 'lng', 'country', 'iso2', 'iso3', 'admin_name', 'capital',
+    'population', 'id'
+]
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+# Flywheel project labels of each site (city)
+SITES_CITIES = {'Accra':['Ghana (Accra)'],
+    'Addis Ababa':['Ethiopia-BCD-Hyperfine','Ethiopia (ENAT)'],
+    'Blantyre':['Malawi-Khula-Hyperfine'],'Bonn':['Bonn'],
+    'Cape Town':['UCT-Khula-Hyperfine','UCT-D2-Hyperfine'], 
+    'Dhaka':['Bangladesh (BEAN_EXT)','Bangladesh (BRAC Care Study)', 'Bangladesh (REVAMP)'],
+    'Gaborone':['Botswana-MOTHEO'],
+    'Harare':['Zimbabwe-Zvitambo'],
+    'Kampala':['Uganda-PRIMES-Highfield', 'Uganda-PRIMES-Hyperfine'],
+    'Karachi':['PRISMA-AKU'],'Kintampo':['PRISMA-Kintampo'],'Kisumu':['PRISMA-Kenya'],
+    'London':['KCL-Neonatal-collection','KCL-HYPE'], 'Lucknow':[], 
+    'Lusaka':['PRISMA-Zambia'], 'Nairobi':[],'Pretoria':['UP-Kalafong-Hyperfine'],
+    'Soweto':['UP-Bara-Hyperfine'],
+    'Vellore':['PRISMA-CMC'],'Zomba':['Malawi (REVAMP)']}
+# Flywheel webhooks (see handle_flywheel_events): path of the function URL, shared
+# secret expected in the X-Webhook-Token header (required), and time
+# (in seconds) the ids of the processed events are kept to ignore redeliveries.
+# The scheduled flush renders the map again once no event came for
+# EVENT_RENDER_DEBOUNCE seconds, or at most EVENT_RENDER_MAX_DELAY seconds after
+# the first event that isn't on it (see maybe_render_events).
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/flywheel-events")
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN", "")
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", str(7 * 24 * 60 * 60)))
+EVENT_RENDER_DEBOUNCE = float(os.getenv("EVENT_RENDER_DEBOUNCE", "30"))
+EVENT_RENDER_MAX_DELAY = float(os.getenv("EVENT_RENDER_MAX_DELAY", "300"))
 
-import fsspec
-import requests
+# Structured logs: one JSON object per line, with the metrics in CloudWatch
+# Embedded Metric Format (EMF), so CloudWatch extracts them from the Lambda logs
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "UnityMap")
+# Unit of each metric reported by measure
+METRIC_UNITS = {
+    'Duration': 'Milliseconds',
+    'Errors': 'Count',
+    'Count': 'Count',
+    'Bytes': 'Bytes',
+    'MaxRSS': 'Megabytes',
+}
 
+# Import time of each lazily imported module, and duration of each pipeline
+# stage of the current invocation, in ms
+IMPORT_TIMES_MS = {}
+STAGE_TIMES_MS = {}
+_STAGE_CLOCK = {'last': None}
+_COLD_START = {'value': True}
+# Fields added to every log line of the current invocation (e.g. request_id)
+LOG_CONTEXT = {}
 
-def search_file(service, file_name, folder_id):
-    # Search for files by name in a specific folder
-    query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-    results = service.files().list(q=query, fields="files(id, name)").execute()
-    files = results.get('files', [])
-    return files
 
-def delete_file(service, file_id):
-    # Delete file by file ID
-    service.files().delete(fileId=file_id).execute()
+def lazy_import(name):
+    # Import a module the first time it is needed, recording the import time
+    # (including the dependencies it loads that weren't loaded yet)
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES_MS[name] = round((time.perf_counter() - start) * 1000, 1)
+    return module
 
 
-def lambda_handler(event, context):
-    
-    dynamodb_client = boto3.client("dynamodb")
-    dynamodb = boto3.resource("dynamodb")
-    
-    API = os.getenv("API_TOKEN")
-    fw = flywheel.Client(api_key=API)
-    message =  fw.get_current_user().email
-    
-    # Check user Info
-    user_info = fw.get_current_user()
-    
-    print(f"Firstname: {user_info.firstname} \n"
-        f"Lastname: {user_info.lastname} \n"
-        f"Email: {user_info.email} \n"
+def start_stages():
+    STAGE_TIMES_MS.clear()
+    _STAGE_CLOCK['last'] = time.perf_counter()
+
+
+def end_stage(name):
+    # Record the time since the previous stage ended as the duration of "name"
+    now = time.perf_counter()
+    STAGE_TIMES_MS[name] = round((now - _STAGE_CLOCK['last']) * 1000, 1)
+    _STAGE_CLOCK['last'] = now
+    emit_metrics(f"stage.{name}", {'Duration': STAGE_TIMES_MS[name], 'MaxRSS': max_rss_mb()})
+
+
+def log_event(event, level="info", **fields):
+    # Print a structured log line (instead of free-form prints)
+    print(json.dumps({'level': level, 'event': event, **LOG_CONTEXT, **fields}, default=str))
+
+
+def max_rss_mb():
+    # Peak resident memory of the process so far (ru_maxrss is in KiB on Linux)
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def emit_metrics(operation, metrics, **properties):
+    # Print an EMF document with the given metrics ({name: value}, see
+    # METRIC_UNITS), under the "Operation" dimension. The properties are logged
+    # with it but are not dimensions, so labels and file names don't create
+    # new metrics.
+    metrics = {name: value for name, value in metrics.items() if value is not None}
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Operation']],
+                'Metrics': [{'Name': name, 'Unit': METRIC_UNITS[name]} for name in metrics],
+            }],
+        },
+        'Operation': operation,
+        **LOG_CONTEXT,
+        **properties,
+        **metrics,
+    }, default=str))
+
+
+@contextlib.contextmanager
+def measure(operation, **properties):
+    # Time a stage or an external call and emit its metrics when it ends. The
+    # yielded dict can be updated with the "Count" and "Bytes" metrics and
+    # other properties. An exception is counted in "Errors", logged with the
+    # metrics and re-raised.
+    record = dict(properties)
+    errors = 0
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        errors = 1
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        metrics = {
+            'Duration': round((time.perf_counter() - start) * 1000, 1),
+            'Errors': errors,
+            'Count': record.pop('Count', None),
+            'Bytes': record.pop('Bytes', None),
+        }
+        emit_metrics(operation, metrics, **record)
+
+
+def startup_report():
+    # Print (and return) the init, import and stage times of this invocation.
+    # On a cold start, the init and import times are checked against
+    # COLD_START_BUDGET_MS.
+    cold_start = _COLD_START['value']
+    _COLD_START['value'] = False
+    imports_ms = round(sum(IMPORT_TIMES_MS.values()), 1)
+    report = {
+        'cold_start': cold_start,
+        'init_ms': INIT_MS,
+        'imports_ms': dict(IMPORT_TIMES_MS),
+        'total_imports_ms': imports_ms,
+        'stages_ms': dict(STAGE_TIMES_MS),
+        'cold_start_budget_ms': COLD_START_BUDGET_MS,
+        'over_budget': cold_start and INIT_MS + imports_ms > COLD_START_BUDGET_MS,
+    }
+    report['max_rss_mb'] = max_rss_mb()
+    log_event("startup_report", level="warning" if report['over_budget'] else "info", **report)
+    return report
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    # End of the time budget of the invocation: the time left in the Lambda
+    # (context.get_remaining_time_in_millis), minus the reserve kept to write
+    # and publish what is complete. Without a context (e.g. run locally), there
+    # is no deadline.
+
+    def __init__(self, context=None, reserve_ms=DEADLINE_RESERVE_MS):
+        self.end = float('inf')
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            remaining_ms = context.get_remaining_time_in_millis()
+            reserve_ms = min(reserve_ms, remaining_ms / 2)
+            self.end = time.monotonic() + (remaining_ms - reserve_ms) / 1000
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, limit=None):
+        # Time to wait for a call: the time left, capped at limit (None = no limit)
+        if self.end == float('inf'):
+            return limit
+        return self.remaining() if limit is None else min(limit, self.remaining())
+
+
+def is_retryable(error):
+    # Transient errors: timeouts, connection errors, 5xx, 408 and 429. A missing
+    # or ambiguous project (ValueError) or another 4xx fails the same way again
+    if isinstance(error, (ValueError, KeyError, DeadlineExceeded)):
+        return False
+    status = getattr(error, 'status', None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status not in (408, 429))
+
+
+def call_with_retries(func, *args, deadline=None, retries=FW_MAX_RETRIES, base_delay=FW_RETRY_BASE_DELAY, **kwargs):
+    # Call func, retrying the transient errors with exponential backoff (and
+    # jitter) as long as the deadline leaves time for it
+    for attempt in range(retries + 1):
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded(f"No time left for {func.__name__}")
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            delay = base_delay * 2 ** attempt * random.uniform(0.5, 1)
+            if (
+                attempt == retries
+                or not is_retryable(e)
+                or (deadline is not None and deadline.remaining() < delay)
+            ):
+                raise
+            log_event(
+                "retry", level="warning", operation=func.__name__, attempt=attempt + 1,
+                delay_s=round(delay, 2), error=f"{type(e).__name__}: {e}"
+            )
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    # Per project label: a label that failed in `threshold` runs in a row is
+    # skipped ("open") for `cooldown` seconds, then tried again once. The state
+    # is a JSON-serializable dict (label -> failures, opened_at), saved with the
+    # checkpoint so it is kept between the invocations (see read_checkpoint).
+
+    def __init__(self, state=None, threshold=FW_BREAKER_THRESHOLD, cooldown=FW_BREAKER_COOLDOWN):
+        self.state = dict(state or {})
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def allow(self, label):
+        entry = self.state.get(label)
+        return (
+            entry is None
+            or entry['failures'] < self.threshold
+            or time.time() - entry['opened_at'] >= self.cooldown
         )
-    
-    # Retrieve sites data (this assumes 'sites' refer to some Flywheel data type - adjust accordingly)
-    # For example, assume we're retrieving projects and filtering their location metadata:
-    sites_cities = {'Accra':['Ghana (Accra)'],
-                'Addis Ababa':['Ethiopia-BCD-Hyperfine','Ethiopia (ENAT)'],
-                'Blantyre':['Malawi-Khula-Hyperfine'],'Bonn':['Bonn'],
-                'Cape Town':['UCT-Khula-Hyperfine','UCT-D2-Hyperfine'], 
-                'Dhaka':['Bangladesh (BEAN_EXT)','Bangladesh (BRAC Care Study)', 'Bangladesh (REVAMP)'],
-                'Gaborone':['Botswana-MOTHEO'],
-                'Harare':['Zimbabwe-Zvitambo'],
-                'Kampala':['Uganda-PRIMES-Highfield', 'Uganda-PRIMES-Hyperfine'],
-                'Karachi':['PRISMA-AKU'],'Kintampo':['PRISMA-Kintampo'],'Kisumu':['PRISMA-Kenya'],
-                'London':['KCL-Neonatal-collection','KCL-HYPE'], 'Lucknow':[], 
-                'Lusaka':['PRISMA-Zambia'], 'Nairobi':[],'Pretoria':['UP-Kalafong-Hyperfine'],
-                'Soweto':['UP-Bara-Hyperfine'],
-                'Vellore':['PRISMA-CMC'],'Zomba':['Malawi (REVAMP)']}
-    
-    print(sites_cities)
-    # Retrieve sites data (this assumes 'sites' refer to some Flywheel data type - adjust accordingly)
-    # For example, assume we're retrieving projects and filtering their location metadata
-    df = pd.read_csv("unitySites.csv")
-    #print(df)
 
+    def record(self, label, success):
+        if success:
+            self.state.pop(label, None)
+            return
+        entry = self.state.setdefault(label, {'failures': 0, 'opened_at': None})
+        entry['failures'] += 1
+        if entry['failures'] >= self.threshold:
+            entry['opened_at'] = time.time()
+            log_event("circuit_open", level="warning", label=label, failures=entry['failures'])
+
+
+def read_checkpoint(
+    checkpoint_path=CHECKPOINT_PATH, max_age=CHECKPOINT_MAX_AGE, table_name=SCAN_HISTORY_TABLE, dynamodb_client=None
+):
+    # {'counts': {label: sessions} of an unfinished run, 'after_id': where its
+    #  listing of the projects stopped, 'matches': {label: [{'_id', 'modified'}]}
+    #  of the projects listed before after_id whose stats are still to fetch
+    #  (all three reset if too old), 'breaker': CircuitBreaker state}, from the
+    # table_name item (pk = "checkpoint") if there is a table, otherwise from
+    # checkpoint_path
     try:
-        rows=[]
-        for i , city in enumerate (sites_cities):
-           
-            site_scans = 0
-            for project_label in sites_cities[city]:
-                
+        if table_name:
+            dynamodb_client = dynamodb_client or get_dynamodb_client()
+            item = dynamodb_client.get_item(
+                TableName=table_name, Key=CHECKPOINT_KEY, ConsistentRead=True
+            ).get('Item')
+            if item is None:
+                raise FileNotFoundError(f"No checkpoint in {table_name}")
+            checkpoint = json.loads(item['data']['S'])
+        else:
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'counts': {}, 'after_id': None, 'matches': {}, 'breaker': {}}
+    checkpoint.setdefault('matches', {})
+    if time.time() - checkpoint.get('updated', 0) > max_age:
+        checkpoint.update(counts={}, after_id=None, matches={})
+    return checkpoint
+
+
+def write_checkpoint(
+    counts, after_id, breaker_state, checkpoint_path=CHECKPOINT_PATH, matches=None,
+    table_name=SCAN_HISTORY_TABLE, dynamodb_client=None
+):
+    data = json.dumps({
+        'counts': counts, 'after_id': after_id, 'matches': matches or {},
+        'breaker': breaker_state, 'updated': time.time()
+    })
+    if table_name:
+        dynamodb_client = dynamodb_client or get_dynamodb_client()
+        dynamodb_client.put_item(TableName=table_name, Item={**CHECKPOINT_KEY, 'data': {'S': data}})
+        return
+    with open(checkpoint_path + ".tmp", 'w') as f:
+        f.write(data)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+class ProjectStatsCache:
+    # SQLite cache of the project stats: label -> (project id, modified, sessions).
+    # Entries older than ttl are ignored, and when the project id / modified
+    # timestamp are given they must match, so changed projects are re-fetched.
+
+    def __init__(self, path=STATS_CACHE_PATH, ttl=STATS_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS project_stats ("
+                "label TEXT PRIMARY KEY, project_id TEXT, modified TEXT, "
+                "sessions INTEGER, cached_at REAL)"
+            )
+
+    def get(self, label, project_id=None, modified=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT project_id, modified, sessions, cached_at FROM project_stats WHERE label = ?",
+                (label,)
+            ).fetchone()
+            if (
+                row is None
+                or time.time() - row[3] > self.ttl
+                or (project_id is not None and row[0] != project_id)
+                or (modified is not None and row[1] != modified)
+            ):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[2]
+
+    def set(self, label, project_id, modified, sessions):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO project_stats VALUES (?, ?, ?, ?, ?)",
+                (label, project_id, modified, sessions, time.time())
+            )
+
+    def evict_expired(self):
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "DELETE FROM project_stats WHERE cached_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+
+    def close(self):
+        self._conn.close()
+
+
+def find_project(fw, project_label):
+    # Project (with its stats) with the given label
+    with measure("flywheel_lookup", label=project_label):
+        return fw.projects.find_one(f'label={project_label}')
+
+
+def get_project_sessions(fw, project_label):
+    # Number of sessions in the project with the given label
+    return find_project(fw, project_label)['stats']['number_of']['sessions']
+
+
+def fetch_projects_sessions(fw, project_labels, max_workers=FW_MAX_WORKERS, cache=None, deadline=None):
+    # Fetch the number of sessions of each project concurrently, with at most
+    # max_workers requests in flight. Results are collected in the order of
+    # project_labels (duplicates are fetched once); failed labels are returned
+    # in a separate dict with the raised exception. The fetched stats are
+    # stored in the cache for build_project_sessions_index, but its entries
+    # aren't used here: without the modified timestamp of the project (which
+    # only comes with its query, stats included), an out of date entry can't be
+    # told apart. The requests are retried (see call_with_retries) until the
+    # deadline; the labels not fetched by then fail with DeadlineExceeded.
+    labels = list(dict.fromkeys(project_labels))
+    counts, errors = {}, {}
+
+    # Not a "with" block: its exit would wait for the requests still running at
+    # the deadline
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(labels))))
+    try:
+        futures = {
+            label: executor.submit(call_with_retries, find_project, fw, label, deadline=deadline)
+            for label in labels
+        }
+        for label in labels:
+            try:
                 try:
-                    project = fw.projects.find_one(f'label={project_label}')
-                    site_scans += project['stats']['number_of']['sessions']
-                    print(project_label,': ' , project['stats']['number_of']['sessions'])
-                
-                except Exception as e: 
-                    print('Something went wrong', e)
-    
-            df.loc[df['city'] == city, 'scans'] = site_scans
-    
-            # Check if the value exists in the cities column
-            if city in df['city'].values:
-                # Update the cell in scans column
-                df.loc[df['city'] == city, 'scans'] = site_scans
+                    project = futures[label].result(timeout=deadline.timeout() if deadline else None)
+                except FuturesTimeoutError:
+                    futures[label].cancel()
+                    raise DeadlineExceeded(f"No time left for project '{label}'")
+                counts[label] = project['stats']['number_of']['sessions']
+                if cache is not None:
+                    cache.set(label, project['_id'], str(project['modified']), counts[label])
+                log_event("project_sessions", label=label, sessions=counts[label])
+            except Exception as e:
+                errors[label] = e
+                log_event("project_sessions", level="error", label=label, error=f"{type(e).__name__}: {e}")
+    finally:
+        executor.shutdown(wait=False)
+
+    return counts, errors
+
+
+def build_project_sessions_index(fw, project_labels, page_size=FW_PAGE_SIZE, cache=None, deadline=None, cursor=None):
+    # List all the accessible projects in pages of page_size and keep a
+    # label -> number of sessions index of the requested labels, so the number
+    # of API calls doesn't grow with the number of registered sites. With a
+    # cache, the listing is done without stats and only the projects whose id
+    # or modified timestamp changed are fetched with their stats. The requests
+    # are retried (see call_with_retries) until the deadline; the labels not
+    # found or fetched by then fail with DeadlineExceeded. The listing starts
+    # after cursor['after_id'], and cursor['after_id'] is set to where it
+    # stopped (None once complete), so that the next run can resume it; the
+    # projects already listed whose stats weren't fetched are kept in
+    # cursor['matches'], as they won't be listed again.
+    # Same return format as fetch_projects_sessions.
+    labels = list(dict.fromkeys(project_labels))
+    wanted = set(labels)
+    # label -> {project id: project}
+    matches = {}
+
+    after_id = cursor.get('after_id') if cursor else None
+    if after_id:
+        for label, projects in (cursor.get('matches') or {}).items():
+            if label in wanted:
+                for project in projects:
+                    matches.setdefault(label, {})[project['_id']] = dict(project, label=label)
+    listed = False
+    while not (deadline is not None and deadline.expired()):
+        page_kwargs = {'after_id': after_id} if after_id else {}
+        with measure("flywheel_list_projects") as record:
+            page = call_with_retries(
+                fw.get_all_projects, exhaustive=True, stats=cache is None, limit=page_size,
+                deadline=deadline, **page_kwargs
+            )
+            record['Count'] = len(page)
+        for project in page:
+            if project['label'] in wanted:
+                matches.setdefault(project['label'], {})[project['_id']] = project
+        if len(page) < page_size:
+            listed = True
+            break
+        after_id = page[-1]['_id']
+    counts, errors = {}, {}
+    stale = {}
+    for label in labels:
+        projects = list(matches.get(label, {}).values())
+        if not projects and not listed:
+            errors[label] = DeadlineExceeded(f"Project '{label}' not listed before the deadline")
+            continue
+        if len(projects) != 1:
+            errors[label] = ValueError(f"Found {len(projects)} projects with label '{label}'")
+            continue
+        project = projects[0]
+        if cache is None:
+            counts[label] = project['stats']['number_of']['sessions']
+            continue
+        sessions = cache.get(label, project['_id'], str(project['modified']))
+        if sessions is None:
+            stale[project['_id']] = label
+        else:
+            counts[label] = sessions
+
+    stale_ids = list(stale)
+    for i in range(0, len(stale_ids), STATS_FETCH_CHUNK):
+        if deadline is not None and deadline.expired():
+            break
+        ids = stale_ids[i:i + STATS_FETCH_CHUNK]
+        with measure("flywheel_project_stats") as record:
+            projects = call_with_retries(
+                fw.get_all_projects, exhaustive=True, stats=True,
+                filter=f"_id=|[{','.join(ids)}]", deadline=deadline
+            )
+            record['Count'] = len(projects)
+        for project in projects:
+            label = stale.get(project['_id'])
+            if label is None:
+                continue
+            counts[label] = project['stats']['number_of']['sessions']
+            cache.set(label, project['_id'], str(project['modified']), counts[label])
+    for label in stale.values():
+        if label not in counts:
+            if deadline is not None and deadline.expired():
+                errors[label] = DeadlineExceeded(f"No time left for the stats of project '{label}'")
             else:
-                # Create a dictionary for the new row
-                new_row_data = {
-                    'city': city,
-                    'scans': site_scans
+                errors[label] = ValueError(f"Could not get the stats of project '{label}'")
+    if cursor is not None:
+        cursor['after_id'] = None if listed else after_id
+        # A complete listing is started again from the beginning
+        cursor['matches'] = {} if listed else {
+            label: [
+                {'_id': project['_id'], 'modified': str(project['modified'])}
+                for project in matches[label].values()
+            ]
+            for label in stale.values()
+            if label not in counts
+        }
+
+    for label in labels:
+        if label in counts:
+            log_event("project_sessions", label=label, sessions=counts[label])
+        else:
+            log_event("project_sessions", level="error", label=label, error=str(errors[label]))
+
+    return counts, errors
+
+
+def get_projects_sessions(fw, project_labels, mode=FW_FETCH_MODE, cache=None, deadline=None, cursor=None):
+    if mode == "bulk":
+        return build_project_sessions_index(fw, project_labels, cache=cache, deadline=deadline, cursor=cursor)
+    if mode == "concurrent":
+        return fetch_projects_sessions(fw, project_labels, cache=cache, deadline=deadline)
+    raise ValueError(f"Unknown Flywheel fetch mode: {mode}")
+
+
+def fetch_project_counts(fw, project_labels, cache=None, deadline=None, checkpoint_path=CHECKPOINT_PATH):
+    # Number of sessions of each project, within the deadline. The counts of an
+    # unfinished previous run (checkpoint) are reused, the labels with an open
+    # circuit breaker are skipped, and only the other ones are fetched. If the
+    # deadline stops the run, the counts so far (and where the listing of the
+    # projects stopped) are saved for the next invocation (see read_checkpoint).
+    # Same return format as fetch_projects_sessions; the labels left for the
+    # next run fail with DeadlineExceeded.
+    labels = list(dict.fromkeys(project_labels))
+    checkpoint = read_checkpoint(checkpoint_path)
+    cursor = {'after_id': checkpoint['after_id'], 'matches': checkpoint['matches']}
+    breaker = CircuitBreaker(checkpoint['breaker'])
+    counts = {label: checkpoint['counts'][label] for label in labels if label in checkpoint['counts']}
+    resumed = len(counts)
+
+    errors = {}
+    todo = []
+    for label in labels:
+        if label in counts:
+            continue
+        if breaker.allow(label):
+            todo.append(label)
+        else:
+            errors[label] = RuntimeError(f"Circuit open for project '{label}'")
+    if todo:
+        fetched, fetch_errors = get_projects_sessions(fw, todo, cache=cache, deadline=deadline, cursor=cursor)
+        counts.update(fetched)
+        errors.update(fetch_errors)
+        for label in todo:
+            if not isinstance(errors.get(label), DeadlineExceeded):
+                breaker.record(label, label in fetched)
+
+    pending = [label for label, e in errors.items() if isinstance(e, DeadlineExceeded)]
+    if pending:
+        write_checkpoint(counts, cursor['after_id'], breaker.state, checkpoint_path, cursor.get('matches'))
+    else:
+        write_checkpoint({}, None, breaker.state, checkpoint_path)
+    time_left = deadline.timeout() if deadline is not None else None
+    log_event(
+        "project_counts", level="warning" if pending else "info", resumed=resumed,
+        fetched=len(counts) - resumed, failed=len(errors) - len(pending), pending=pending,
+        time_left_ms=None if time_left is None else round(time_left * 1000)
+    )
+    return counts, errors
+
+
+def fetch_world_data(
+    url=WORLD_DATA_URL, cache_dir=WORLD_DATA_CACHE_DIR, max_age=WORLD_DATA_MAX_AGE,
+    fallback_path=BUNDLED_WORLD_DATA
+):
+    # Local copy of the world data: a cached copy younger than max_age is used
+    # as is ("hit"), an older one is revalidated with a conditional request
+    # ("revalidated" on 304, "download" otherwise). If the server can't be
+    # reached, the cached copy ("stale") or the bundled one ("fallback") is used.
+    # Returns the path to the file and how it was obtained.
+    with measure("world_data_fetch") as record:
+        path, status = _fetch_world_data(url, cache_dir, max_age, fallback_path)
+        record['status'] = status
+        record['Bytes'] = os.path.getsize(path)
+    return path, status
+
+
+def _fetch_world_data(url, cache_dir, max_age, fallback_path):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, os.path.basename(url))
+    meta_path = path + ".json"
+    meta = {}
+    if os.path.isfile(path) and os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    if meta and time.time() - meta['fetched_at'] < max_age:
+        status = "hit"
+    else:
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            requests = lazy_import("requests")
+            response = requests.get(url, headers=headers, timeout=30)
+            if response.status_code == 304:
+                status = "revalidated"
+            else:
+                response.raise_for_status()
+                with open(path + ".part", "wb") as f:
+                    f.write(response.content)
+                os.replace(path + ".part", path)
+                meta = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
                 }
-                
-                # Create a new DataFrame with NaN for all other columns
-                new_row = pd.DataFrame({col: [np.nan] for col in df.columns}, index=[0])
-                
-                
-                # Update the new row with the specified values
-                new_row.update(pd.DataFrame(new_row_data, index=[0]))
-    
-                # Append the new row to the DataFrame
-                df = pd.concat([df, new_row], ignore_index=True)
-    
-                # rows.append([city,site_scans])
-    
-         
-    except Exception as e: 
-        print('Something went wrong', e)
-        
+                status = "download"
+            meta['fetched_at'] = time.time()
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        except Exception as e:
+            log_event("world_data_download", level="warning", error=f"{type(e).__name__}: {e}")
+            if meta:
+                status = "stale"
+            elif os.path.isfile(fallback_path):
+                path, status = fallback_path, "fallback"
+            else:
+                raise
+    return path, status
+
+
+@functools.lru_cache(maxsize=4)
+def _read_world_data(path, mtime):
+    # Parsed world data, kept in memory on warm containers until the file changes
+    gpd = lazy_import("geopandas")
+    with measure("world_data_load") as record:
+        world_data = gpd.read_file(path)
+        world_data.columns = map(str.lower, world_data.columns)
+        record['Count'] = len(world_data)
+    return world_data
+
+
+def read_world_data(path):
+    # The geometry artifact (".geojson") is read without geopandas
+    if path.endswith(".geojson"):
+        return _read_geometry_artifact(path, os.path.getmtime(path))
+    return _read_world_data(path, os.path.getmtime(path))
+
+
+@functools.lru_cache(maxsize=2)
+def _read_geometry_artifact(path, mtime):
+    # One row per country, with the GeoJSON feature of the country (already
+    # simplified and quantized) in the "feature" column instead of a geometry
+    pd = lazy_import("pandas")
+    with measure("world_data_load", source="artifact") as record:
+        with open(path) as f:
+            geojson = json.load(f)
+        world_data = pd.DataFrame([
+            {
+                **feature['properties'],
+                'feature': {
+                    'type': 'Feature',
+                    'properties': {'name': feature['properties']['name']},
+                    'geometry': feature['geometry'],
+                },
+            }
+            for feature in geojson['features']
+        ])
+        record['Count'] = len(world_data)
+        record['Bytes'] = os.path.getsize(path)
+    return world_data
+
+
+def map_geometry_path():
+    # File to build the map from: the geometry artifact if packaged, otherwise
+    # the world data (downloaded and read with geopandas)
+    if GEOMETRY_ARTIFACT_PATH and os.path.isfile(GEOMETRY_ARTIFACT_PATH):
+        return GEOMETRY_ARTIFACT_PATH
+    return fetch_world_data()[0]
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def get_dynamodb_client():
+    boto3 = lazy_import("boto3")
+    return boto3.client("dynamodb", endpoint_url=DYNAMODB_ENDPOINT_URL)
+
+
+def create_scan_history_table(table_name=SCAN_HISTORY_TABLE, dynamodb_client=None):
+    # Table with a string partition key "pk" and sort key "sk":
+    # - history items: pk = "<registry>#<city>" or "project#<label>", sk = time
+    #   of the run (ISO 8601), i.e. one Query per site for its counts over time
+    # - latest items: pk = "latest", sk = the pk of the history item, i.e. one
+    #   Query for the latest counts of all the sites
+    # - webhook items: pk = "event#<id>" (expiring), and pk = "events" for the
+    #   state of the debounced render
+    # - pk = "checkpoint": the checkpoint of an unfinished run (see read_checkpoint)
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    try:
+        dynamodb_client.create_table(
+            TableName=table_name,
+            KeySchema=[
+                {'AttributeName': 'pk', 'KeyType': 'HASH'},
+                {'AttributeName': 'sk', 'KeyType': 'RANGE'},
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'pk', 'AttributeType': 'S'},
+                {'AttributeName': 'sk', 'AttributeType': 'S'},
+            ],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        dynamodb_client.get_waiter('table_exists').wait(TableName=table_name)
+        # Ids of the webhook events (see apply_session_event) expire
+        dynamodb_client.update_time_to_live(
+            TableName=table_name,
+            TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'expires'},
+        )
+    except dynamodb_client.exceptions.ResourceInUseException:
+        pass
+
+
+def batch_write_items(items, table_name=SCAN_HISTORY_TABLE, dynamodb_client=None, max_retries=5):
+    # batch_write_item, 25 items at a time, retrying the unprocessed items
+    # with exponential backoff
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    for i in range(0, len(items), 25):
+        requests_batch = {table_name: [{'PutRequest': {'Item': item}} for item in items[i:i + 25]]}
+        for attempt in range(max_retries + 1):
+            response = dynamodb_client.batch_write_item(RequestItems=requests_batch)
+            requests_batch = response.get('UnprocessedItems') or {}
+            if not requests_batch:
+                break
+            if attempt == max_retries:
+                raise RuntimeError(f"Could not write {len(requests_batch[table_name])} items to {table_name}")
+            time.sleep(0.05 * 2 ** attempt)
+
+
+def write_scan_history(project_counts, city_scans, run_at=None, table_name=SCAN_HISTORY_TABLE, dynamodb_client=None):
+    # city_scans: {registry: {city: scans}}. Each project and city gets a
+    # history item and a "latest" item
+    run_at = run_at or time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    counts = {f"project#{label}": sessions for label, sessions in project_counts.items()}
+    for registry, scans in city_scans.items():
+        counts.update({f"{registry}#{city}": n for city, n in scans.items()})
+
+    items = []
+    for key, n in counts.items():
+        items.append({'pk': {'S': key}, 'sk': {'S': run_at}, 'scans': {'N': str(n)}})
+        items.append({'pk': {'S': 'latest'}, 'sk': {'S': key}, 'scans': {'N': str(n)}, 'run_at': {'S': run_at}})
+    with measure("dynamodb_write", table=table_name, run_at=run_at) as record:
+        batch_write_items(items, table_name, dynamodb_client)
+        record['Count'] = len(items)
+    return run_at
+
+
+def query_items(dynamodb_client, **query_kwargs):
+    while True:
+        response = dynamodb_client.query(**query_kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def read_latest_snapshot(table_name=SCAN_HISTORY_TABLE, dynamodb_client=None):
+    # Latest counts of all the projects and cities, with a single Query.
+    # Returns ({label: sessions}, {registry: {city: scans}})
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    project_counts, city_scans = {}, {}
+    for item in query_items(
+        dynamodb_client,
+        TableName=table_name,
+        KeyConditionExpression='pk = :pk',
+        ExpressionAttributeValues={':pk': {'S': 'latest'}},
+    ):
+        kind, name = item['sk']['S'].split('#', 1)
+        if kind == 'project':
+            project_counts[name] = int(item['scans']['N'])
+        else:
+            city_scans.setdefault(kind, {})[name] = int(item['scans']['N'])
+    return project_counts, city_scans
+
+
+def read_site_history(city, registry="sites", table_name=SCAN_HISTORY_TABLE, dynamodb_client=None):
+    # [(time of the run, scans)] of a site, oldest first
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    return [
+        (item['sk']['S'], int(item['scans']['N']))
+        for item in query_items(
+            dynamodb_client,
+            TableName=table_name,
+            KeyConditionExpression='pk = :pk',
+            ExpressionAttributeValues={':pk': {'S': f"{registry}#{city}"}},
+        )
+    ]
+
+
+def merge_city_scans(df, city_scans):
+    # Merge the number of scans per city (a Series indexed by city) into the
+    # sites table in one pass: update the known cities and append the new ones
+    # (with NaN in the other columns) with a single concatenation
+    known = df['city'].isin(city_scans.index)
+    df.loc[known, 'scans'] = df.loc[known, 'city'].map(city_scans)
+
+    new_cities = city_scans.index[~city_scans.index.isin(df['city'])]
+    if len(new_cities):
+        pd = lazy_import("pandas")
+        new_rows = pd.DataFrame(
+            {'city': new_cities, 'scans': city_scans[new_cities].to_numpy()}
+        ).reindex(columns=df.columns)
+        df = pd.concat([df, new_rows], ignore_index=True)
+    return df
+
+
+def normalize_place_name(name):
+    # Lookup key of a place name: no accents, case, punctuation or extra spaces
+    name = unicodedata.normalize('NFKD', str(name))
+    name = "".join(c if c.isalnum() else " " for c in name if not unicodedata.combining(c))
+    return " ".join(name.casefold().split())
+
+
+@functools.lru_cache(maxsize=2)
+def _load_gazetteer(path, mtime):
+    # {key: [place]}, the most populated place first (the file is sorted)
+    index = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            place = {column: row.get(column) or None for column in ['city', *GAZETTEER_COLUMNS]}
+            for column in ('lat', 'lng', 'population', 'id'):
+                if place[column] is not None:
+                    place[column] = float(place[column])
+            index.setdefault(row['key'], []).append(place)
+    return index
+
+
+def load_gazetteer(path=GAZETTEER_PATH):
+    return _load_gazetteer(path, os.path.getmtime(path))
+
+
+def lookup_place(gazetteer, city, country=None):
+    # The country (name, ISO 2 or ISO 3 code) chooses between homonyms
+    places = gazetteer.get(normalize_place_name(city), [])
+    if country is not None:
+        key = normalize_place_name(country)
+        places = [
+            place for place in places
+            if key in {normalize_place_name(place[column] or '') for column in ('country', 'iso2', 'iso3')}
+        ]
+    return places[0] if places else None
+
+
+def fill_site_locations(df, gazetteer_path=GAZETTEER_PATH):
+    # Fill the missing location columns of the sites without lat/lng from the
+    # gazetteer, so new sites show up on the map without geocoding requests
+    pd = lazy_import("pandas")
+    missing = df.index[df['lat'].isna() | df['lng'].isna()]
+    if not len(missing):
+        return df
+    if not os.path.exists(gazetteer_path):
+        log_event("gazetteer", level="warning", error="not found", path=gazetteer_path, sites=len(missing))
+        return df
+
+    gazetteer = load_gazetteer(gazetteer_path)
+    for i in missing:
+        city = df.at[i, 'city']
+        country = df.at[i, 'country'] if 'country' in df.columns else None
+        place = lookup_place(gazetteer, city, country if pd.notna(country) else None)
+        if place is None:
+            log_event("gazetteer", level="warning", city=city, error="not found")
+            continue
+        for column in GAZETTEER_COLUMNS:
+            value = place[column]
+            if column not in df.columns or value is None or pd.notna(df.at[i, column]):
+                continue
+            if isinstance(value, str) and df[column].dtype != object:
+                df[column] = df[column].astype(object)
+            df.at[i, column] = value
+        log_event("gazetteer", city=city, lat=place['lat'], lng=place['lng'], country=place['country'])
+    return df
+
+
+def compute_fingerprint(project_counts, df, csv_paths, world_data_version):
+    # SHA-256 of everything the map and the uploads depend on: the counts per
+    # project, the sites table, the other CSV inputs and the world data version
+    sha = hashlib.sha256()
+    sha.update(json.dumps(project_counts, sort_keys=True).encode())
+    sha.update(df.to_csv(index=False).encode())
+    for csv_path in csv_paths:
+        with open(csv_path, 'rb') as f:
+            sha.update(hashlib.sha256(f.read()).digest())
+    sha.update(world_data_version.encode())
+    return sha.hexdigest()
+
+
+def read_fingerprint(fingerprint_path=FINGERPRINT_PATH):
+    try:
+        with open(fingerprint_path) as f:
+            return json.load(f).get('fingerprint')
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_fingerprint(fingerprint, fingerprint_path=FINGERPRINT_PATH):
+    with open(fingerprint_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'created': time.time()}, f)
+
+
+def fetch_and_merge(fw, df, sites_cities, from_history=False, deadline=None):
+    # Counts per project (from Flywheel or the scan history), merged into the
+    # sites table. The counts already in the table are kept for the cities with
+    # projects left for the next run by the deadline (see fetch_project_counts);
+    # the errors of single projects are logged there. Any other failure is
+    # raised, so that stale counts aren't published.
+    # Returns (project_counts, df)
+    pd = lazy_import("pandas")
+    np = lazy_import("numpy")
+    project_counts = {}
+    pending = set()
+    if from_history:
+        project_counts, _ = read_latest_snapshot()
+    else:
+        stats_cache = ProjectStatsCache() if STATS_CACHE_PATH else None
+        project_counts, errors = fetch_project_counts(
+            fw, [label for labels in sites_cities.values() for label in labels],
+            cache=stats_cache, deadline=deadline
+        )
+        pending = {label for label, e in errors.items() if isinstance(e, DeadlineExceeded)}
+        if stats_cache is not None:
+            stats_cache.evict_expired()
+            log_event("project_stats_cache", hits=stats_cache.hits, misses=stats_cache.misses)
+            stats_cache.close()
+    city_scans = pd.Series(
+        {
+            city: sum(project_counts.get(label, 0) for label in project_labels)
+            for city, project_labels in sites_cities.items()
+            if pending.isdisjoint(project_labels)
+        },
+        dtype=np.int64
+    )
+    df = merge_city_scans(df, city_scans)
+    df = fill_site_locations(df)
+
+    if SCAN_HISTORY_TABLE and not from_history:
+        # The full run reconciles the counts updated by the webhooks: log
+        # how far they drifted, and overwrite them
+        previous_counts, _ = read_latest_snapshot()
+        drift = {
+            label: sessions - previous_counts[label]
+            for label, sessions in project_counts.items()
+            if label in previous_counts and sessions != previous_counts[label]
+        }
+        log_event("reconciliation", level="warning" if drift else "info", drift=drift)
+        write_scan_history(project_counts, {'sites': city_scans.to_dict()})
+
     # temp_csv_file = csv.writer(open("/tmp/site_scans.csv", "w+"))
     # # writing rows in to the CSV file
     
@@ -132,30 +1102,264 @@ def lambda_handler(event, context):
     # df = pd.DataFrame(columns=['city','n_scans'],data=rows)
     #df.to_csv("site_scans.csv",index=False)
 
-    df["scans"] = df["scans"].apply(np.int64)
+    df["scans"] = df["scans"].astype(np.int64)
+    return project_counts, df
 
-    write_csv(df)
-    update_data()
+
+def load_world_data():
+    # Local copy of the world data, and the base layer of the map (kept in
+    # memory for update_data; the world data is only parsed if it isn't cached)
+    world_data_path = map_geometry_path()
+    load_base_figure(world_data_path)
+    return world_data_path
+
+
+class PipelineTimeline:
+    # Runs the blocking pipeline stages in threads, each one once the stages
+    # it depends on are done, and reports their spans, the total duration, the
+    # duration one after the other and the critical path (the chain of
+    # dependencies that ended last)
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.dependencies = {}
+        self._names = {}
+
+    def stage(self, name, func, *args, after=()):
+        loop = asyncio.get_event_loop()
+
+        async def run():
+            await asyncio.gather(*after)
+            begin = time.perf_counter()
+            try:
+                return await loop.run_in_executor(None, functools.partial(func, *args))
+            finally:
+                end = time.perf_counter()
+                self.spans[name] = (begin - self.start, end - self.start)
+                STAGE_TIMES_MS[name] = round((end - begin) * 1000, 1)
+                emit_metrics(f"stage.{name}", {'Duration': STAGE_TIMES_MS[name], 'MaxRSS': max_rss_mb()})
+
+        task = asyncio.ensure_future(run())
+        self._names[task] = name
+        self.dependencies[name] = [self._names[dependency] for dependency in after]
+        return task
+
+    def report(self):
+        if not self.spans:
+            return {}
+
+        def ms(seconds):
+            return round(seconds * 1000, 1)
+
+        critical_path = [max(self.spans, key=lambda name: self.spans[name][1])]
+        while True:
+            done = [name for name in self.dependencies[critical_path[0]] if name in self.spans]
+            if not done:
+                break
+            critical_path.insert(0, max(done, key=lambda name: self.spans[name][1]))
+        wall = max(end for _, end in self.spans.values())
+        sequential = sum(end - begin for begin, end in self.spans.values())
+        report = {
+            'spans_ms': {name: [ms(begin), ms(end)] for name, (begin, end) in self.spans.items()},
+            'wall_ms': ms(wall),
+            'sequential_ms': ms(sequential),
+            'speedup': round(sequential / wall, 2) if wall else None,
+            'critical_path': critical_path,
+        }
+        log_event("pipeline_timing", **report)
+        return report
+
+
+async def run_pipeline_async(fw, df, sites_cities, from_history=False, deadline=None):
+    # Same steps as lambda_handler, but the world data is loaded while the
+    # counts are fetched, and the CSV is uploaded while the map is rendered
+    timeline = PipelineTimeline()
+    merge = timeline.stage("fetch_and_merge", fetch_and_merge, fw, df, sites_cities, from_history, deadline)
+    world_data = timeline.stage("world_data", load_world_data)
+
+    def fingerprint_inputs():
+        (project_counts, merged), world_data_path = merge.result(), world_data.result()
+        return compute_fingerprint(
+            project_counts, merged, ['developmentSites.csv'], file_sha256(world_data_path)
+        )
+
+    fingerprinted = timeline.stage("fingerprint", fingerprint_inputs, after=[merge, world_data])
+    fingerprint = await fingerprinted
+    if fingerprint == read_fingerprint():
+        log_event("unchanged", fingerprint=fingerprint)
+        timeline.report()
+        startup_report()
+        return {
+            'statusCode': 200,
+            'body': "Unchanged"
+        }
+
+    _, df = merge.result()
+    csv_written = timeline.stage("write_csv", write_csv, df, after=[fingerprinted])
+    map_rendered = timeline.stage("render_map", update_data, world_data.result(), after=[csv_written])
+    results = await asyncio.gather(
+        timeline.stage("upload_csv", update_drive, ['site_scans.csv'], after=[csv_written]),
+        timeline.stage("upload_map", update_drive, ['unity_map.html'], after=[map_rendered]),
+        timeline.stage(
+            "upload_s3", update_s3, ['site_scans.csv', 'unity_map.html'], after=[csv_written, map_rendered]
+        ),
+    )
+    log_event("upload", results=results)
+    timeline.report()
+    check_uploads(results)
+    write_fingerprint(fingerprint)
+    startup_report()
+    return {
+        'statusCode': 200,
+        'body': "Success"
+    }
+
+
+def lambda_handler(event, context):
+    
+    # Requests from API Gateway or a function URL are served from the files of
+    # the last run (see serve_handler)
+    if is_http_event(event):
+        return serve_handler(event, context)
+    # {"action": "flush_events"} (e.g. scheduled every minute) renders the
+    # counts updated by the Flywheel webhooks once the debounce delay is over
+    if (event or {}).get('action') == 'flush_events':
+        LOG_CONTEXT['request_id'] = getattr(context, 'aws_request_id', None)
+        start_stages()
+        return {
+            'statusCode': 200,
+            'body': maybe_render_events(force=bool(event.get('force')), deadline=Deadline(context))
+        }
+
+    LOG_CONTEXT['request_id'] = getattr(context, 'aws_request_id', None)
+    start_stages()
+    # The Flywheel requests stop in time to write and publish what is complete
+    deadline = Deadline(context)
+    # {"source": "history"} uses the latest counts saved in the scan history
+    # (SCAN_HISTORY_TABLE) instead of querying Flywheel
+    from_history = (event or {}).get('source') == 'history'
+    pd = lazy_import("pandas")
+    end_stage("imports")
+
+    fw = None
+    if not from_history:
+        flywheel = lazy_import("flywheel")
+        API = os.getenv("API_TOKEN")
+        fw = flywheel.Client(
+            api_key=API,
+            request_timeout=deadline.timeout(FW_REQUEST_TIMEOUT),
+            connect_timeout=deadline.timeout(FW_CONNECT_TIMEOUT),
+        )
+    
+        # Check user Info
+        with measure("flywheel_current_user"):
+            user_info = fw.get_current_user()
+        log_event("flywheel_user", firstname=user_info.firstname, lastname=user_info.lastname, email=user_info.email)
+    
+    # Retrieve sites data (this assumes 'sites' refer to some Flywheel data type - adjust accordingly)
+    # For example, assume we're retrieving projects and filtering their location metadata:
+    sites_cities = SITES_CITIES
+    
+    log_event("sites", cities=len(sites_cities), projects=sum(map(len, sites_cities.values())))
+    # Retrieve sites data (this assumes 'sites' refer to some Flywheel data type - adjust accordingly)
+    # For example, assume we're retrieving projects and filtering their location metadata
+    df = pd.read_csv("unitySites.csv")
+    #print(df)
+    end_stage("setup")
+
+    mode = (event or {}).get('pipeline', PIPELINE_MODE)
+    if mode == "async":
+        return asyncio.run(run_pipeline_async(fw, df, sites_cities, from_history, deadline))
+    if mode != "sequential":
+        raise ValueError(f"Unknown pipeline mode: {mode}")
+
+    project_counts, df = fetch_and_merge(fw, df, sites_cities, from_history, deadline)
+    end_stage("fetch_and_merge")
+
+    body = publish_outputs(project_counts, df)
+    startup_report()
     
     
     return {
         'statusCode': 200,
-        'body': "Success"
+        'body': body
     }
 
-def update_data():
+
+def publish_outputs(project_counts, df):
+    # Write the CSV, render the map and upload them, unless nothing changed
+    # since the last run (see compute_fingerprint). Returns "Success" or
+    # "Unchanged"
+    world_data_path = map_geometry_path()
+    fingerprint = compute_fingerprint(
+        project_counts, df, ['developmentSites.csv'], file_sha256(world_data_path)
+    )
+    end_stage("world_data_and_fingerprint")
+    if fingerprint == read_fingerprint():
+        log_event("unchanged", fingerprint=fingerprint)
+        return "Unchanged"
+
+    write_csv(df)
+    end_stage("write_csv")
+    update_data(world_data_path)
+    end_stage("render_map")
+    results = [update_drive(['site_scans.csv', 'unity_map.html']), update_s3(['site_scans.csv', 'unity_map.html'])]
+    log_event("upload", results=results)
+    end_stage("upload")
+    check_uploads(results)
+    write_fingerprint(fingerprint)
+    return "Success"
+
+
+def check_uploads(results):
+    # Raise if any upload failed (update_drive returns its exception, update_s3
+    # one per file), so that the fingerprint isn't saved and the next run
+    # uploads again
+    errors = []
+    for result in results:
+        if isinstance(result, Exception):
+            errors.append(result)
+        elif isinstance(result, dict):
+            errors.extend(r for r in result.values() if isinstance(r, Exception))
+    if errors:
+        raise RuntimeError(f"{len(errors)} upload(s) failed: " + "; ".join(f"{type(e).__name__}: {e}" for e in errors))
+
+
+def round_coordinates(coordinates, ndigits):
+    if isinstance(coordinates, (list, tuple)):
+        return [round_coordinates(c, ndigits) for c in coordinates]
+    return round(coordinates, ndigits)
+
+
+def build_countries_geojson(
+    countries, simplify_tolerance=MAP_SIMPLIFY_TOLERANCE, coordinate_precision=MAP_COORDINATE_PRECISION
+):
+    # Compact GeoJSON of the countries: only the "name" property, polygons
+    # simplified to simplify_tolerance degrees and rounded coordinates
+    compact = countries[['name', 'geometry']].copy()
+    if simplify_tolerance:
+        compact['geometry'] = compact.geometry.simplify(simplify_tolerance, preserve_topology=True)
+    geojson = json.loads(compact.to_json(drop_id=True))
+    if coordinate_precision is not None:
+        for feature in geojson['features']:
+            feature['geometry']['coordinates'] = round_coordinates(
+                feature['geometry']['coordinates'], coordinate_precision
+            )
+    return geojson
+
+
+def update_data(world_data_path=None):
     
+    pd = lazy_import("pandas")
+
     # Load country data
     df = pd.read_csv("site_scans.csv")
-    # Download the file
-    url = "https://naciscdn.org/naturalearth/110m/cultural/ne_110m_admin_0_countries.zip"
-    response = requests.get(url)
+    # Get the (cached) world data file
+    if world_data_path is None:
+        world_data_path = map_geometry_path()
 
-    # Save the downloaded zip file
-    with open("ne_110m_admin_0_countries.zip", "wb") as f:
-        f.write(response.content)
-    
-    world_data = gpd.read_file("ne_110m_admin_0_countries.zip")
+    base_figure = load_base_figure(world_data_path)
 
         
     #url = "https://naciscdn.org/naturalearth/110m/cultural/ne_110m_admin_0_countries.zip"
@@ -163,9 +1367,6 @@ def update_data():
 
     #world_data = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
     # world_data = pd.read_csv('/Users/nbourke/GD/atom/unity/beta/geo/world_data.csv')
-    # Parse UNITY countries
-    lst = ['United States of America', 'Pakistan', 'India', 'Zambia', 'Malawi', 'Uganda', 'Kenya', 'Botswana', 'Zimbabwe', 'Ghana', 'Ethiopia', 'South Africa', 'United Kingdom', 'Bangladesh', 'Sweden', 'Canada', 'Netherlands', 'Australia', 'Germany']
-    world_data.columns = map(str.lower, world_data.columns)
 
     # for row in df.iterrows():
         # new_row['city_ascii'] = new_row_data['city']
@@ -174,8 +1375,75 @@ def update_data():
 
     #city_ascii,lat,lng,country,iso2,iso3,admin_name,capital,population,id,scans
 
-    unity = world_data.loc[world_data['name'].isin(lst)]
-    unity_json = json.loads(unity.to_json())
+    with measure("figure_build"):
+        fig = build_figure(df, base_figure)
+
+    with measure("html_serialization") as record:
+        html = fig.to_html(include_plotlyjs='cdn').encode()
+        record['Bytes'] = len(html)
+    with measure("write_map", file='unity_map.html') as record:
+        with open('unity_map.html', 'wb') as f:
+            f.write(html)
+        record['Bytes'] = len(html)
+    if len(html) > MAP_BYTE_BUDGET:
+        log_event("map_size", level="warning", bytes=len(html), budget=MAP_BYTE_BUDGET)
+        
+
+    #fig.show()
+
+
+def load_base_figure(world_data_path, cache_dir=MAP_BASE_CACHE_DIR):
+    # Base layer of the map (see build_base_figure). The UNITY countries rarely
+    # change, so it is saved as a Plotly figure JSON file in cache_dir (and kept
+    # in memory on warm containers), keyed by the world data version: a routine
+    # update then only builds the marker traces, without parsing the world data
+    pio = lazy_import("plotly.io")
+    with measure("base_figure_load") as record:
+        hits = _load_base_figure.cache_info().hits
+        fig_json, record['cache'] = _load_base_figure(
+            world_data_path, file_sha256(world_data_path), cache_dir
+        )
+        if _load_base_figure.cache_info().hits > hits:
+            record['cache'] = "memory"
+        record['Bytes'] = len(fig_json)
+        return pio.from_json(fig_json)
+
+
+@functools.lru_cache(maxsize=2)
+def _load_base_figure(world_data_path, world_data_version, cache_dir):
+    plotly = lazy_import("plotly")
+    key = hashlib.sha256(json.dumps([
+        MAP_BASE_CACHE_VERSION, plotly.__version__, world_data_version, sorted(UNITY_COUNTRIES),
+        MAP_OPTIMIZE, MAP_SIMPLIFY_TOLERANCE, MAP_COORDINATE_PRECISION,
+    ]).encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, f"map_base_{key[:16]}.json") if cache_dir else None
+    if cache_path and os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            return f.read(), "hit"
+
+    fig_json = build_base_figure(read_world_data(world_data_path)).to_json()
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + ".tmp", 'w') as f:
+            f.write(fig_json)
+        os.replace(cache_path + ".tmp", cache_path)
+    return fig_json, "miss"
+
+
+def build_base_figure(world_data):
+    # Map of the UNITY countries, with their codes
+    go = lazy_import("plotly.graph_objects")
+    px = lazy_import("plotly.express")
+
+    # Parse UNITY countries
+    unity = world_data.loc[world_data['name'].isin(UNITY_COUNTRIES)]
+    if 'feature' in unity.columns:
+        # Geometry artifact: the polygons are already compact
+        unity_json = {'type': 'FeatureCollection', 'features': list(unity['feature'])}
+    elif MAP_OPTIMIZE:
+        unity_json = build_countries_geojson(unity)
+    else:
+        unity_json = json.loads(unity.to_json())
 
     # Setup country map
     fig1 = px.choropleth(unity,
@@ -185,14 +1453,44 @@ def update_data():
                     color='name')
 
     ## Add labels on countries
-    fig1.add_scattergeo(
-        geojson=unity_json,
-        locations=unity['name'],
-        featureidkey='properties.name',
-        text=unity['iso_a3'],
-        mode='text',
-    )
-    
+    if MAP_OPTIMIZE:
+        # One choropleth trace per country: embed only the trace's own feature,
+        # and place the labels with coordinates instead of another GeoJSON copy
+        features = {f['properties']['name']: f for f in unity_json['features']}
+        for trace in fig1.data:
+            trace.geojson = {
+                'type': 'FeatureCollection',
+                'features': [features[name] for name in trace.locations],
+            }
+        if 'feature' in unity.columns:
+            label_lat, label_lng = unity['label_lat'], unity['label_lng']
+        else:
+            label_points = unity.geometry.representative_point()
+            label_lat = label_points.y.round(MAP_COORDINATE_PRECISION)
+            label_lng = label_points.x.round(MAP_COORDINATE_PRECISION)
+        fig1.add_scattergeo(
+            lat=label_lat,
+            lon=label_lng,
+            text=unity['iso_a3'],
+            mode='text',
+        )
+    else:
+        fig1.add_scattergeo(
+            geojson=unity_json,
+            locations=unity['name'],
+            featureidkey='properties.name',
+            text=unity['iso_a3'],
+            mode='text',
+        )
+    return go.Figure(data=fig1.data)
+
+
+def build_figure(df, base_figure):
+    # Map of the UNITY countries (base_figure, see load_base_figure), the sites
+    # (df) and the development sites
+    pd = lazy_import("pandas")
+    go = lazy_import("plotly.graph_objects")
+
     city_lst = ['Karachi', 'Lucknow', 'Lusaka','Zomba', 'Blantyre', 'Kampala', 'Nairobi', 'Kisumu', 'Gaborone', 'Harare', 'Accra', 'Kintampo', 'Addis Ababa', 'Cape Town', 'Pretoria', 'London', 'Dhaka', 'Vellore', 'Bonn']
     city_data = df[df['city'].isin(city_lst)]
 
@@ -242,80 +1540,593 @@ def update_data():
                             ),
                         )))
     
-    fig = go.Figure(data = fig1.data + fig2.data + fig3.data)
-
-    with open('unity_map.html', 'w') as f:
-        f.write(fig.to_html(include_plotlyjs='cdn'))
-        
-
-    #fig.show()
-    
+    return go.Figure(data = base_figure.data + fig2.data + fig3.data)
 
 
 def write_csv(df):
-    
-    BUCKET_NAME = os.getenv("BUCKET_NAME")
+    # Uploaded with the map by update_s3 (to S3_BUCKET) and update_drive
     #s3 = boto3.client('s3')
     
-    print(df)
-    
-    with open("site_scans.csv", "w", newline="") as f:
-        temp_csv_file = csv.writer(f)
-    
-        # Write the header
-        temp_csv_file.writerow(df.columns)
-    
-        for index, row in df.iterrows():
-            # print('row: ', row)
-            temp_csv_file.writerow(row)
-            
-    f.close()
-    
-    df.to_csv('site_scans.csv',index=False)
+    # Write the CSV once, atomically (to a temporary file, then renamed)
+    with measure("write_csv", file='site_scans.csv') as record:
+        df.to_csv('site_scans.csv.tmp', index=False)
+        os.replace('site_scans.csv.tmp', 'site_scans.csv')
+        record['Count'] = len(df)
+        record['Bytes'] = os.path.getsize('site_scans.csv')
     #s3.upload_file('./tmp/site_scans.csv', BUCKET_NAME, 'site_scans.csv')
-    file_id = update_drive()
-    
-    print(file_id)
 
 
-def update_drive():
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class GoogleDrivePublisher:
+    # Uploads files to Google Drive folders with one Drive service for all the
+    # uploads: existing files are updated in place (files().update), unchanged
+    # files (same MD5 as Drive's md5Checksum) are skipped, and independent
+    # files are uploaded concurrently. Pass service to use a fake Drive API;
+    # otherwise each thread gets its own HTTP connection (httplib2 is not
+    # thread-safe).
+
+    def __init__(self, service=None, credentials_path=GOOGLE_CREDENTIALS_PATH, max_workers=UPLOAD_MAX_WORKERS):
+        self._credentials = None
+        self._local = threading.local()
+        if service is None:
+            service_account = lazy_import("google.oauth2.service_account")
+            build = lazy_import("googleapiclient.discovery").build
+            self._credentials = service_account.Credentials.from_service_account_file(
+                credentials_path, scopes=['https://www.googleapis.com/auth/drive']
+            )
+            service = build('drive', 'v3', credentials=self._credentials)
+        self.service = service
+        self.max_workers = max_workers
+
+    def _execute(self, request):
+        if self._credentials is None:
+            return request.execute()
+        if not hasattr(self._local, 'http'):
+            google_auth_httplib2 = lazy_import("google_auth_httplib2")
+            httplib2 = lazy_import("httplib2")
+            self._local.http = google_auth_httplib2.AuthorizedHttp(self._credentials, http=httplib2.Http())
+        return request.execute(http=self._local.http)
+
+    def upload(self, file_path, folder_id):
+        # Returns the Drive file ID and "unchanged", "updated" or "created"
+        with measure("drive_upload", file=os.path.basename(file_path)) as record:
+            file_id, result = self._upload(file_path, folder_id)
+            record['result'] = result
+            record['Bytes'] = 0 if result == "unchanged" else os.path.getsize(file_path)
+        return file_id, result
+
+    def _upload(self, file_path, folder_id):
+        MediaFileUpload = lazy_import("googleapiclient.http").MediaFileUpload
+        filename = os.path.basename(file_path)
+        query = f"name='{filename}' and '{folder_id}' in parents and trashed=false"
+        existing_files = self._execute(
+            self.service.files().list(q=query, fields="files(id, name, md5Checksum)")
+        ).get('files', [])
+
+        media = MediaFileUpload(file_path, resumable=False)
+        if not existing_files:
+            file = self._execute(self.service.files().create(
+                body={'name': filename, 'parents': [folder_id]}, media_body=media, fields='id'
+            ))
+            return file['id'], "created"
+
+        # Keep the first match, and remove the duplicates left by older uploads
+        file, duplicates = existing_files[0], existing_files[1:]
+        for duplicate in duplicates:
+            log_event("drive_delete_duplicate", file=duplicate['name'], file_id=duplicate['id'])
+            self._execute(self.service.files().delete(fileId=duplicate['id']))
+
+        if file.get('md5Checksum') == file_md5(file_path):
+            return file['id'], "unchanged"
+
+        self._execute(self.service.files().update(fileId=file['id'], media_body=media, fields='id'))
+        return file['id'], "updated"
+
+    def publish(self, files):
+        # files: {local path: Drive folder ID}. Returns the result of upload
+        # (or the raised exception) for each path
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(files)))) as executor:
+            futures = {
+                file_path: executor.submit(self.upload, file_path, folder_id)
+                for file_path, folder_id in files.items()
+            }
+            for file_path, future in futures.items():
+                try:
+                    results[file_path] = future.result()
+                except Exception as e:
+                    results[file_path] = e
+        return results
+
+
+@functools.lru_cache(maxsize=1)
+def get_drive_publisher():
+    # Built once per container, and reused by the next (warm) invocations
+    return GoogleDrivePublisher()
+
+
+def update_drive(file_paths=('site_scans.csv', 'unity_map.html')):
     
     try:
-        # Load service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            'service-credentials-google.json'
+        results = get_drive_publisher().publish(
+            {file_path: DRIVE_FOLDERS[os.path.basename(file_path)] for file_path in file_paths}
         )
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
+        return results
         
-        # Build the Google Drive service
-        service = build('drive', 'v3', credentials=credentials)
+    except Exception as e:
+        log_event("drive_upload", level="error", error=f"{type(e).__name__}: {e}")
+        return e
 
-        ### UPLOAD FILES TO GDRIVE ###
 
-        file_folder_dict={'site_scans.csv':'1WVRj-wu51QmkzeOYnWeLX0yi6qwEBbqa', 'unity_map.html':'1WTTQb7nKgOvnhLkt6EIQ6tlHEqf09luc'}
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    boto3 = lazy_import("boto3")
+    return boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
 
-        for filename,folder_id in file_folder_dict.items():
-            # File details
-            file_metadata = {
-                'name': filename,  # Name of the file to upload
-                'parents': [folder_id]   # ID of the folder to upload to
-            }
-            media = MediaFileUpload('site_scans.csv')
-        
-            
-             # Search for the file
-            existing_files = search_file(service, filename, folder_id)
-            if existing_files:
-                # If the file exists, delete it
-                for file in existing_files:
-                    print(f"DELETING existing file: {file['name']} (ID: {file['id']})")
-                    delete_file(service, file['id'])
-            
-            # Upload the file
-            file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-            print(f'New file uploaded id {file.get('id')}')
-
-        return {'successfully uploaded to drive'}
-        
-    except Exception as e:
-        print("Failed to upload to drive: ", e)
-        return e
\ No newline at end of file
+
+def update_s3(file_paths=('site_scans.csv', 'unity_map.html')):
+    # Upload the files to S3_BUCKET, where the read path of every container
+    # finds them (see get_served_file). They are stored uncompressed (the read
+    # path compresses them for each Accept-Encoding), with the SHA-256 of the
+    # content in the metadata, and skipped if unchanged.
+    # Returns {file_path: "uploaded" | "unchanged" | exception}
+    if not S3_BUCKET:
+        return {}
+    s3 = get_s3_client()
+    results = {}
+    for file_path in file_paths:
+        file_name = os.path.basename(file_path)
+        key = S3_PREFIX + file_name
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            sha256 = hashlib.sha256(data).hexdigest()
+            try:
+                head = s3.head_object(Bucket=S3_BUCKET, Key=key)
+                if head.get('Metadata', {}).get('content-sha256') == sha256:
+                    results[file_path] = "unchanged"
+                    continue
+            except s3.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise
+            content_type = next(
+                (route[1] for route in SERVE_ROUTES.values() if route[0] == file_name and not route[2]),
+                'application/octet-stream'
+            )
+            with measure("s3_upload", file=file_name) as record:
+                s3.put_object(
+                    Bucket=S3_BUCKET, Key=key, Body=data, ContentType=content_type,
+                    Metadata={'content-sha256': sha256},
+                )
+                record['Bytes'] = len(data)
+            results[file_path] = "uploaded"
+        except Exception as e:
+            log_event("s3_upload", level="error", file=file_name, error=f"{type(e).__name__}: {e}")
+            results[file_path] = e
+    return results
+
+
+def is_http_event(event):
+    # API Gateway REST (v1) events have "httpMethod"; HTTP API (v2) and
+    # function URL events have requestContext.http
+    return isinstance(event, dict) and (
+        'httpMethod' in event or 'http' in (event.get('requestContext') or {})
+    )
+
+
+# Served files, by path: {'version', 'checked_at', 'etag', 'content_type',
+# 'bodies'}, kept on warm containers until the file changes
+_SERVE_CACHE = {}
+
+
+def sites_json(data):
+    # Sites table (CSV bytes) as a JSON array of objects, with numbers for the
+    # numeric columns
+    rows = []
+    for row in csv.DictReader(data.decode('utf-8').splitlines()):
+        for column, value in row.items():
+            if column in ('lat', 'lng', 'population', 'scans') and value:
+                number = float(value)
+                row[column] = int(number) if column in ('population', 'scans') and number.is_integer() else number
+            elif value == '':
+                row[column] = None
+        rows.append(row)
+    return json.dumps(rows, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def load_published_file(file_name, version=None):
+    # (version, content) of the latest published file: the S3 object (see
+    # update_s3) if S3_BUCKET is set, otherwise the file in SERVE_DIR. The
+    # content is None if the file is still at the given version; returns None
+    # if it was never published
+    if S3_BUCKET:
+        s3 = get_s3_client()
+        try:
+            response = s3.get_object(
+                Bucket=S3_BUCKET, Key=S3_PREFIX + file_name, **({'IfNoneMatch': version} if version else {})
+            )
+        except s3.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                return version, None
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response['ETag'], response['Body'].read()
+
+    file_path = os.path.join(SERVE_DIR, file_name)
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    if [stat.st_mtime_ns, stat.st_size] == version:
+        return version, None
+    with open(file_path, 'rb') as f:
+        return [stat.st_mtime_ns, stat.st_size], f.read()
+
+
+def get_served_file(path):
+    # Cache entry of a served path (None if there is no such file). The file is
+    # checked at most every SERVE_REVALIDATE seconds, and only read again (and
+    # its compressed bodies dropped) when it changed
+    file_name, content_type, as_json = SERVE_ROUTES[path]
+    entry = _SERVE_CACHE.get(path)
+    if entry is not None and time.monotonic() - entry['checked_at'] < SERVE_REVALIDATE:
+        return entry
+
+    with measure("serve_load", file=file_name) as record:
+        published = load_published_file(file_name, entry['version'] if entry else None)
+        if published is None:
+            _SERVE_CACHE.pop(path, None)
+            return None
+        version, data = published
+        if data is None:
+            entry['checked_at'] = time.monotonic()
+            return entry
+        if as_json:
+            data = sites_json(data)
+        record['Bytes'] = len(data)
+    entry = {
+        'version': version,
+        'checked_at': time.monotonic(),
+        'etag': hashlib.sha256(data).hexdigest()[:32],
+        'content_type': content_type,
+        'bodies': {'identity': data},
+    }
+    _SERVE_CACHE[path] = entry
+    return entry
+
+
+def compressed_body(entry, encoding):
+    # Body of the entry with the given Content-Encoding, compressed once per
+    # version of the file
+    if encoding not in entry['bodies']:
+        data = entry['bodies']['identity']
+        if encoding == 'br':
+            body = lazy_import("brotli").compress(data, quality=11)
+        else:
+            # mtime=0 so that the same content always gives the same bytes
+            body = gzip.compress(data, compresslevel=9, mtime=0)
+        entry['bodies'][encoding] = body
+    return entry['bodies'][encoding]
+
+
+@functools.lru_cache(maxsize=1)
+def has_brotli():
+    try:
+        lazy_import("brotli")
+        return True
+    except ImportError:
+        return False
+
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison (RFC 9110), and the representations of a version only
+    # differ by their encoding, so any of its ETags matches
+    for tag in (if_none_match or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag.strip('"').split('-')[0] == etag:
+            return True
+    return False
+
+
+def choose_encoding(accept_encoding):
+    # Best Content-Encoding accepted by the client: br (if the brotli package
+    # is installed), then gzip, then identity
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    for encoding in ('br', 'gzip'):
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > 0 and (encoding != 'br' or has_brotli()):
+            return encoding
+    return 'identity'
+
+
+def http_response(status, headers=None, body=b'', head=False):
+    # Response in the API Gateway / function URL format (binary bodies in base64)
+    return {
+        'statusCode': status,
+        'headers': headers or {},
+        'body': '' if head else base64.b64encode(body).decode(),
+        'isBase64Encoded': not head,
+    }
+
+
+def serve_handler(event, context):
+    # Read path: GET/HEAD of the map (/ or /unity_map.html), the sites table
+    # (/site_scans.csv) and the sites as JSON (/sites.json). Nothing is
+    # generated here: the files of the last run (from S3, see
+    # load_published_file) are read once per container and version, compressed once per encoding (chosen by Accept-Encoding),
+    # and answered with a strong ETag; If-None-Match gives a 304.
+    # POST on WEBHOOK_PATH receives the Flywheel webhooks (see webhook_response).
+    http = (event.get('requestContext') or {}).get('http') or {}
+    method = (event.get('httpMethod') or http.get('method') or 'GET').upper()
+    path = event.get('rawPath') or event.get('path') or http.get('path') or '/'
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+
+    if path == WEBHOOK_PATH:
+        if method != 'POST':
+            return http_response(405, {'Allow': 'POST'})
+        return webhook_response(event, headers)
+    if method not in ('GET', 'HEAD'):
+        return http_response(405, {'Allow': 'GET, HEAD'})
+    if path not in SERVE_ROUTES:
+        return http_response(404, {'Content-Type': 'text/plain'}, b'Not found', method == 'HEAD')
+    entry = get_served_file(path)
+    if entry is None:
+        return http_response(404, {'Content-Type': 'text/plain'}, b'Not generated yet', method == 'HEAD')
+
+    encoding = choose_encoding(headers.get('accept-encoding'))
+    etag = f'"{entry["etag"]}"' if encoding == 'identity' else f'"{entry["etag"]}-{encoding}"'
+    response_headers = {
+        'Content-Type': entry['content_type'],
+        'ETag': etag,
+        'Cache-Control': SERVE_CACHE_CONTROL,
+        'Vary': 'Accept-Encoding',
+    }
+    if etag_matches(headers.get('if-none-match'), entry['etag']):
+        return http_response(304, response_headers, head=True)
+
+    if encoding != 'identity':
+        response_headers['Content-Encoding'] = encoding
+    return http_response(200, response_headers, compressed_body(entry, encoding), method == 'HEAD')
+
+
+@functools.lru_cache(maxsize=1)
+def label_index():
+    # Inverted index of the registry: project label -> (registry, city)
+    index = {}
+    for registry, cities in {'sites': SITES_CITIES}.items():
+        for city, labels in cities.items():
+            for label in labels:
+                index[label] = (registry, city)
+    return index
+
+
+@functools.lru_cache(maxsize=1)
+def get_flywheel_client():
+    flywheel = lazy_import("flywheel")
+    return flywheel.Client(
+        api_key=os.getenv("API_TOKEN"), request_timeout=FW_REQUEST_TIMEOUT, connect_timeout=FW_CONNECT_TIMEOUT
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def project_label(project_id):
+    # Label of a project, looked up once per container
+    with measure("flywheel_get_project"):
+        return get_flywheel_client().get_project(project_id).label
+
+
+def parse_flywheel_event(payload):
+    # Normalize a webhook payload:
+    #   {"id": ..., "type": "session.created" | "session.deleted",
+    #    "session": {"_id": ..., "parents": {"project": <project id>}}}
+    # ("event_type", "data" and a "project_label" are accepted too).
+    # Returns {'id', 'delta', 'session_id', 'project_id', 'label'}, or None for
+    # the other events
+    event_type = str(payload.get('type') or payload.get('event_type') or '').lower().replace('_', '.')
+    if not event_type.startswith('session.'):
+        return None
+    delta = {'session.created': 1, 'session.deleted': -1}.get(event_type)
+    if delta is None:
+        return None
+    session = payload.get('session') or payload.get('data') or {}
+    session_id = session.get('_id') or session.get('id') or payload.get('session_id')
+    project_id = (session.get('parents') or {}).get('project') or payload.get('project_id')
+    return {
+        'id': payload.get('id') or f"{event_type}:{session_id}",
+        'delta': delta,
+        'session_id': session_id,
+        'project_id': project_id,
+        'label': payload.get('project_label') or (payload.get('project') or {}).get('label'),
+    }
+
+
+def apply_session_event(event, table_name=SCAN_HISTORY_TABLE, dynamodb_client=None):
+    # Add the event's delta to the latest count of its project and city (see
+    # write_scan_history) and mark the map as out of date, in one transaction:
+    # O(1) whatever the size of the registry. A redelivered event (same id) is
+    # ignored. A project without a count in the history (e.g. new in the
+    # registry) isn't counted from the delta alone: the map is marked for a
+    # full count from Flywheel instead (see maybe_render_events).
+    # Returns "applied", "reconcile", "duplicate" or "ignored" (not a project
+    # of the registry)
+    label = event['label'] or project_label(event['project_id'])
+    registry, city = label_index().get(label, (None, None))
+    if city is None:
+        log_event("flywheel_event", event_id=event['id'], label=label, result="ignored")
+        return "ignored"
+
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    now = time.time()
+    seen = {'Put': {
+        'TableName': table_name,
+        'Item': {
+            'pk': {'S': f"event#{event['id']}"}, 'sk': {'S': 'seen'},
+            'expires': {'N': str(int(now + EVENT_DEDUP_TTL))},
+        },
+        'ConditionExpression': 'attribute_not_exists(pk)',
+    }}
+    render_state = {
+        'TableName': table_name,
+        'Key': {'pk': {'S': 'events'}, 'sk': {'S': 'render'}},
+        'UpdateExpression': 'SET last_event_at = :now, dirty_since = if_not_exists(dirty_since, :now)',
+        'ExpressionAttributeValues': {':now': {'N': str(now)}},
+    }
+    delta = {':delta': {'N': str(event['delta'])}}
+    transactions = [
+        ("applied", [
+            seen,
+            {'Update': {
+                'TableName': table_name,
+                'Key': {'pk': {'S': 'latest'}, 'sk': {'S': f"project#{label}"}},
+                'UpdateExpression': 'ADD scans :delta',
+                'ConditionExpression': 'attribute_exists(scans)',
+                'ExpressionAttributeValues': delta,
+            }},
+            {'Update': {
+                'TableName': table_name,
+                'Key': {'pk': {'S': 'latest'}, 'sk': {'S': f"{registry}#{city}"}},
+                'UpdateExpression': 'ADD scans :delta',
+                'ExpressionAttributeValues': delta,
+            }},
+            {'Update': render_state},
+        ]),
+        ("reconcile", [
+            seen,
+            {'Update': dict(
+                render_state, UpdateExpression=render_state['UpdateExpression'] + ', reconcile = :true',
+                ExpressionAttributeValues={**render_state['ExpressionAttributeValues'], ':true': {'BOOL': True}},
+            )},
+        ]),
+    ]
+    for result, items in transactions:
+        try:
+            with measure("dynamodb_event", table=table_name):
+                dynamodb_client.transact_write_items(TransactItems=items)
+            break
+        except dynamodb_client.exceptions.TransactionCanceledException as e:
+            codes = [reason.get('Code') for reason in e.response.get('CancellationReasons') or [{}]]
+            if codes[0] == 'ConditionalCheckFailed':
+                result = "duplicate"
+                break
+            if result != "applied" or codes[1:2] != ['ConditionalCheckFailed']:
+                raise
+    log_event(
+        "flywheel_event", level="warning" if result == "reconcile" else "info", event_id=event['id'],
+        label=label, city=city, delta=event['delta'], result=result
+    )
+    return result
+
+
+def maybe_render_events(force=False, now=None, deadline=None, table_name=SCAN_HISTORY_TABLE, dynamodb_client=None):
+    # Debounced re-render of the counts updated by the webhooks: once no event
+    # came for EVENT_RENDER_DEBOUNCE seconds (or EVENT_RENDER_MAX_DELAY seconds
+    # after the first event not rendered yet, or with force), one invocation
+    # claims the render and publishes the latest counts of the scan history,
+    # or of a full count from Flywheel if an event needs it (see
+    # apply_session_event). Returns "clean" (nothing to render), "waiting",
+    # "claimed" (by another invocation), or the result of publish_outputs
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    now = now or time.time()
+    key = {'pk': {'S': 'events'}, 'sk': {'S': 'render'}}
+    state = dynamodb_client.get_item(TableName=table_name, Key=key, ConsistentRead=True).get('Item') or {}
+    if 'dirty_since' not in state:
+        return "clean"
+    dirty_since = float(state['dirty_since']['N'])
+    last_event_at = float(state['last_event_at']['N'])
+    if not force and (
+        now - last_event_at < EVENT_RENDER_DEBOUNCE and now - dirty_since < EVENT_RENDER_MAX_DELAY
+    ):
+        return "waiting"
+    reconcile = state.get('reconcile', {}).get('BOOL', False)
+
+    try:
+        dynamodb_client.update_item(
+            TableName=table_name, Key=key,
+            UpdateExpression='REMOVE dirty_since, reconcile',
+            ConditionExpression='dirty_since = :since',
+            ExpressionAttributeValues={':since': state['dirty_since']},
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return "claimed"
+
+    try:
+        pd = lazy_import("pandas")
+        fw = get_flywheel_client() if reconcile else None
+        project_counts, df = fetch_and_merge(
+            fw, pd.read_csv("unitySites.csv"), SITES_CITIES, from_history=not reconcile, deadline=deadline
+        )
+        end_stage("fetch_and_merge")
+        return publish_outputs(project_counts, df)
+    except Exception:
+        # Leave the events to the next flush
+        dynamodb_client.update_item(
+            TableName=table_name, Key=key,
+            UpdateExpression='SET dirty_since = if_not_exists(dirty_since, :since)'
+            + (', reconcile = :true' if reconcile else ''),
+            ExpressionAttributeValues={
+                ':since': state['dirty_since'], **({':true': {'BOOL': True}} if reconcile else {})
+            },
+        )
+        raise
+
+
+def handle_flywheel_events(payloads):
+    # Apply the session events of the webhook payloads (one or a list). The
+    # map isn't rendered here (the webhook is answered right away), but by the
+    # scheduled flush (see maybe_render_events). Returns the result of each event
+    if isinstance(payloads, dict):
+        payloads = [payloads]
+    results = []
+    for payload in payloads:
+        event = parse_flywheel_event(payload)
+        results.append("ignored" if event is None else apply_session_event(event))
+    return {'events': results}
+
+
+def webhook_response(event, headers):
+    # HTTP front of handle_flywheel_events. Without WEBHOOK_TOKEN, every
+    # request is rejected
+    if not WEBHOOK_TOKEN:
+        return http_response(503, {'Content-Type': 'text/plain'}, b'WEBHOOK_TOKEN is not configured')
+    if not hmac.compare_digest(headers.get('x-webhook-token', ''), WEBHOOK_TOKEN):
+        return http_response(401, {'Content-Type': 'text/plain'}, b'Unauthorized')
+    if not SCAN_HISTORY_TABLE:
+        return http_response(503, {'Content-Type': 'text/plain'}, b'SCAN_HISTORY_TABLE is not configured')
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode()
+    try:
+        payloads = json.loads(body)
+    except ValueError:
+        return http_response(400, {'Content-Type': 'text/plain'}, b'Invalid JSON')
+    start_stages()
+    result = handle_flywheel_events(payloads)
+    return http_response(202, {'Content-Type': 'application/json'}, json.dumps(result).encode())
+
+
+# Module initialization time (without the lazily imported dependencies)
+INIT_MS = round((time.perf_counter() - _INIT_START) * 1000, 1)
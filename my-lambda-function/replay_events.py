@@ -0,0 +1,163 @@
+"""Replay Flywheel webhook events against the Lambda handler, locally.
+
+Each event is sent to `app.lambda_handler` as a POST of the function URL on
+WEBHOOK_PATH, as Flywheel would, and the scheduled {"action": "flush_events"}
+is sent every --flush-interval seconds of the stream, so the counts of the scan
+history table and the debounced re-render can be checked without deploying
+(e.g. against DynamoDB Local with DYNAMODB_ENDPOINT_URL). WEBHOOK_TOKEN
+defaults to a local token. The input is a JSON Lines file of
+webhook payloads, or of {"at": <seconds>, "payload": {...}} to keep the timing
+of a recorded stream; --generate makes a synthetic stream instead:
+
+    SCAN_HISTORY_TABLE=unity-scans DYNAMODB_ENDPOINT_URL=http://localhost:8000 \\
+        python replay_events.py events.jsonl --speed 10 --create-table
+    python replay_events.py --generate 500 --debounce 1 --seed-history
+"""
+import argparse
+import base64
+import collections
+import json
+import os
+import random
+import sys
+import time
+import typing as t
+
+
+def read_events(path: str) -> t.List[t.Tuple[float, dict]]:
+    # [(time offset in seconds, payload)] of a JSON Lines file
+    events = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'payload' in record:
+                events.append((float(record.get('at', i)), record['payload']))
+            else:
+                events.append((float(i), record))
+    return events
+
+
+def generate_events(count: int, labels: t.List[str], interval: float = 0.1,
+                    delete_ratio: float = 0.1, seed: int = 0) -> t.List[t.Tuple[float, dict]]:
+    # Synthetic session.created/deleted events of the given project labels,
+    # with some redeliveries (same id) to exercise the deduplication
+    rng = random.Random(seed)
+    events, created = [], []
+    for i in range(count):
+        if created and rng.random() < 0.05:
+            events.append((i * interval, rng.choice(events)[1]))
+            continue
+        if created and rng.random() < delete_ratio:
+            session_id, label = created.pop(rng.randrange(len(created)))
+            event_type = 'session.deleted'
+        else:
+            session_id, label = f"session{i:06d}", rng.choice(labels)
+            created.append((session_id, label))
+            event_type = 'session.created'
+        events.append((i * interval, {
+            'id': f"event{i:06d}",
+            'type': event_type,
+            'session': {'_id': session_id},
+            'project_label': label,
+        }))
+    return events
+
+
+def webhook_request(payload: dict, path: str, token: str) -> dict:
+    # Function URL event (payload format 2.0) of a webhook delivery
+    body = json.dumps(payload).encode()
+    return {
+        'version': '2.0',
+        'rawPath': path,
+        'headers': {'content-type': 'application/json', 'x-webhook-token': token},
+        'requestContext': {'http': {'method': 'POST', 'path': path}},
+        'body': base64.b64encode(body).decode(),
+        'isBase64Encoded': True,
+    }
+
+
+def replay(app, events: t.List[t.Tuple[float, dict]], speed: float = 0.0,
+           flush_interval: float = 60.0) -> collections.Counter:
+    # Send the events to the handler (in real time divided by speed, or as
+    # fast as possible if 0), with a flush every flush_interval seconds of the
+    # stream (0 for none), and count the results
+    results = collections.Counter()
+    start = time.monotonic()
+    first = events[0][0] if events else 0.0
+    next_flush = first + flush_interval
+    for at, payload in events:
+        if speed > 0:
+            time.sleep(max(0.0, start + (at - first) / speed - time.monotonic()))
+        while flush_interval > 0 and at >= next_flush:
+            flush = app.lambda_handler({'action': 'flush_events'}, None)
+            results[f"render_{flush['body']}"] += 1
+            next_flush += flush_interval
+        response = app.lambda_handler(webhook_request(payload, app.WEBHOOK_PATH, app.WEBHOOK_TOKEN), None)
+        if response['statusCode'] != 202:
+            results[f"http_{response['statusCode']}"] += 1
+            continue
+        body = response['body']
+        if response.get('isBase64Encoded'):
+            body = base64.b64decode(body).decode()
+        results.update(json.loads(body)['events'])
+    return results
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("events", nargs="?",
+                        help="JSON Lines file of webhook payloads.")
+    parser.add_argument("--generate", type=int, default=0,
+                        help="Number of synthetic events (instead of a file).")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="Replay speed (1 = real time, 0 = as fast as possible).")
+    parser.add_argument("--flush-interval", type=float, default=60.0,
+                        help="Seconds of the stream between two scheduled flushes (0 for none).")
+    parser.add_argument("--debounce", type=float,
+                        help="Override EVENT_RENDER_DEBOUNCE (seconds).")
+    parser.add_argument("--create-table", action="store_true",
+                        help="Create SCAN_HISTORY_TABLE first.")
+    parser.add_argument("--seed-history", action="store_true",
+                        help="Start from zero counts for every project of the registry (otherwise "
+                             "the events of projects without a count ask for a full count from Flywheel).")
+    parser.add_argument("--no-flush", action="store_true",
+                        help="Don't force the render of the last events.")
+    args = parser.parse_args(argv)
+    if not args.events and not args.generate:
+        parser.error("give an events file or --generate")
+    if not os.getenv("SCAN_HISTORY_TABLE"):
+        parser.error("SCAN_HISTORY_TABLE is not set")
+    # The webhook rejects the requests without a token
+    os.environ.setdefault("WEBHOOK_TOKEN", "replay")
+
+    import app
+
+    if args.debounce is not None:
+        app.EVENT_RENDER_DEBOUNCE = args.debounce
+    if args.create_table:
+        app.create_scan_history_table()
+    if args.seed_history:
+        app.write_scan_history(
+            dict.fromkeys(app.label_index(), 0),
+            {'sites': dict.fromkeys(app.SITES_CITIES, 0)}
+        )
+    if args.generate:
+        events = generate_events(args.generate, sorted(app.label_index()))
+    else:
+        events = read_events(args.events)
+
+    app.start_stages()
+    results = replay(app, events, args.speed, args.flush_interval)
+    if not args.no_flush:
+        flush = app.lambda_handler({'action': 'flush_events', 'force': True}, None)
+        results[f"render_{flush['body']}"] += 1
+    print(json.dumps({'events': len(events), 'results': dict(results)}, indent=2))
+    project_counts, city_scans = app.read_latest_snapshot()
+    print(json.dumps(city_scans, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -1,14 +1,43 @@
+import argparse
+import asyncio
+import collections
+import csv
+import dataclasses
+import datetime
+import functools
+import gzip
+import hashlib
+import io
 import json
+import mimetypes
 import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import flywheel
 import pandas as pd
 import numpy as np
 import typing as t
+from html import escape
+
+if t.TYPE_CHECKING:
+    # Imported when the world data is read (see read_world_data): the map is
+    # built from the geometry artifact without it
+    import geopandas as gpd
 
-import geopandas as gpd
+import plotly
 import plotly.graph_objects as go
 import plotly.express as px
+import plotly.io as pio
 
+import boto3
+import google_auth_httplib2
+from boto3.s3.transfer import TransferConfig
+import httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
@@ -16,6 +45,11 @@ from googleapiclient.http import MediaFileUpload
 # import fsspec
 import requests
 
+try:
+    import brotli
+except ImportError:  # Optional: only needed for S3_COMPRESSION="br"
+    brotli = None
+
 ### Global variables: ###
 # Dictionary relating cities to the corresponding Flywheel project labels:
 SITES_CITIES = {
@@ -50,318 +84,2796 @@ DEVELOPMENT_CITIES = {
 }
 # This is either the URL or the path to the GeoJSON file with the world data source
 WORLD_DATA_SRC = "https://naciscdn.org/naturalearth/110m/cultural/ne_110m_admin_0_countries.zip"
+# Maximum number of concurrent requests to the Flywheel API (1 = sequential)
+FW_MAX_WORKERS = int(os.getenv("FW_MAX_WORKERS", "8"))
+# How to get the project stats from Flywheel: "bulk" lists all the projects once
+# (see build_project_sessions_index), "concurrent" runs one query per label.
+FW_FETCH_MODE = os.getenv("FW_FETCH_MODE", "bulk")
+# Number of projects per page when listing the projects in "bulk" mode
+FW_PAGE_SIZE = int(os.getenv("FW_PAGE_SIZE", "1000"))
+# Persistent cache of the project stats (see ProjectStatsCache). An empty path
+# disables the cache.
+STATS_CACHE_PATH = os.getenv(
+    "STATS_CACHE_PATH", os.path.join(tempfile.gettempdir(), "unity_project_stats.sqlite")
+)
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", str(24 * 60 * 60)))
+# Number of project ids per request when fetching the stats of changed projects
+STATS_FETCH_CHUNK = 50
+# Pipeline files: the CSV files with the sites, the artifact passed from the
+# "collect" stage to the "render" and "publish" stages, and the map
+SITES_CSV_PATH = "site_scans.csv"
+DEV_SITES_CSV_PATH = "developmentSites.csv"
+COLLECT_ARTIFACT_PATH = os.getenv("COLLECT_ARTIFACT_PATH", "site_counts.json")
+MAP_HTML_PATH = os.getenv("MAP_HTML_PATH", "unity_map.html")
+# Timeline mode (see timeline_stage): scans per site per month, and its
+# animated map
+TIMELINE_CSV_PATH = os.getenv("TIMELINE_CSV_PATH", "site_timeline.csv")
+TIMELINE_HTML_PATH = os.getenv("TIMELINE_HTML_PATH", "unity_timeline.html")
+# Offline gazetteer (see build_gazetteer), used to fill in the location of the
+# sites that are not in the CSV files yet. Shipped with the Lambda function.
+GAZETTEER_PATH = os.getenv(
+    "GAZETTEER_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "my-lambda-function", "gazetteer.csv")
+)
+# Columns of the gazetteer copied to the sites tables
+GAZETTEER_COLUMNS = [
+    'city_ascii', 'lat', 'lng', 'country', 'iso2', 'iso3', 'admin_name', 'capital',
+    'population', 'id'
+]
+# Google Drive uploads: credentials, destination folder of each file (by file
+# name) and maximum number of concurrent uploads
+GOOGLE_CREDENTIALS_PATH = os.getenv(
+    "GOOGLE_CREDENTIALS_PATH", "./utils/service-credentials-google.json"
+)
+DRIVE_FOLDERS = {
+    'site_scans.csv': '1WVRj-wu51QmkzeOYnWeLX0yi6qwEBbqa',
+    'unity_map.html': '1WTTQb7nKgOvnhLkt6EIQ6tlHEqf09luc',
+}
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", "4"))
+# Publishing backend of the CSV file and the map: "drive" or "s3"
+PUBLISH_BACKEND = os.getenv("PUBLISH_BACKEND", "drive")
+# S3 uploads: bucket, key prefix, endpoint (e.g. MinIO, empty for AWS), content
+# encoding ("br", "gzip" or "identity"), Cache-Control header and size above
+# which multipart uploads are used
+S3_BUCKET = os.getenv("BUCKET_NAME")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_COMPRESSION = os.getenv("S3_COMPRESSION", "gzip")
+S3_CACHE_CONTROL = os.getenv("S3_CACHE_CONTROL", "public, max-age=300")
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+# DynamoDB table with the history of the counts (see create_scan_history_table).
+# Empty to disable. DYNAMODB_ENDPOINT_URL can point to DynamoDB Local.
+SCAN_HISTORY_TABLE = os.getenv("SCAN_HISTORY_TABLE", "")
+DYNAMODB_ENDPOINT_URL = os.getenv("DYNAMODB_ENDPOINT_URL") or None
+# Map output optimization (see update_map_figure): simplification tolerance of the
+# country polygons (in degrees), number of decimals kept in the coordinates, and
+# size budget (in bytes) of the map HTML file
+MAP_OPTIMIZE = os.getenv("MAP_OPTIMIZE", "1") == "1"
+MAP_SIMPLIFY_TOLERANCE = float(os.getenv("MAP_SIMPLIFY_TOLERANCE", "0.05"))
+MAP_COORDINATE_PRECISION = int(os.getenv("MAP_COORDINATE_PRECISION", "3"))
+MAP_BYTE_BUDGET = int(os.getenv("MAP_BYTE_BUDGET", str(500 * 1024)))
+# Clustering of the site markers (see cluster_sites): from MAP_CLUSTER_MIN_SITES
+# sites, nearby sites are merged into one marker per grid cell. Each zoom tier is
+# (minimum projection scale, grid cell size in degrees), 0 meaning no clustering.
+MAP_CLUSTER_MIN_SITES = int(os.getenv("MAP_CLUSTER_MIN_SITES", "100"))
+MAP_CLUSTER_TIERS = [(1, 10.0), (3, 3.0), (9, 1.0), (27, 0.0)]
+# Cache of the base layer of the map (see load_base_figure): directory of the
+# Plotly figure JSON files (empty to disable), and version of their format (to
+# bump when build_countries_figure changes)
+MAP_BASE_CACHE_DIR = os.getenv("MAP_BASE_CACHE_DIR", tempfile.gettempdir())
+MAP_BASE_CACHE_VERSION = 1
+# Names of the map layers, by language (see build_map_figure). In the other
+# languages than English, the countries are labelled with their names (the
+# "name_<language>" columns of the world data) instead of their codes.
+MAP_LABELS = {
+    'en': {'sites': 'Data-contributing sites', 'development': 'Development sites', 'countries': 'Number of scans'},
+    'fr': {'sites': 'Sites contributeurs', 'development': 'Sites de développement', 'countries': 'Nombre de scans'},
+    'es': {'sites': 'Sitios que aportan datos', 'development': 'Sitios de desarrollo', 'countries': 'Número de escaneos'},
+    'pt': {'sites': 'Locais que contribuem com dados', 'development': 'Locais de desenvolvimento', 'countries': 'Número de exames'},
+}
+# Map variants (see render_map_variants): output directory and number of
+# worker processes (0 = one per CPU)
+MAP_VARIANTS_DIR = os.getenv("MAP_VARIANTS_DIR", "map_variants")
+MAP_VARIANT_WORKERS = int(os.getenv("MAP_VARIANT_WORKERS", "0"))
+# Static SVG version of the map (see render_map_svg), rendered with the HTML map.
+# Empty to disable.
+MAP_SVG_PATH = os.getenv("MAP_SVG_PATH", "map.svg")
+MAP_SVG_WIDTH = int(os.getenv("MAP_SVG_WIDTH", "1000"))
+# Fingerprint of the inputs of the last successful run (see compute_fingerprint)
+FINGERPRINT_PATH = os.getenv("FINGERPRINT_PATH", "pipeline_fingerprint.json")
+# Local cache of the world data downloaded from WORLD_DATA_SRC, and how long (in
+# seconds) a cached copy is used before revalidating it with the server
+WORLD_DATA_CACHE_DIR = os.getenv("WORLD_DATA_CACHE_DIR", tempfile.gettempdir())
+WORLD_DATA_MAX_AGE = float(os.getenv("WORLD_DATA_MAX_AGE", str(7 * 24 * 60 * 60)))
+# Copy of the world data shipped with the repo, used when it can't be downloaded
+BUNDLED_WORLD_DATA = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "ne_110m_admin_0_countries.zip"
+)
+# Compact geometry of the countries (see build_geometry_artifact), shipped with
+# the Lambda function: the HTML map is built from it without geopandas
+GEOMETRY_ARTIFACT_PATH = os.getenv(
+    "GEOMETRY_ARTIFACT_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "my-lambda-function", "countries.geojson")
+)
+# Columns of the world data kept in the geometry artifact (the labels of the map)
+GEOMETRY_ARTIFACT_COLUMNS = ['name', 'iso_a3'] + [f"name_{language}" for language in MAP_LABELS]
+
+
+class ProjectStatsCache:
+    """Persistent (SQLite) cache of the Flywheel project stats.
+
+    Each entry is keyed by project label and stores the project id, its
+    `modified` timestamp and its number of sessions. Entries older than `ttl`
+    seconds are ignored (and evicted with `evict_expired`). When the project id
+    and `modified` timestamp are known (e.g. from a listing without stats), an
+    entry only counts as a hit if they match, so changed projects are fetched
+    again. The `hits` and `misses` counters tell how effective the cache is.
+    """
+
+    def __init__(self, path: str = STATS_CACHE_PATH, ttl: float = STATS_CACHE_TTL):
+        """Open (or create) the cache.
+
+        Args:
+            path (str): The path to the SQLite file.
+            ttl (float): The time-to-live of the entries, in seconds.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS project_stats ("
+                "label TEXT PRIMARY KEY, project_id TEXT, modified TEXT, "
+                "sessions INTEGER, cached_at REAL)"
+            )
+
+    def get(
+        self,
+        label: str,
+        project_id: t.Optional[str] = None,
+        modified: t.Optional[str] = None
+    ) -> t.Optional[int]:
+        """Get the cached number of sessions of a project.
+
+        Args:
+            label (str): The project label.
+            project_id (t.Optional[str]): The current project id, if known.
+            modified (t.Optional[str]): The current `modified` timestamp of the
+                project, if known.
+
+        Returns:
+            t.Optional[int]: The number of sessions, or None if the entry is
+                missing, expired or out of date.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT project_id, modified, sessions, cached_at "
+                "FROM project_stats WHERE label = ?",
+                (label,)
+            ).fetchone()
+            if (
+                row is None
+                or time.time() - row[3] > self.ttl
+                or (project_id is not None and row[0] != project_id)
+                or (modified is not None and row[1] != modified)
+            ):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[2]
+
+    def set(self, label: str, project_id: str, modified: str, sessions: int) -> None:
+        """Store the number of sessions of a project.
+
+        Args:
+            label (str): The project label.
+            project_id (str): The project id.
+            modified (str): The `modified` timestamp of the project.
+            sessions (int): The number of sessions.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO project_stats VALUES (?, ?, ?, ?, ?)",
+                (label, project_id, modified, sessions, time.time())
+            )
+
+    def evict_expired(self) -> int:
+        """Remove the entries older than the TTL.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "DELETE FROM project_stats WHERE cached_at < ?",
+                (time.time() - self.ttl,)
+            ).rowcount
+
+    def close(self) -> None:
+        """Close the connection to the SQLite file."""
+        self._conn.close()
+
+
+def find_project(fw_client: flywheel.Client, project_label: str):
+    """Find a Flywheel project (with its stats) by label.
+
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+        project_label (str): The project label.
+
+    Returns:
+        The Flywheel project.
+    """
+    return fw_client.projects.find_one(
+        f'label={project_label}', exhaustive=True
+    )
+
+
+def get_project_sessions(fw_client: flywheel.Client, project_label: str) -> int:
+    """Get the number of sessions in a Flywheel project.
+
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+        project_label (str): The project label.
+
+    Returns:
+        int: The number of sessions.
+    """
+    return find_project(fw_client, project_label)['stats']['number_of']['sessions']
+
+
+def fetch_projects_sessions(
+    fw_client: flywheel.Client,
+    project_labels: t.Iterable[str],
+    max_workers: int = FW_MAX_WORKERS,
+    cache: t.Optional[ProjectStatsCache] = None
+) -> t.Tuple[t.Dict[str, int], t.Dict[str, Exception]]:
+    """Get the number of sessions for a list of projects concurrently.
+
+    The requests are sent through a pool of at most `max_workers` threads, so
+    the total time is roughly that of the slowest request. Duplicated labels
+    are only fetched once, and the results are collected in the order of
+    `project_labels`, regardless of the order in which the requests finish.
+
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+        project_labels (t.Iterable[str]): The project labels.
+        max_workers (int): The maximum number of concurrent requests.
+        cache (t.Optional[ProjectStatsCache]): If given, the fetched stats
+            are stored in it, for `build_project_sessions_index`. Its entries
+            are not used here: without the `modified` timestamp of the project
+            (which only comes with its query, stats included), an out of date
+            entry can't be told apart.
+
+    Returns:
+        t.Tuple[t.Dict[str, int], t.Dict[str, Exception]]: The number of
+            sessions per project label, and the error raised for each project
+            label that could not be retrieved.
+    """
+    labels = list(dict.fromkeys(project_labels))
+    counts, errors = {}, {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(labels)))) as executor:
+        futures = {
+            label: executor.submit(find_project, fw_client, label)
+            for label in labels
+        }
+        for label in labels:
+            try:
+                project = futures[label].result()
+                counts[label] = project['stats']['number_of']['sessions']
+                if cache is not None:
+                    cache.set(label, project['_id'], str(project['modified']), counts[label])
+                print(label, ': ', counts[label])
+            except Exception as e:
+                errors[label] = e
+                print(label, ': Something went wrong', e)
+
+    return counts, errors
+
+
+def build_project_sessions_index(
+    fw_client: flywheel.Client,
+    project_labels: t.Iterable[str],
+    page_size: int = FW_PAGE_SIZE,
+    cache: t.Optional[ProjectStatsCache] = None
+) -> t.Tuple[t.Dict[str, int], t.Dict[str, Exception]]:
+    """Get the number of sessions for a list of projects with a bulk listing.
+
+    Instead of one query per label, all the accessible projects are listed (with
+    their stats) in pages of `page_size`, and only the requested labels are kept
+    in an in-memory label -> number of sessions index. The number of API calls
+    depends on the number of projects in the Flywheel instance, not on the
+    number of labels requested.
+
+    With a `cache`, the listing is done without stats, and only the projects
+    whose id or `modified` timestamp don't match the cache are then fetched
+    with their stats.
+
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+        project_labels (t.Iterable[str]): The project labels.
+        page_size (int): The number of projects per page.
+        cache (t.Optional[ProjectStatsCache]): The project stats cache.
+
+    Returns:
+        t.Tuple[t.Dict[str, int], t.Dict[str, Exception]]: The number of
+            sessions per project label, and the error for each project label
+            that could not be resolved (not found, or found more than once),
+            in the same format as `fetch_projects_sessions`.
+    """
+    labels = list(dict.fromkeys(project_labels))
+    wanted = set(labels)
+    matches = {}
+
+    after_id = None
+    while True:
+        page_kwargs = {'after_id': after_id} if after_id else {}
+        page = fw_client.get_all_projects(
+            exhaustive=True, stats=cache is None, limit=page_size, **page_kwargs
+        )
+        for project in page:
+            if project['label'] in wanted:
+                matches.setdefault(project['label'], []).append(project)
+        if len(page) < page_size:
+            break
+        after_id = page[-1]['_id']
+
+    counts, errors = {}, {}
+    stale = {}
+    for label in labels:
+        projects = matches.get(label, [])
+        if len(projects) != 1:
+            errors[label] = ValueError(
+                f"Found {len(projects)} projects with label '{label}'"
+            )
+            continue
+        project = projects[0]
+        if cache is None:
+            counts[label] = project['stats']['number_of']['sessions']
+            continue
+        sessions = cache.get(label, project['_id'], str(project['modified']))
+        if sessions is None:
+            stale[project['_id']] = label
+        else:
+            counts[label] = sessions
+
+    # Fetch the stats of the changed projects only, a chunk of ids at a time:
+    stale_ids = list(stale)
+    for i in range(0, len(stale_ids), STATS_FETCH_CHUNK):
+        ids = stale_ids[i:i + STATS_FETCH_CHUNK]
+        for project in fw_client.get_all_projects(
+            exhaustive=True, stats=True, filter=f"_id=|[{','.join(ids)}]"
+        ):
+            label = stale.get(project['_id'])
+            if label is None:
+                continue
+            counts[label] = project['stats']['number_of']['sessions']
+            cache.set(label, project['_id'], str(project['modified']), counts[label])
+    for label in stale.values():
+        if label not in counts:
+            errors[label] = ValueError(f"Could not get the stats of project '{label}'")
+
+    for label in labels:
+        if label in counts:
+            print(label, ': ', counts[label])
+        else:
+            print(label, ': Something went wrong', errors[label])
+
+    return counts, errors
 
 
-def search_file(service, file_name, folder_id):
-    # Search for files by name in a specific folder
-    query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-    results = service.files().list(q=query, fields="files(id, name)").execute()
-    files = results.get('files', [])
-    return files
+def get_projects_sessions(
+    fw_client: flywheel.Client,
+    project_labels: t.Iterable[str],
+    mode: str = FW_FETCH_MODE,
+    cache: t.Optional[ProjectStatsCache] = None
+) -> t.Tuple[t.Dict[str, int], t.Dict[str, Exception]]:
+    """Get the number of sessions for a list of projects.
 
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+        project_labels (t.Iterable[str]): The project labels.
+        mode (str): "bulk" to list all the projects once, or "concurrent" to
+            query each project label separately.
+        cache (t.Optional[ProjectStatsCache]): The project stats cache.
 
-def delete_file(service, file_id):
-    # Delete file by file ID
-    service.files().delete(fileId=file_id).execute()
+    Returns:
+        t.Tuple[t.Dict[str, int], t.Dict[str, Exception]]: The number of
+            sessions per project label, and the errors per project label.
+    """
+    if mode == "bulk":
+        return build_project_sessions_index(fw_client, project_labels, cache=cache)
+    if mode == "concurrent":
+        return fetch_projects_sessions(fw_client, project_labels, cache=cache)
+    raise ValueError(f"Unknown Flywheel fetch mode: {mode}")
 
 
-def get_site_scans(fw_client: flywheel.Client, projects: t.List[str]) -> int:
+def get_site_scans(
+    fw_client: flywheel.Client,
+    projects: t.List[str],
+    max_workers: int = FW_MAX_WORKERS,
+    cache: t.Optional[ProjectStatsCache] = None
+) -> int:
     """Get the number of scans accross a list of projects.
 
     Args:
         fw_client (flywheel.Client): The Flywheel SDK client.
         projects (t.List[str]): The list of project labels.
+        max_workers (int): The maximum number of concurrent requests.
+        cache (t.Optional[ProjectStatsCache]): The project stats cache.
 
     Returns:
         int: The number of scans.
     """
-    site_scans = 0
-    for project_label in projects:
-        try:
-            project = fw_client.projects.find_one(
-                f'label={project_label}', exhaustive=True
-            )
-            site_scans += project['stats']['number_of']['sessions']
-            print(project_label,': ' , project['stats']['number_of']['sessions'])
-        
-        except Exception as e: 
-            print(project_label,': Something went wrong', e)
+    counts, _ = fetch_projects_sessions(fw_client, projects, max_workers, cache)
+    return sum(counts.values())
 
-    return site_scans
 
+def build_sessions_view(fw_client: flywheel.Client):
+    """Data view with one row per session and only its timestamps.
 
-def update_number_of_scans_in_csv(
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+
+    Returns:
+        flywheel.DataView: The data view.
+    """
+    return fw_client.View(
+        columns=[('session.timestamp', 'timestamp'), ('session.created', 'created')],
+        include_ids=False,
+        include_labels=False,
+        sort=False,
+    )
+
+
+def count_sessions_by_month(
     fw_client: flywheel.Client,
-    cities_dict: t.Dict[str, t.List[str]],
-    csv_path: str
-) -> None:
-    """Update the number of scans in the CSV file with the data in Flywheel
-    
-    It retrieves the number of scans for each site (city) in the cities_dict and
-    updates the CSV file.
+    project_id: str,
+    view=None
+) -> t.Counter[str]:
+    """Count the sessions of a project per month, streaming a data view.
+
+    The data view is read as CSV one row at a time, so only the counts (one
+    per month) are kept in memory, whatever the number of sessions.
 
     Args:
         fw_client (flywheel.Client): The Flywheel SDK client.
-        cities_dict (t.Dict[str, t.List[str]]): The dictionary with the cities and
-            the corresponding Flywheel project labels.
-        csv_path (str): The path to the CSV file.
+        project_id (str): The id of the project.
+        view (flywheel.DataView): The data view (see `build_sessions_view`).
+
+    Returns:
+        t.Counter[str]: The number of sessions per month ("YYYY-MM"), by session
+            timestamp (or creation date, for the sessions without timestamp).
     """
-    if not os.path.exists(csv_path):
-        raise FileNotFoundError(f"File not found: {csv_path}")
+    months = collections.Counter()
+    stream = fw_client.read_view_data(view or build_sessions_view(fw_client), project_id, format='csv')
+    try:
+        for row in csv.DictReader(stream):
+            date = row.get('timestamp') or row.get('created')
+            if date:
+                months[date[:7]] += 1
+    finally:
+        stream.close()
+    return months
 
-    df = pd.read_csv(csv_path)
 
-    try:
-        rows=[]
-        for city, projects_list in cities_dict.items():
-            site_scans = get_site_scans(fw, projects_list)
-    
-            # Check if the value exists in the cities column
-            if city in df['city'].values:
-                # Update the cell in scans column
-                df.loc[df['city'] == city, 'scans'] = site_scans
-            else:
-                # Create new DataFrame for the new row, with NaN for all other columns
-                new_row = pd.DataFrame([{
-                    'city': city,
-                    'scans': site_scans,
-                    **{col: np.nan for col in df.columns if col not in ["city", "scans"]}
-                }])
-    
-                # Append the new row to the DataFrame
-                df = pd.concat([df, new_row], ignore_index=True)    
+def fetch_monthly_sessions(
+    fw_client: flywheel.Client,
+    project_labels: t.List[str],
+    max_workers: int = FW_MAX_WORKERS
+) -> t.Tuple[t.Dict[str, t.Counter[str]], t.Dict[str, Exception]]:
+    """Count the sessions of each project per month.
 
-    except Exception as e: 
-        print('Something went wrong', e)
-    
-    df["scans"] = df["scans"].apply(np.int64)
+    The projects are streamed concurrently (see `count_sessions_by_month`), with
+    at most `max_workers` data views running at a time.
 
-    # Save the updated DataFrame to the CSV file:
-    df.to_csv(csv_path, index=False)
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+        project_labels (t.List[str]): The project labels (duplicates are fetched once).
+        max_workers (int): The maximum number of concurrent requests.
 
+    Returns:
+        t.Tuple[t.Dict[str, t.Counter[str]], t.Dict[str, Exception]]: The number
+            of sessions per month of each project, and the exception raised for
+            each project that failed.
+    """
+    labels = list(dict.fromkeys(project_labels))
+    view = build_sessions_view(fw_client)
 
-def main(fw):
-    # Check URL:
-    print(f"Site URL: {fw.get_config().site.api_url.removesuffix("/api")}")
+    def count(label):
+        return count_sessions_by_month(fw_client, find_project(fw_client, label)['_id'], view)
 
-    # Check user Info
-    user_info = fw.get_current_user()
-    
-    print(f"Firstname: {user_info.firstname} \n"
-        f"Lastname: {user_info.lastname} \n"
-        f"Email: {user_info.email} \n"
-    )
+    months, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(labels)))) as executor:
+        futures = {label: executor.submit(count, label) for label in labels}
+        for label, future in futures.items():
+            try:
+                months[label] = future.result()
+                print(label, ': ', sum(months[label].values()), 'sessions in', len(months[label]), 'months')
+            except Exception as e:
+                errors[label] = e
+                print(label, ': Something went wrong', e)
+    return months, errors
 
-    # Get data from Flywheel
-    # A) For the SITE_CITIES (data-contributing sites):
-    # print(SITES_CITIES)
-    sites_csv_path = "site_scans.csv"    
-    update_number_of_scans_in_csv(fw, SITES_CITIES, sites_csv_path)
-    # write_csv_to_bucket(sites_csv_path)
 
-    # B) For the DEVELOPMENT_CITIES:
-    # print(DEVELOPMENT_CITIES)
-    dev_sites_csv_path = "developmentSites.csv"
-    update_number_of_scans_in_csv(fw, DEVELOPMENT_CITIES, dev_sites_csv_path)
+def city_monthly_scans(
+    cities_dict: t.Dict[str, t.List[str]],
+    project_months: t.Dict[str, t.Counter[str]]
+) -> pd.DataFrame:
+    """Sum the monthly counts of the projects of each city.
 
-    # Generate the map figure
-    update_map_figure(WORLD_DATA_SRC, sites_csv_path, dev_sites_csv_path)
+    Args:
+        cities_dict (t.Dict[str, t.List[str]]): The project labels of each city.
+        project_months (t.Dict[str, t.Counter[str]]): The number of sessions per
+            month of each project (see `fetch_monthly_sessions`).
 
-    return {
-        'statusCode': 200,
-        'body': "Success"
-    }
+    Returns:
+        pd.DataFrame: One row per city and month with sessions, with the columns
+            "city", "month" ("YYYY-MM") and "scans".
+    """
+    rows = []
+    for city, labels in cities_dict.items():
+        months = collections.Counter()
+        for label in labels:
+            months.update(project_months.get(label, {}))
+        rows.extend((city, month, n) for month, n in sorted(months.items()))
+    return pd.DataFrame(rows, columns=['city', 'month', 'scans'])
 
 
-def update_map_figure(map_file: str, sites_csv_path: str, dev_sites_csv_path: str) -> None:
-    """Update the map figure with the data from the CSV files.
+def merge_city_scans(df: pd.DataFrame, city_scans: pd.Series) -> pd.DataFrame:
+    """Merge the number of scans per city into the sites table.
+
+    The cities already in the table get their "scans" updated, and the new
+    cities are appended (with NaN in the other columns), all in one pass
+    instead of one lookup and one concatenation per city.
 
     Args:
-        map_file (str): The path to the map file.
-        sites_csv_path (str): The path to the CSV file with the data-contributing sites.
-        dev_sites_csv_path (str): The path to the CSV file with the development sites.
+        df (pd.DataFrame): The sites table (with "city" and "scans" columns).
+        city_scans (pd.Series): The number of scans, indexed by city.
+
+    Returns:
+        pd.DataFrame: The updated sites table.
     """
-    
-    # Load country data
-    world_data = gpd.read_file(map_file)
-    world_data.columns = map(str.lower, world_data.columns)
+    known = df['city'].isin(city_scans.index)
+    df.loc[known, 'scans'] = df.loc[known, 'city'].map(city_scans)
 
-    # Load the CSV files:
-    city_data = pd.read_csv(sites_csv_path)
-    DS_data = pd.read_csv(dev_sites_csv_path)
+    new_cities = city_scans.index[~city_scans.index.isin(df['city'])]
+    if len(new_cities):
+        new_rows = pd.DataFrame(
+            {'city': new_cities, 'scans': city_scans[new_cities].to_numpy()}
+        ).reindex(columns=df.columns)
+        df = pd.concat([df, new_rows], ignore_index=True)
+    return df
 
-    ### Base layer: ###
-    # World map with UNITY countries highlighted in colors
 
-    # Parse UNITY countries (grab countries present in either city_data or DS_data)
-    unity = world_data.loc[
-        world_data["name"].isin(city_data["country"])
-        | world_data["name"].isin(DS_data["country"])
-    ]
-    unity_json = json.loads(unity.to_json())
+def normalize_place_name(name: str) -> str:
+    """Normalize a place name for the gazetteer lookups.
 
-    # Setup country map
-    fig = px.choropleth(
-        unity,
-        geojson=unity_json,
-        featureidkey='properties.name',
-        locations='name',
-        color='name'
-    )
+    Accents, case, punctuation and extra spaces are ignored, e.g. "Lomé",
+    "LOME" and "lome." give the same key.
 
-    ## Add labels on countries
-    fig.add_scattergeo(
-        name='Number of scans',
-        geojson=unity_json,
-        locations=unity['name'],
-        featureidkey='properties.name',
-        text=unity['iso_a3'],
-        mode='text',
-    )
+    Args:
+        name (str): The place name.
 
-    ### Layer 1: data-contributing sites ###
-    # city_lst = ['Karachi', 'Lucknow', 'Lusaka','Zomba', 'Blantyre', 'Kampala', 'Nairobi', 'Kisumu', 'Gaborone', 'Harare', 'Accra', 'Kintampo', 'Addis Ababa', 'Cape Town', 'Pretoria', 'London', 'Dhaka', 'Vellore', 'Bonn']
-    # city_data = city_data[city_data['city'].isin(city_lst)]
-    # city_data['text'] = df['city'] + ' Hyperfine scans: ' + city_data['scans'].astype(str)
+    Returns:
+        str: The lookup key.
+    """
+    name = unicodedata.normalize('NFKD', str(name))
+    name = "".join(c if c.isalnum() else " " for c in name if not unicodedata.combining(c))
+    return " ".join(name.casefold().split())
 
-    data_contributing_sites_scatter = go.Scattergeo(
-        name='Data-contributing sites',
-        lat=city_data['lat'],
-        lon=city_data['lng'],
-        text=city_data['scans'],
-        mode='markers+text',
-        marker = dict(
-            # Adjust size by the square root of "scans", so that the marker area is
-            # proportional to the number of scans
-            size= city_data['scans'] ** 0.5 * 2,
-            symbol = 'square',
-            opacity=0.8,
-            color='rgb(60, 211, 113)',
-            line = dict(
-                width=1,
-                color='rgba(102, 102, 102)'
-            ),
-        ),
-        textposition="middle center",
-        hoverinfo="location",
-    )
 
-    # Development sites
-    # DS_lst = ['Leiden', 'Lund', 'Vancouver','London', 'Los Angelas', 'Melbourne', 'Wisconsin']
-    # DS_data['text'] = DS_df['city'] + ' Research focus: ' + DS_data['scans'].astype(str)
+def build_gazetteer(
+    source_csv_path: str,
+    output_path: str = GAZETTEER_PATH,
+    world_data_path: str = BUNDLED_WORLD_DATA
+) -> int:
+    """Build the gazetteer from a table of cities.
 
-    development_sites_scatter = go.Scattergeo(
-        name='Development sites',
-        lat=DS_data['lat'],
-        lon=DS_data['lng'],
-        text=DS_data['scans'],
-        mode='markers+text',
-        marker = dict(
-            # Adjust size by the square root of "scans", so that the marker area is
-            # proportional to the number of scans
-            size= DS_data['scans'] ** 0.5 * 2,
-            symbol = 'circle',
-            opacity=0.8,
-            color='rgb(255, 99, 71)',
-            line = dict(
-                width=1,
-                color='rgba(102, 102, 102)'
-            ),
-        ),
-        textposition="middle center",
-        hoverinfo="text",
+    The source has the columns of the sites CSV files (as in the SimpleMaps
+    world cities database: "city", "city_ascii", "lat", "lng", "country",
+    "iso2", "iso3", ...) and optionally "aliases" (other names, separated by
+    "|"). The gazetteer has one row per name or alias, with its normalized
+    "key" (see `normalize_place_name`), sorted by key and then by decreasing
+    population, so the lookups only have to take the first matching row. The
+    countries are renamed as in the world data (by ISO 3 code), so the new
+    sites match the country names of the map.
+
+    Args:
+        source_csv_path (str): The path to the table of cities.
+        output_path (str): The path to the output gazetteer CSV file.
+        world_data_path (str): The path to the world data.
+
+    Returns:
+        int: The number of rows (names) of the gazetteer.
+    """
+    source = pd.read_csv(source_csv_path, keep_default_na=False, na_values=[''])
+    world_data = read_world_data(world_data_path)
+    country_names = dict(zip(world_data['adm0_a3'], world_data['name']))
+    source['country'] = source['iso3'].map(country_names).fillna(source['country'])
+
+    names = source['city'].astype(str).str.cat(
+        source.get('aliases', pd.Series('', index=source.index)).fillna(''), sep='|'
     )
-    
-    fig.add_traces([data_contributing_sites_scatter, development_sites_scatter])
-    # with open('unity_map.html', 'w') as f:
-    #     f.write(fig.to_html(include_plotlyjs='cdn'))
-        
-    fig.show()
-    
+    source['key'] = names.map(
+        lambda names: sorted({normalize_place_name(name) for name in names.split('|') if name.strip()})
+    )
+    gazetteer = source.explode('key').dropna(subset=['key'])
+    gazetteer = gazetteer.sort_values(['key', 'population'], ascending=[True, False])
+    gazetteer = gazetteer.reindex(columns=['key', 'city', *GAZETTEER_COLUMNS])
+    write_csv_atomic(gazetteer, output_path)
+    return len(gazetteer)
 
 
-def write_csv_to_bucket(csv_path: str) -> None:
-    
-    BUCKET_NAME = os.getenv("BUCKET_NAME")
-    # TO-DO: call a different method to upload the file depending on the bucket type
-    # For now, we are just calling the Google Drive method:
-    file_id = update_google_drive(csv_path)
-    print(file_id)
+@functools.lru_cache(maxsize=2)
+def _load_gazetteer(path: str, mtime: float) -> t.Dict[str, t.List[t.Dict[str, t.Any]]]:
+    index = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            place = {column: row.get(column) or None for column in ['city', *GAZETTEER_COLUMNS]}
+            for column in ('lat', 'lng', 'population', 'id'):
+                if place[column] is not None:
+                    place[column] = float(place[column])
+            index.setdefault(row['key'], []).append(place)
+    return index
 
 
-def update_s3_bucket(file_path: str) -> str:
-    """Upload the file to an S3 bucket.
-    
-    Arguments:
-        file_path {str} -- The path to the file to upload.
+def load_gazetteer(path: str = GAZETTEER_PATH) -> t.Dict[str, t.List[t.Dict[str, t.Any]]]:
+    """Load the gazetteer index (see `build_gazetteer`).
+
+    It is kept in memory until the file changes.
+
+    Args:
+        path (str): The path to the gazetteer CSV file.
+
+    Returns:
+        t.Dict[str, t.List[t.Dict[str, t.Any]]]: The places of each normalized
+            name, the most populated first.
     """
+    return _load_gazetteer(path, os.path.getmtime(path))
+
+
+def lookup_place(
+    gazetteer: t.Dict[str, t.List[t.Dict[str, t.Any]]],
+    city: str,
+    country: t.Optional[str] = None
+) -> t.Optional[t.Dict[str, t.Any]]:
+    """Find a city in the gazetteer.
+
+    Args:
+        gazetteer (t.Dict[str, t.List[t.Dict[str, t.Any]]]): The gazetteer index
+            (see `load_gazetteer`).
+        city (str): The name (or alias) of the city.
+        country (t.Optional[str]): The country (name, ISO 2 or ISO 3 code), to
+            choose between cities with the same name. If None, the most
+            populated one is returned.
 
-    #s3 = boto3.client('s3')
+    Returns:
+        t.Optional[t.Dict[str, t.Any]]: The place (with the columns of
+            GAZETTEER_COLUMNS), or None if not found.
+    """
+    places = gazetteer.get(normalize_place_name(city), [])
+    if country is not None:
+        key = normalize_place_name(country)
+        places = [
+            place for place in places
+            if key in {normalize_place_name(place[column] or '') for column in ('country', 'iso2', 'iso3')}
+        ]
+    return places[0] if places else None
 
-    #s3.upload_file('./tmp/site_scans.csv', BUCKET_NAME, 'site_scans.csv')
 
-    # Not implemented yet
-    pass
+def fill_site_locations(df: pd.DataFrame, gazetteer_path: str = GAZETTEER_PATH) -> pd.DataFrame:
+    """Fill in the location of the sites without coordinates from the gazetteer.
 
+    The missing values of GAZETTEER_COLUMNS (coordinates, country, codes, ...)
+    of the sites without "lat" or "lng" are taken from the gazetteer, looking
+    the city up in the site's country if it is known.
 
-def update_google_drive(file_path: str) -> str|Exception:
-    """Upload the file to Google Drive.
-    
-    Arguments:
-        file_path {str} -- The path to the file to upload.
+    Args:
+        df (pd.DataFrame): The sites table.
+        gazetteer_path (str): The path to the gazetteer CSV file.
 
     Returns:
-        str|Exception -- The file ID if the upload was successful, otherwise an
-            Exception.
+        pd.DataFrame: The sites table.
+    """
+    missing = df.index[df['lat'].isna() | df['lng'].isna()]
+    if not len(missing):
+        return df
+    if not os.path.exists(gazetteer_path):
+        print(f"WARNING: gazetteer not found ({gazetteer_path}), {len(missing)} sites without location")
+        return df
+
+    gazetteer = load_gazetteer(gazetteer_path)
+    for i in missing:
+        city = df.at[i, 'city']
+        country = df.at[i, 'country'] if 'country' in df.columns else None
+        place = lookup_place(gazetteer, city, country if pd.notna(country) else None)
+        if place is None:
+            print(f"WARNING: {city} not found in the gazetteer, it won't be on the map")
+            continue
+        for column in GAZETTEER_COLUMNS:
+            value = place[column]
+            if column not in df.columns or value is None or pd.notna(df.at[i, column]):
+                continue
+            if isinstance(value, str) and df[column].dtype != object:
+                df[column] = df[column].astype(object)
+            df.at[i, column] = value
+        print(f"{city}: location from the gazetteer ({place['lat']}, {place['lng']}, {place['country']})")
+    return df
+
+
+def write_csv_atomic(df: pd.DataFrame, csv_path: str) -> None:
+    """Write a DataFrame to a CSV file atomically.
+
+    Args:
+        df (pd.DataFrame): The DataFrame.
+        csv_path (str): The path to the CSV file.
     """
+    tmp_path = csv_path + ".tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, csv_path)
+
+
+def update_number_of_scans_in_csv(
+    fw_client: flywheel.Client,
+    cities_dict: t.Dict[str, t.List[str]],
+    csv_path: str,
+    project_counts: t.Optional[t.Dict[str, int]] = None
+) -> None:
+    """Update the number of scans in the CSV file with the data in Flywheel
     
+    It retrieves the number of scans for each site (city) in the cities_dict and
+    updates the CSV file. The projects of all the cities are fetched at once.
+
+    Args:
+        fw_client (flywheel.Client): The Flywheel SDK client.
+        cities_dict (t.Dict[str, t.List[str]]): The dictionary with the cities and
+            the corresponding Flywheel project labels.
+        csv_path (str): The path to the CSV file.
+        project_counts (t.Optional[t.Dict[str, int]]): The number of sessions per
+            project label, if already retrieved (e.g. shared between several
+            CSV files). If None, they are retrieved from Flywheel.
+    """
+    if not os.path.exists(csv_path):
+        raise FileNotFoundError(f"File not found: {csv_path}")
+
+    df = pd.read_csv(csv_path)
+
     try:
-        # Load service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            './utils/service-credentials-google.json'
+        if project_counts is None:
+            project_counts, _ = get_projects_sessions(
+                fw_client,
+                [label for projects_list in cities_dict.values() for label in projects_list]
+            )
+        city_scans = pd.Series(
+            city_scans_from_counts(cities_dict, project_counts), dtype=np.int64
         )
-        
-        # Build the Google Drive service
-        service = build('drive', 'v3', credentials=credentials)
+        df = merge_city_scans(df, city_scans)
 
-        ### UPLOAD FILES TO GDRIVE ###
+    except Exception as e: 
+        print('Something went wrong', e)
 
-        file_folder_dict={'site_scans.csv':'1WVRj-wu51QmkzeOYnWeLX0yi6qwEBbqa', 'unity_map.html':'1WTTQb7nKgOvnhLkt6EIQ6tlHEqf09luc'}
+    # Locate the new sites (and the ones without coordinates) offline
+    df = fill_site_locations(df)
+    
+    df["scans"] = df["scans"].astype(np.int64)
 
-        for filename,folder_id in file_folder_dict.items():
-            # File details
-            file_metadata = {
-                'name': filename,  # Name of the file to upload
-                'parents': [folder_id]   # ID of the folder to upload to
-            }
-            media = MediaFileUpload(file_path)
-
-            # Search for the file
-            existing_files = search_file(service, filename, folder_id)
-            if existing_files:
-                # If the file exists, delete it
-                for file in existing_files:
-                    print(f"DELETING existing file: {file['name']} (ID: {file['id']})")
-                    delete_file(service, file['id'])
-            
-            # Upload the file
-            file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-            print(f"New file uploaded id {file.get('id')}")
-
-        # ### UPLOAD MAP ####
-        # filename = 'unity_map.html',  # Name of the file to upload
-        # folder_id = '1WTTQb7nKgOvnhLkt6EIQ6tlHEqf09luc'
-
-        #  # File details
-        # file_metadata = {
-        #     'name': filename,  # Name of the file to upload
-        #     'parents': [folder_id]   # ID of the folder to upload to
-        # }
-        # media = MediaFileUpload(filename)
-        # # Upload the file
-        # file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-
-        return {'successfully uploaded to drive'}
+    # Save the updated DataFrame to the CSV file:
+    write_csv_atomic(df, csv_path)
+
+
+def get_world_data_version(world_data_src: str) -> str:
+    """Get a version identifier of the world data source.
+
+    Args:
+        world_data_src (str): The URL or path to the world data file.
+
+    Returns:
+        str: The SHA-256 of the file if it is a local file, otherwise the URL.
+    """
+    if not os.path.isfile(world_data_src):
+        return world_data_src
+
+    sha = hashlib.sha256()
+    with open(world_data_src, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def compute_fingerprint(
+    project_counts: t.Dict[str, int],
+    csv_paths: t.List[str],
+    world_data_version: str
+) -> str:
+    """Compute a fingerprint of the inputs of the map and the uploads.
+
+    Args:
+        project_counts (t.Dict[str, int]): The number of sessions per project label.
+        csv_paths (t.List[str]): The paths to the CSV files.
+        world_data_version (str): The version of the world data (see
+            `get_world_data_version`).
+
+    Returns:
+        str: The SHA-256 hex digest of the inputs.
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps(project_counts, sort_keys=True).encode())
+    for csv_path in csv_paths:
+        sha.update(csv_path.encode())
+        with open(csv_path, 'rb') as f:
+            sha.update(hashlib.sha256(f.read()).digest())
+    sha.update(world_data_version.encode())
+    return sha.hexdigest()
+
+
+def read_fingerprint(fingerprint_path: str) -> t.Optional[str]:
+    """Read the fingerprint of the last successful run.
+
+    Args:
+        fingerprint_path (str): The path to the fingerprint file.
+
+    Returns:
+        t.Optional[str]: The fingerprint, or None if there is none.
+    """
+    try:
+        with open(fingerprint_path) as f:
+            return json.load(f).get('fingerprint')
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_fingerprint(fingerprint_path: str, fingerprint: str) -> None:
+    """Save the fingerprint of a successful run.
+
+    Args:
+        fingerprint_path (str): The path to the fingerprint file.
+        fingerprint (str): The fingerprint.
+    """
+    with open(fingerprint_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'created': time.time()}, f)
+
+
+def fetch_world_data(
+    world_data_src: str = WORLD_DATA_SRC,
+    cache_dir: str = WORLD_DATA_CACHE_DIR,
+    max_age: float = WORLD_DATA_MAX_AGE,
+    fallback_path: str = BUNDLED_WORLD_DATA
+) -> t.Tuple[str, str]:
+    """Get a local copy of the world data, downloading it only when needed.
+
+    The file is cached in `cache_dir`, together with the ETag and Last-Modified
+    headers of the response. A cached copy younger than `max_age` is used as is;
+    an older one is revalidated with a conditional request (If-None-Match /
+    If-Modified-Since). If the server can't be reached, the cached copy (or, if
+    there is none, `fallback_path`) is used.
+
+    Args:
+        world_data_src (str): The URL or path to the world data file.
+        cache_dir (str): The directory where the downloaded file is cached.
+        max_age (float): The time (in seconds) a cached copy is used without
+            revalidating it.
+        fallback_path (str): The file used if it can't be downloaded nor found
+            in the cache.
+
+    Returns:
+        t.Tuple[str, str]: The path to the local file, and how it was obtained:
+            "local", "hit", "revalidated", "download", "stale" or "fallback".
+    """
+    start = time.perf_counter()
+    if os.path.isfile(world_data_src):
+        path, status = world_data_src, "local"
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, os.path.basename(world_data_src))
+        meta_path = path + ".json"
+        meta = {}
+        if os.path.isfile(path) and os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+
+        if meta and time.time() - meta['fetched_at'] < max_age:
+            status = "hit"
+        else:
+            headers = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            try:
+                response = requests.get(world_data_src, headers=headers, timeout=30)
+                if response.status_code == 304:
+                    status = "revalidated"
+                else:
+                    response.raise_for_status()
+                    tmp_path = path + ".part"
+                    with open(tmp_path, "wb") as f:
+                        f.write(response.content)
+                    os.replace(tmp_path, path)
+                    meta = {
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                    }
+                    status = "download"
+                meta['fetched_at'] = time.time()
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+            except Exception as e:
+                print('Could not download the world data:', e)
+                if meta:
+                    status = "stale"
+                else:
+                    path, status = fallback_path, "fallback"
+
+    print(f"World data: {status} ({path}, {time.perf_counter() - start:.3f} s)")
+    return path, status
+
+
+@functools.lru_cache(maxsize=4)
+def _read_world_data(path: str, mtime: float) -> "gpd.GeoDataFrame":
+    import geopandas as gpd
+
+    world_data = gpd.read_file(path)
+    world_data.columns = map(str.lower, world_data.columns)
+    return world_data
+
+
+def read_world_data(path: str) -> "gpd.GeoDataFrame":
+    """Read the world data, with lower case column names.
+
+    The parsed data are kept in memory (until the file changes), so later calls
+    in the same process (e.g. a warm Lambda container) don't parse it again.
+
+    A geometry artifact (".geojson", see `build_geometry_artifact`) is read
+    without geopandas, as a DataFrame with the GeoJSON feature of each country
+    in a "feature" column instead of the geometry. It is enough for the HTML map
+    (see `build_countries_figure`).
+
+    Args:
+        path (str): The path (or URL) to the world data file.
+
+    Returns:
+        gpd.GeoDataFrame: The world data. Don't modify it in place.
+    """
+    mtime = os.path.getmtime(path) if os.path.isfile(path) else 0.0
+    if path.endswith(".geojson"):
+        return _read_geometry_artifact(path, mtime)
+    return _read_world_data(path, mtime)
+
+
+@functools.lru_cache(maxsize=2)
+def _read_geometry_artifact(path: str, mtime: float) -> pd.DataFrame:
+    with open(path) as f:
+        geojson = json.load(f)
+    return pd.DataFrame([
+        {
+            **feature['properties'],
+            'feature': {
+                'type': 'Feature',
+                'properties': {'name': feature['properties']['name']},
+                'geometry': feature['geometry'],
+            },
+        }
+        for feature in geojson['features']
+    ])
+
+
+def build_geometry_artifact(
+    world_data_path: str = BUNDLED_WORLD_DATA,
+    output_path: str = GEOMETRY_ARTIFACT_PATH,
+    country_names: t.Optional[t.Iterable[str]] = None
+) -> int:
+    """Build the compact geometry artifact of the countries for the HTML map.
+
+    The polygons are simplified and quantized as for the map (see
+    `build_countries_geojson`), and each feature only keeps the columns of
+    GEOMETRY_ARTIFACT_COLUMNS and the position of the country label, so the map
+    can be built from it with the standard library and pandas, without reading
+    the shapefile with geopandas (see `read_world_data`).
+
+    Args:
+        world_data_path (str): The path to the world data.
+        output_path (str): The path to the output GeoJSON file.
+        country_names (t.Optional[t.Iterable[str]]): The countries to keep. If
+            None, all of them (so that a site in a new country doesn't need a new
+            artifact).
+
+    Returns:
+        int: The size of the artifact, in bytes.
+    """
+    world_data = read_world_data(world_data_path)
+    if country_names is not None:
+        world_data = world_data.loc[world_data['name'].isin(set(country_names))]
+
+    geojson = build_countries_geojson(world_data)
+    label_points = world_data.geometry.representative_point()
+    label_lat = label_points.y.round(MAP_COORDINATE_PRECISION)
+    label_lng = label_points.x.round(MAP_COORDINATE_PRECISION)
+    properties = world_data[GEOMETRY_ARTIFACT_COLUMNS].to_dict('records')
+    for feature, row, lat, lng in zip(geojson['features'], properties, label_lat, label_lng):
+        feature['properties'] = {**row, 'label_lat': lat, 'label_lng': lng}
+    geojson['world_data_version'] = get_world_data_version(world_data_path)
+
+    data = json.dumps(geojson, separators=(',', ':'), ensure_ascii=False).encode()
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+    print(f"Geometry artifact written to {output_path}: {len(world_data)} countries, "
+          f"{len(data) / 1024:.1f} KiB")
+    return len(data)
+
+
+def map_geometry_path(
+    world_data_path: t.Optional[str],
+    artifact_path: str = GEOMETRY_ARTIFACT_PATH
+) -> t.Optional[str]:
+    """The file to build the HTML map from: the geometry artifact if there is one.
+
+    Args:
+        world_data_path (t.Optional[str]): The path to the world data (None to
+            tell whether there is an artifact before downloading it).
+        artifact_path (str): The path to the geometry artifact (see
+            `build_geometry_artifact`).
+
+    Returns:
+        t.Optional[str]: `artifact_path` if it exists, otherwise `world_data_path`.
+    """
+    return artifact_path if artifact_path and os.path.isfile(artifact_path) else world_data_path
+
+
+@functools.lru_cache(maxsize=1)
+def get_dynamodb_client():
+    """Get the DynamoDB client, built once per process (DYNAMODB_ENDPOINT_URL,
+    if set, points it to DynamoDB Local)."""
+    return boto3.client("dynamodb", endpoint_url=DYNAMODB_ENDPOINT_URL)
+
+
+def create_scan_history_table(table_name: str = SCAN_HISTORY_TABLE, dynamodb_client=None) -> None:
+    """Create the scan history table (e.g. in DynamoDB Local), if it doesn't exist.
+
+    The table has a partition key "pk" and a sort key "sk" (both strings):
+
+    - History items: pk = "<registry>#<city>" or "project#<label>", and sk = the
+      time of the run (ISO 8601), so that the counts of a site over time are a
+      single Query on its pk.
+    - Latest items: pk = "latest", and sk = the pk of the history item, so that
+      the latest counts of all the sites are a single Query on pk = "latest".
+
+    Args:
+        table_name (str): The name of the table.
+        dynamodb_client: The boto3 DynamoDB client (default: get_dynamodb_client()).
+    """
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    try:
+        dynamodb_client.create_table(
+            TableName=table_name,
+            KeySchema=[
+                {'AttributeName': 'pk', 'KeyType': 'HASH'},
+                {'AttributeName': 'sk', 'KeyType': 'RANGE'},
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'pk', 'AttributeType': 'S'},
+                {'AttributeName': 'sk', 'AttributeType': 'S'},
+            ],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        dynamodb_client.get_waiter('table_exists').wait(TableName=table_name)
+    except dynamodb_client.exceptions.ResourceInUseException:
+        pass
+
+
+def batch_write_items(
+    items: t.List[dict],
+    table_name: str = SCAN_HISTORY_TABLE,
+    dynamodb_client=None,
+    max_retries: int = 5
+) -> None:
+    """Write items to a DynamoDB table with batch_write_item.
+
+    The items are sent 25 at a time (the batch_write_item limit), and the
+    unprocessed items are retried with exponential backoff.
+
+    Args:
+        items (t.List[dict]): The items, in DynamoDB attribute value format.
+        table_name (str): The name of the table.
+        dynamodb_client: The boto3 DynamoDB client (default: get_dynamodb_client()).
+        max_retries (int): The maximum number of retries of a batch.
+    """
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    for i in range(0, len(items), 25):
+        requests_batch = {
+            table_name: [{'PutRequest': {'Item': item}} for item in items[i:i + 25]]
+        }
+        for attempt in range(max_retries + 1):
+            response = dynamodb_client.batch_write_item(RequestItems=requests_batch)
+            requests_batch = response.get('UnprocessedItems') or {}
+            if not requests_batch:
+                break
+            if attempt == max_retries:
+                raise RuntimeError(
+                    f"Could not write {len(requests_batch[table_name])} items to {table_name}"
+                )
+            time.sleep(0.05 * 2 ** attempt)
+
+
+def write_scan_history(
+    project_counts: t.Dict[str, int],
+    city_scans: t.Dict[str, t.Dict[str, int]],
+    run_at: t.Optional[str] = None,
+    table_name: str = SCAN_HISTORY_TABLE,
+    dynamodb_client=None
+) -> str:
+    """Save the counts of a run in the scan history table.
+
+    Each project and each city gets a history item and a "latest" item (see
+    `create_scan_history_table`).
+
+    Args:
+        project_counts (t.Dict[str, int]): The number of sessions per project label.
+        city_scans (t.Dict[str, t.Dict[str, int]]): The number of scans per city,
+            for each registry (e.g. {"sites": {...}, "development": {...}}).
+        run_at (t.Optional[str]): The time of the run (ISO 8601, UTC). Default: now.
+        table_name (str): The name of the table.
+        dynamodb_client: The boto3 DynamoDB client (default: get_dynamodb_client()).
+
+    Returns:
+        str: The time of the run.
+    """
+    run_at = run_at or datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    counts = {f"project#{label}": sessions for label, sessions in project_counts.items()}
+    for registry, scans in city_scans.items():
+        counts.update({f"{registry}#{city}": n for city, n in scans.items()})
+
+    items = []
+    for key, n in counts.items():
+        items.append({'pk': {'S': key}, 'sk': {'S': run_at}, 'scans': {'N': str(n)}})
+        items.append({
+            'pk': {'S': 'latest'}, 'sk': {'S': key},
+            'scans': {'N': str(n)}, 'run_at': {'S': run_at},
+        })
+    batch_write_items(items, table_name, dynamodb_client)
+    print(f"Saved {len(counts)} counts in {table_name} ({run_at})")
+    return run_at
+
+
+def query_items(dynamodb_client, **query_kwargs) -> t.Iterator[dict]:
+    """Iterate over the items of a DynamoDB Query, following the pagination."""
+    while True:
+        response = dynamodb_client.query(**query_kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def read_latest_snapshot(
+    table_name: str = SCAN_HISTORY_TABLE,
+    dynamodb_client=None
+) -> t.Tuple[t.Dict[str, int], t.Dict[str, t.Dict[str, int]]]:
+    """Read the latest counts of all the projects and cities with one Query.
+
+    Args:
+        table_name (str): The name of the table.
+        dynamodb_client: The boto3 DynamoDB client (default: get_dynamodb_client()).
+
+    Returns:
+        t.Tuple[t.Dict[str, int], t.Dict[str, t.Dict[str, int]]]: The number of
+            sessions per project label, and the number of scans per city for
+            each registry.
+    """
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    project_counts, city_scans = {}, {}
+    for item in query_items(
+        dynamodb_client,
+        TableName=table_name,
+        KeyConditionExpression='pk = :pk',
+        ExpressionAttributeValues={':pk': {'S': 'latest'}},
+    ):
+        kind, name = item['sk']['S'].split('#', 1)
+        if kind == 'project':
+            project_counts[name] = int(item['scans']['N'])
+        else:
+            city_scans.setdefault(kind, {})[name] = int(item['scans']['N'])
+    return project_counts, city_scans
+
+
+def read_site_history(
+    city: str,
+    registry: str = "sites",
+    table_name: str = SCAN_HISTORY_TABLE,
+    dynamodb_client=None
+) -> t.List[t.Tuple[str, int]]:
+    """Read the number of scans of a site over time.
+
+    Args:
+        city (str): The city.
+        registry (str): The registry of the city ("sites" or "development").
+        table_name (str): The name of the table.
+        dynamodb_client: The boto3 DynamoDB client (default: get_dynamodb_client()).
+
+    Returns:
+        t.List[t.Tuple[str, int]]: The (time of the run, number of scans) pairs,
+            oldest first.
+    """
+    dynamodb_client = dynamodb_client or get_dynamodb_client()
+    return [
+        (item['sk']['S'], int(item['scans']['N']))
+        for item in query_items(
+            dynamodb_client,
+            TableName=table_name,
+            KeyConditionExpression='pk = :pk',
+            ExpressionAttributeValues={':pk': {'S': f"{registry}#{city}"}},
+        )
+    ]
+
+
+def city_scans_from_counts(
+    cities_dict: t.Dict[str, t.List[str]],
+    project_counts: t.Dict[str, int]
+) -> t.Dict[str, int]:
+    """Add up the number of sessions of the projects of each city.
+
+    Args:
+        cities_dict (t.Dict[str, t.List[str]]): The project labels of each city.
+        project_counts (t.Dict[str, int]): The number of sessions per project label.
+
+    Returns:
+        t.Dict[str, int]: The number of scans per city.
+    """
+    return {
+        city: sum(project_counts.get(label, 0) for label in projects_list)
+        for city, projects_list in cities_dict.items()
+    }
+
+
+def write_json_atomic(path: str, data: t.Any) -> None:
+    """Write a JSON file atomically (so that readers never see a partial file).
+
+    Args:
+        path (str): The path to the JSON file.
+        data (t.Any): The data to save.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def collect_stage(
+    fw: flywheel.Client,
+    artifact_path: str = COLLECT_ARTIFACT_PATH,
+    sites_csv_path: str = SITES_CSV_PATH,
+    dev_sites_csv_path: str = DEV_SITES_CSV_PATH,
+    source: str = "flywheel"
+) -> t.Dict[str, t.Any]:
+    """Collect stage: get the scan counts from Flywheel and update the CSV files.
+
+    The result is saved in a small JSON artifact, which is the input of the
+    "render" and "publish" stages, so these can run separately (e.g. in another
+    process or Lambda, with a different memory size) and be retried without
+    querying Flywheel again.
+
+    If SCAN_HISTORY_TABLE is set, the counts fetched from Flywheel are also saved
+    in the scan history, and with `source="history"` the latest counts saved
+    there are used instead of querying Flywheel.
+
+    Args:
+        fw (flywheel.Client): The Flywheel SDK client (unused with
+            `source="history"`).
+        artifact_path (str): The path to the JSON artifact.
+        sites_csv_path (str): The path to the CSV file with the data-contributing sites.
+        dev_sites_csv_path (str): The path to the CSV file with the development sites.
+        source (str): Where to get the counts from: "flywheel" or "history".
+
+    Returns:
+        t.Dict[str, t.Any]: The content of the artifact.
+    """
+    if source == "history":
+        if not SCAN_HISTORY_TABLE:
+            raise ValueError("No scan history table configured (set SCAN_HISTORY_TABLE)")
+        project_counts, _ = read_latest_snapshot()
+        errors = {}
+    elif source == "flywheel":
+        # Get data from Flywheel, once for all the projects in both dictionaries
+        stats_cache = ProjectStatsCache() if STATS_CACHE_PATH else None
+        project_counts, errors = get_projects_sessions(
+            fw,
+            [
+                label
+                for cities_dict in (SITES_CITIES, DEVELOPMENT_CITIES)
+                for projects_list in cities_dict.values()
+                for label in projects_list
+            ],
+            cache=stats_cache
+        )
+        if stats_cache is not None:
+            stats_cache.evict_expired()
+            print(f"Project stats cache: {stats_cache.hits} hits, {stats_cache.misses} misses")
+            stats_cache.close()
+
+        if SCAN_HISTORY_TABLE:
+            write_scan_history(project_counts, {
+                'sites': city_scans_from_counts(SITES_CITIES, project_counts),
+                'development': city_scans_from_counts(DEVELOPMENT_CITIES, project_counts),
+            })
+    else:
+        raise ValueError(f"Unknown source of the counts: {source}")
+
+    # A) For the SITE_CITIES (data-contributing sites):
+    update_number_of_scans_in_csv(fw, SITES_CITIES, sites_csv_path, project_counts)
+
+    # B) For the DEVELOPMENT_CITIES:
+    update_number_of_scans_in_csv(fw, DEVELOPMENT_CITIES, dev_sites_csv_path, project_counts)
+
+    artifact = {
+        'created': time.time(),
+        'project_counts': project_counts,
+        'errors': {label: str(e) for label, e in errors.items()},
+        'sites_csv_path': sites_csv_path,
+        'dev_sites_csv_path': dev_sites_csv_path,
+    }
+    write_json_atomic(artifact_path, artifact)
+    return artifact
+
+
+def read_artifact(artifact_path: str = COLLECT_ARTIFACT_PATH) -> t.Dict[str, t.Any]:
+    """Read the artifact written by the "collect" stage.
+
+    Args:
+        artifact_path (str): The path to the JSON artifact.
+
+    Returns:
+        t.Dict[str, t.Any]: The content of the artifact.
+    """
+    if not os.path.exists(artifact_path):
+        raise FileNotFoundError(
+            f"File not found: {artifact_path} (run the 'collect' stage first)"
+        )
+    with open(artifact_path) as f:
+        return json.load(f)
+
+
+def render_stage(
+    artifact_path: str = COLLECT_ARTIFACT_PATH,
+    map_path: str = MAP_HTML_PATH
+) -> bool:
+    """Render stage: build the map from the "collect" artifact.
+
+    The map is not rendered again if its inputs (see `compute_fingerprint`)
+    haven't changed since it was last rendered.
+
+    Args:
+        artifact_path (str): The path to the JSON artifact.
+        map_path (str): The path to the output HTML file.
+
+    Returns:
+        bool: Whether the map was rendered (False if it was up to date).
+    """
+    artifact = read_artifact(artifact_path)
+    sites_csv_path = artifact['sites_csv_path']
+    dev_sites_csv_path = artifact['dev_sites_csv_path']
+
+    # The maps are built from the geometry artifact if there is one (see
+    # map_geometry_path): the world data is only downloaded without it
+    map_file = map_geometry_path(None)
+    if map_file is None:
+        map_file, _ = fetch_world_data(WORLD_DATA_SRC)
+
+    # Skip the map if nothing changed since the last run
+    fingerprint = compute_fingerprint(
+        artifact['project_counts'],
+        [sites_csv_path, dev_sites_csv_path],
+        get_world_data_version(map_file)
+    )
+    if fingerprint == read_fingerprint(FINGERPRINT_PATH) and os.path.exists(map_path):
+        print("No changes since the last run, skipping the map update")
+        return False
+
+    # Generate the map figure
+    update_map_figure(map_file, sites_csv_path, dev_sites_csv_path, map_path)
+    if MAP_SVG_PATH:
+        render_map_svg(map_file, sites_csv_path, dev_sites_csv_path, MAP_SVG_PATH)
+    write_fingerprint(FINGERPRINT_PATH, fingerprint)
+    return True
+
+
+def publish_stage(
+    artifact_path: str = COLLECT_ARTIFACT_PATH,
+    map_path: str = MAP_HTML_PATH
+) -> None:
+    """Publish stage: upload the CSV file and the map.
+
+    Args:
+        artifact_path (str): The path to the JSON artifact.
+        map_path (str): The path to the map HTML file.
+    """
+    artifact = read_artifact(artifact_path)
+    if not os.path.exists(map_path):
+        raise FileNotFoundError(f"File not found: {map_path} (run the 'render' stage first)")
+    print(publish_files([artifact['sites_csv_path'], map_path]))
+
+
+def timeline_stage(
+    fw: flywheel.Client,
+    sites_csv_path: str = SITES_CSV_PATH,
+    timeline_csv_path: str = TIMELINE_CSV_PATH,
+    output_path: str = TIMELINE_HTML_PATH
+) -> pd.DataFrame:
+    """Timeline stage: scans per site per month, and the animated map.
+
+    Args:
+        fw (flywheel.Client): The Flywheel SDK client.
+        sites_csv_path (str): The path to the CSV file with the data-contributing sites.
+        timeline_csv_path (str): The path to the output CSV file with the scans
+            per site per month.
+        output_path (str): The path to the output HTML file.
+
+    Returns:
+        pd.DataFrame: The scans per site per month.
+    """
+    project_months, _ = fetch_monthly_sessions(
+        fw, [label for labels in SITES_CITIES.values() for label in labels]
+    )
+    timeline = city_monthly_scans(SITES_CITIES, project_months)
+    write_csv_atomic(timeline, timeline_csv_path)
+    if timeline.empty:
+        print("No sessions found, skipping the timeline map")
+    else:
+        world_data_path, _ = fetch_world_data(WORLD_DATA_SRC)
+        update_timeline_figure(world_data_path, sites_csv_path, timeline_csv_path, output_path)
+    return timeline
+
+
+def main(fw):
+    # Check URL:
+    print(f"Site URL: {fw.get_config().site.api_url.removesuffix('/api')}")
+
+    # Check user Info
+    user_info = fw.get_current_user()
+    
+    print(f"Firstname: {user_info.firstname} \n"
+        f"Lastname: {user_info.lastname} \n"
+        f"Email: {user_info.email} \n"
+    )
+
+    collect_stage(fw)
+    rendered = render_stage()
+
+    return {
+        'statusCode': 200,
+        'body': "Success" if rendered else "Unchanged"
+    }
+
+
+class PipelineTimeline:
+    """Run pipeline stages concurrently, and report their timing.
+
+    Each stage is a blocking function run in a thread (so the Flywheel, world
+    data and upload requests overlap) once the stages it depends on are done.
+    The report gives the span of each stage, the total duration, the duration
+    the stages would have taken one after the other, and the critical path:
+    the chain of dependencies that ended last, i.e. the stages to speed up to
+    shorten the pipeline.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: t.Dict[str, t.Tuple[float, float]] = {}
+        self.dependencies: t.Dict[str, t.List[str]] = {}
+        self._names: t.Dict[asyncio.Future, str] = {}
+
+    def stage(
+        self,
+        name: str,
+        func: t.Callable,
+        *args,
+        after: t.Sequence[asyncio.Future] = (),
+        **kwargs
+    ) -> asyncio.Task:
+        """Schedule a stage.
+
+        Args:
+            name (str): The name of the stage.
+            func (t.Callable): The blocking function of the stage.
+            *args: The arguments of the function.
+            after (t.Sequence[asyncio.Future]): The stages (returned by `stage`)
+                to wait for. If one of them fails, this stage fails too.
+            **kwargs: The keyword arguments of the function.
+
+        Returns:
+            asyncio.Task: The stage, whose result is the result of the function.
+        """
+        async def run():
+            await asyncio.gather(*after)
+            begin = time.perf_counter()
+            try:
+                return await asyncio.to_thread(func, *args, **kwargs)
+            finally:
+                self.spans[name] = (begin - self.start, time.perf_counter() - self.start)
+
+        task = asyncio.ensure_future(run())
+        self._names[task] = name
+        self.dependencies[name] = [self._names[dependency] for dependency in after]
+        return task
+
+    def report(self) -> t.Dict[str, t.Any]:
+        """Timing of the stages that ran, in ms.
+
+        Returns:
+            t.Dict[str, t.Any]: The start and end of each stage, the total
+                ("wall_ms") and one-after-the-other ("sequential_ms")
+                durations, the speedup and the critical path.
+        """
+        if not self.spans:
+            return {}
+        def ms(seconds):
+            return round(seconds * 1000, 1)
+
+        critical_path = [max(self.spans, key=lambda name: self.spans[name][1])]
+        while True:
+            done = [name for name in self.dependencies[critical_path[0]] if name in self.spans]
+            if not done:
+                break
+            critical_path.insert(0, max(done, key=lambda name: self.spans[name][1]))
+        wall = max(end for _, end in self.spans.values())
+        sequential = sum(end - begin for begin, end in self.spans.values())
+        return {
+            'spans_ms': {name: [ms(begin), ms(end)] for name, (begin, end) in self.spans.items()},
+            'wall_ms': ms(wall),
+            'sequential_ms': ms(sequential),
+            'speedup': round(sequential / wall, 2) if wall else None,
+            'critical_path': critical_path,
+        }
+
+
+def load_world_data(world_data_src: str = WORLD_DATA_SRC) -> str:
+    """Get the map file and parse it (see `read_world_data`, which keeps it in
+    memory for the map).
+
+    As in `render_stage`, the geometry artifact is used if there is one (see
+    `map_geometry_path`): the world data is only downloaded without it.
+
+    Args:
+        world_data_src (str): The URL or path of the world data.
+
+    Returns:
+        str: The path to the geometry artifact, or to the local copy of the
+            world data.
+    """
+    map_file = map_geometry_path(None)
+    if map_file is None:
+        map_file, _ = fetch_world_data(world_data_src)
+    read_world_data(map_file)
+    return map_file
+
+
+async def run_pipeline_async(fw: flywheel.Client, publish: bool = True) -> t.Dict[str, t.Any]:
+    """Run the collect, render and publish stages with asyncio, overlapping
+    the independent steps.
+
+    The world data is loaded while the counts are fetched from Flywheel, and
+    the CSV file is published as soon as it is written, while the map is
+    rendered. The map is published once rendered (not if `render_stage` skipped
+    it).
+
+    Args:
+        fw (flywheel.Client): The Flywheel SDK client.
+        publish (bool): Whether to publish the CSV file and the map.
+
+    Returns:
+        t.Dict[str, t.Any]: The timing report (see `PipelineTimeline.report`).
+    """
+    timeline = PipelineTimeline()
+    collect = timeline.stage("collect", collect_stage, fw)
+    world_data = timeline.stage("world_data", load_world_data)
+    render = timeline.stage("render", render_stage, after=[collect, world_data])
+    stages = [collect, world_data, render]
+    if publish:
+        def publish_map():
+            # Only a map rendered by this run: render_stage returns False when
+            # it skipped the map, which may then be stale or missing
+            if not render.result():
+                print(f"{MAP_HTML_PATH} wasn't rendered by this run, not publishing it")
+                return
+            print(publish_files([MAP_HTML_PATH]))
+
+        stages.append(timeline.stage(
+            "publish_csv", lambda: print(publish_files([collect.result()['sites_csv_path']])),
+            after=[collect],
+        ))
+        stages.append(timeline.stage("publish_map", publish_map, after=[render]))
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        report = timeline.report()
+        print(json.dumps({'pipeline_timing': report}))
+    return report
+
+
+def round_coordinates(coordinates: t.Any, ndigits: int) -> t.Any:
+    """Round the (nested) coordinates of a GeoJSON geometry.
+
+    Args:
+        coordinates (t.Any): The coordinates (a number or a nested list of them).
+        ndigits (int): The number of decimals to keep.
+
+    Returns:
+        t.Any: The rounded coordinates.
+    """
+    if isinstance(coordinates, (list, tuple)):
+        return [round_coordinates(c, ndigits) for c in coordinates]
+    return round(coordinates, ndigits)
+
+
+def build_countries_geojson(
+    countries: "gpd.GeoDataFrame",
+    simplify_tolerance: t.Optional[float] = MAP_SIMPLIFY_TOLERANCE,
+    coordinate_precision: t.Optional[int] = MAP_COORDINATE_PRECISION
+) -> dict:
+    """Build a compact GeoJSON of the countries for the map.
+
+    Only the "name" property is kept, the polygons are simplified to
+    `simplify_tolerance` (in degrees, which is well below what can be seen at
+    the scale of a world map) and the coordinates are rounded to
+    `coordinate_precision` decimals.
+
+    Args:
+        countries (gpd.GeoDataFrame): The countries (with "name" and "geometry").
+        simplify_tolerance (t.Optional[float]): The simplification tolerance. If
+            None, the polygons are not simplified.
+        coordinate_precision (t.Optional[int]): The number of decimals of the
+            coordinates. If None, they are not rounded.
+
+    Returns:
+        dict: The GeoJSON FeatureCollection.
+    """
+    compact = countries[['name', 'geometry']].copy()
+    if simplify_tolerance:
+        compact['geometry'] = compact.geometry.simplify(
+            simplify_tolerance, preserve_topology=True
+        )
+    geojson = json.loads(compact.to_json(drop_id=True))
+    if coordinate_precision is not None:
+        for feature in geojson['features']:
+            feature['geometry']['coordinates'] = round_coordinates(
+                feature['geometry']['coordinates'], coordinate_precision
+            )
+    return geojson
+
+
+def cluster_sites(sites: pd.DataFrame, cell_size: float) -> pd.DataFrame:
+    """Aggregate the sites into one cluster per cell of a lat/lng grid.
+
+    Each cluster is placed at the mean position of its sites and gets their
+    summed "scans", so the number of markers is bounded by the number of grid
+    cells, whatever the number of sites.
+
+    Args:
+        sites (pd.DataFrame): The sites (with "city", "lat", "lng" and "scans").
+            The sites without coordinates are left out.
+        cell_size (float): The size of the grid cells, in degrees.
+
+    Returns:
+        pd.DataFrame: The clusters, with "lat", "lng", "scans", "n_sites" and a
+            "hovertext" listing (the first few of) their cities.
+    """
+    sites = sites.dropna(subset=['lat', 'lng'])
+    cells = pd.DataFrame({
+        'row': np.floor(sites['lat'].to_numpy() / cell_size),
+        'col': np.floor(sites['lng'].to_numpy() / cell_size),
+    }, index=sites.index)
+    clusters = sites.groupby([cells['row'], cells['col']]).agg(
+        lat=('lat', 'mean'),
+        lng=('lng', 'mean'),
+        scans=('scans', 'sum'),
+        n_sites=('city', 'size'),
+        cities=('city', lambda cities: ", ".join(map(str, cities.iloc[:5]))),
+    ).reset_index(drop=True)
+    clusters['hovertext'] = np.where(
+        clusters['n_sites'] == 1,
+        clusters['cities'],
+        clusters['n_sites'].astype(str) + " sites: " + clusters['cities']
+        + np.where(clusters['n_sites'] > 5, ", ...", ""),
+    )
+    return clusters.drop(columns='cities')
+
+
+def sites_scatter(
+    sites: pd.DataFrame,
+    name: str,
+    symbol: str,
+    color: str,
+    **kwargs
+) -> go.Scattergeo:
+    """Markers of the sites (or clusters of sites), labelled with their scans.
+
+    Args:
+        sites (pd.DataFrame): The sites (with "lat", "lng" and "scans").
+        name (str): The name of the trace (in the legend).
+        symbol (str): The marker symbol.
+        color (str): The marker color.
+        **kwargs: Other properties of the trace.
+
+    Returns:
+        go.Scattergeo: The trace.
+    """
+    return go.Scattergeo(
+        name=name,
+        lat=sites['lat'],
+        lon=sites['lng'],
+        text=sites['scans'],
+        mode='markers+text',
+        marker = dict(
+            # Adjust size by the square root of "scans", so that the marker area is
+            # proportional to the number of scans
+            size= sites['scans'] ** 0.5 * 2,
+            symbol = symbol,
+            opacity=0.8,
+            color=color,
+            line = dict(
+                width=1,
+                color='rgba(102, 102, 102)'
+            ),
+        ),
+        textposition="middle center",
+        **kwargs
+    )
+
+
+def cluster_zoom_script(tier_scales: t.List[float], tier_traces: t.List[t.List[int]]) -> str:
+    """JavaScript showing the cluster traces of the current zoom tier.
+
+    To be passed as `post_script` to `fig.to_html`: when the map is zoomed, the
+    traces of the tier with the highest minimum scale below the projection
+    scale are shown, and the traces of the other tiers are hidden.
+
+    Args:
+        tier_scales (t.List[float]): The minimum projection scale of each tier.
+        tier_traces (t.List[t.List[int]]): The indices of the traces of each tier.
+
+    Returns:
+        str: The script.
+    """
+    return f"""
+        var gd = document.getElementById('{{plot_id}}');
+        var scales = {json.dumps(tier_scales)}, tiers = {json.dumps(tier_traces)};
+        var traces = [].concat.apply([], tiers), current = 0;
+        gd.on('plotly_relayout', function (event) {{
+            var scale = event['geo.projection.scale'];
+            if (scale === undefined) return;
+            var tier = 0;
+            scales.forEach(function (s, i) {{ if (scale >= s) tier = i; }});
+            if (tier === current) return;
+            current = tier;
+            Plotly.restyle(gd, {{visible: traces.map(function (i) {{
+                return tiers[tier].indexOf(i) >= 0;
+            }})}}, traces);
+        }});
+    """
+
+
+def build_countries_figure(
+    world_data: "gpd.GeoDataFrame",
+    country_names: t.Iterable[str],
+    optimize: bool = MAP_OPTIMIZE,
+    label_column: str = 'iso_a3',
+    labels_name: str = 'Number of scans'
+) -> go.Figure:
+    """Base layer of the maps: the UNITY countries in colors, with their codes.
+
+    Args:
+        world_data (gpd.GeoDataFrame): The world data, or the geometry artifact
+            (see `read_world_data`).
+        country_names (t.Iterable[str]): The names of the UNITY countries.
+        optimize (bool): Whether to optimize the size of the output (see
+            `update_map_figure`).
+        label_column (str): The column of the world data with the labels of
+            the countries (e.g. "name_fr" for their names in French).
+        labels_name (str): The name of the trace of the labels.
+
+    Returns:
+        go.Figure: The figure, with one choropleth trace per country and a trace
+            with the country codes.
+    """
+    unity = world_data.loc[world_data["name"].isin(country_names)]
+    if 'feature' in unity.columns:
+        # Geometry artifact: the polygons are already compact
+        unity_json = {'type': 'FeatureCollection', 'features': list(unity['feature'])}
+    elif optimize:
+        unity_json = build_countries_geojson(unity)
+    else:
+        unity_json = json.loads(unity.to_json())
+
+    # Setup country map
+    fig = px.choropleth(
+        unity,
+        geojson=unity_json,
+        featureidkey='properties.name',
+        locations='name',
+        color='name'
+    )
+
+    ## Add labels on countries
+    if optimize:
+        # px.choropleth makes one trace per country (color='name'), each one
+        # with its own copy of the GeoJSON: keep only the trace's own features
+        features = {f['properties']['name']: f for f in unity_json['features']}
+        for trace in fig.data:
+            trace.geojson = {
+                'type': 'FeatureCollection',
+                'features': [features[name] for name in trace.locations],
+            }
+        if 'feature' in unity.columns:
+            label_lat, label_lng = unity['label_lat'], unity['label_lng']
+        else:
+            label_points = unity.geometry.representative_point()
+            label_lat = label_points.y.round(MAP_COORDINATE_PRECISION)
+            label_lng = label_points.x.round(MAP_COORDINATE_PRECISION)
+        fig.add_scattergeo(
+            name=labels_name,
+            lat=label_lat,
+            lon=label_lng,
+            text=unity[label_column],
+            mode='text',
+        )
+    else:
+        fig.add_scattergeo(
+            name=labels_name,
+            geojson=unity_json,
+            locations=unity['name'],
+            featureidkey='properties.name',
+            text=unity[label_column],
+            mode='text',
+        )
+    return fig
+
+
+def base_figure_key(
+    country_names: t.Iterable[str],
+    world_data_version: str,
+    optimize: bool = MAP_OPTIMIZE,
+    label_column: str = 'iso_a3',
+    labels_name: str = 'Number of scans'
+) -> str:
+    """Key of a base layer of the map in the cache (see `load_base_figure`).
+
+    Args:
+        country_names (t.Iterable[str]): The names of the UNITY countries.
+        world_data_version (str): The version of the world data (see
+            `get_world_data_version`).
+        optimize (bool): Whether the size of the output is optimized.
+        label_column (str): The column of the world data with the labels.
+        labels_name (str): The name of the trace of the labels.
+
+    Returns:
+        str: The SHA-256 hex digest of everything the base layer depends on.
+    """
+    return hashlib.sha256(json.dumps([
+        MAP_BASE_CACHE_VERSION, plotly.__version__, world_data_version,
+        sorted(country_names), optimize, MAP_SIMPLIFY_TOLERANCE,
+        MAP_COORDINATE_PRECISION, label_column, labels_name,
+    ]).encode()).hexdigest()
+
+
+def load_base_figure(
+    map_file: str,
+    country_names: t.Iterable[str],
+    optimize: bool = MAP_OPTIMIZE,
+    label_column: str = 'iso_a3',
+    labels_name: str = 'Number of scans',
+    cache_dir: str = MAP_BASE_CACHE_DIR
+) -> go.Figure:
+    """Get the base layer of the map (see `build_countries_figure`), from the cache if possible.
+
+    The set of UNITY countries rarely changes, so the base layer is saved as a
+    Plotly figure JSON file in `cache_dir`, keyed by the countries and the
+    version of the world data (see `base_figure_key`). When it is in the cache,
+    the world data isn't even read: only the marker traces are then built.
+
+    Args:
+        map_file (str): The path to the map file.
+        country_names (t.Iterable[str]): The names of the UNITY countries.
+        optimize (bool): Whether to optimize the size of the output.
+        label_column (str): The column of the world data with the labels of
+            the countries.
+        labels_name (str): The name of the trace of the labels.
+        cache_dir (str): The directory of the cache. If empty, the base layer is
+            always built.
+
+    Returns:
+        go.Figure: The base layer.
+    """
+    country_names = set(country_names)
+    if not cache_dir:
+        return build_countries_figure(
+            read_world_data(map_file), country_names, optimize, label_column, labels_name
+        )
+
+    key = base_figure_key(
+        country_names, get_world_data_version(map_file), optimize, label_column, labels_name
+    )
+    cache_path = os.path.join(cache_dir, f"map_base_{key[:16]}.json")
+    try:
+        with open(cache_path) as f:
+            return pio.from_json(f.read())
+    except (FileNotFoundError, ValueError):
+        pass
+
+    fig_json = build_countries_figure(
+        read_world_data(map_file), country_names, optimize, label_column, labels_name
+    ).to_json()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(fig_json)
+    os.replace(tmp_path, cache_path)
+    # Same figure as when it is loaded from the cache, so that the output is
+    # identical either way
+    return pio.from_json(fig_json)
+
+
+def update_map_figure(
+    map_file: str,
+    sites_csv_path: str,
+    dev_sites_csv_path: str,
+    output_path: t.Optional[str] = None,
+    optimize: bool = MAP_OPTIMIZE,
+    byte_budget: int = MAP_BYTE_BUDGET,
+    cluster_min_sites: int = MAP_CLUSTER_MIN_SITES,
+    cluster_tiers: t.List[t.Tuple[float, float]] = MAP_CLUSTER_TIERS,
+    base_cache_dir: str = MAP_BASE_CACHE_DIR
+) -> t.Optional[int]:
+    """Update the map figure with the data from the CSV files.
+
+    With `optimize`, the size of the output is reduced: the country polygons
+    are simplified and quantized (see `build_countries_geojson`), each
+    country's geometry is embedded only once (in its own choropleth trace), and
+    the country labels are placed with coordinates instead of a second copy of
+    the geometries.
+
+    From `cluster_min_sites` sites, each layer of sites is drawn as clusters
+    (see `cluster_sites`), with one trace per zoom tier: zooming in on the map
+    switches to the traces of finer grids, so the browser only draws a bounded
+    number of markers.
+
+    The base layer (the countries) is cached (see `load_base_figure`), so that
+    when only the numbers of scans change, only the markers are built.
+
+    Args:
+        map_file (str): The path to the map file.
+        sites_csv_path (str): The path to the CSV file with the data-contributing sites.
+        dev_sites_csv_path (str): The path to the CSV file with the development sites.
+        output_path (t.Optional[str]): The path to the output HTML file. If None,
+            the figure is shown instead.
+        optimize (bool): Whether to optimize the size of the output.
+        byte_budget (int): The maximum expected size of the output, in bytes. A
+            warning is printed if the output is bigger.
+        cluster_min_sites (int): The number of sites from which they are clustered.
+        cluster_tiers (t.List[t.Tuple[float, float]]): The minimum projection
+            scale and the grid cell size (in degrees, 0 for no clustering) of
+            each zoom tier.
+        base_cache_dir (str): The directory of the cache of the base layer (see
+            `load_base_figure`). If empty, the base layer is always built.
+
+    Returns:
+        t.Optional[int]: The size of the output HTML file in bytes, if written.
+    """
+
+    # Load the CSV files:
+    city_data = pd.read_csv(sites_csv_path)
+    DS_data = pd.read_csv(dev_sites_csv_path)
+
+    # Load the base layer (the world data is only read if it isn't cached)
+    base_figure = load_base_figure(
+        map_file, set(city_data["country"].dropna()) | set(DS_data["country"].dropna()), optimize,
+        cache_dir=base_cache_dir
+    )
+
+    fig, post_script = build_map_figure(
+        None, city_data, DS_data, optimize, cluster_min_sites, cluster_tiers,
+        base_figure=base_figure
+    )
+    if output_path is None:
+        fig.show(post_script=post_script)
+        return None
+    return write_map_html(fig, output_path, post_script, byte_budget)
+
+
+def build_map_figure(
+    world_data: t.Optional["gpd.GeoDataFrame"],
+    city_data: pd.DataFrame,
+    DS_data: pd.DataFrame,
+    optimize: bool = MAP_OPTIMIZE,
+    cluster_min_sites: int = MAP_CLUSTER_MIN_SITES,
+    cluster_tiers: t.List[t.Tuple[float, float]] = MAP_CLUSTER_TIERS,
+    labels: t.Optional[t.Dict[str, str]] = None,
+    label_column: str = 'iso_a3',
+    base_figure: t.Optional[go.Figure] = None
+) -> t.Tuple[go.Figure, t.Optional[str]]:
+    """Build the map figure (see `update_map_figure`).
+
+    Args:
+        world_data (t.Optional[gpd.GeoDataFrame]): The world data (not used
+            with `base_figure`).
+        city_data (pd.DataFrame): The data-contributing sites.
+        DS_data (pd.DataFrame): The development sites.
+        optimize (bool): Whether to optimize the size of the output.
+        cluster_min_sites (int): The number of sites from which they are clustered.
+        cluster_tiers (t.List[t.Tuple[float, float]]): The zoom tiers of the clusters.
+        labels (t.Optional[t.Dict[str, str]]): The names of the layers (see
+            MAP_LABELS). If None, the English ones.
+        label_column (str): The column of the world data with the labels of
+            the countries.
+        base_figure (t.Optional[go.Figure]): The base layer (see
+            `load_base_figure`), to which the sites are added. If None, it is
+            built from the world data.
+
+    Returns:
+        t.Tuple[go.Figure, t.Optional[str]]: The figure, and the script to pass
+            to `fig.to_html` (to switch the cluster tiers when zooming), if any.
+    """
+    labels = labels or MAP_LABELS['en']
+
+    ### Base layer: ###
+    # World map with UNITY countries highlighted in colors
+
+    # Parse UNITY countries (grab countries present in either city_data or DS_data)
+    if base_figure is not None:
+        fig = base_figure
+    else:
+        fig = build_countries_figure(
+            world_data, set(city_data["country"].dropna()) | set(DS_data["country"].dropna()), optimize,
+            label_column, labels['countries']
+        )
+
+    ### Layer 1: data-contributing sites ###
+    # city_lst = ['Karachi', 'Lucknow', 'Lusaka','Zomba', 'Blantyre', 'Kampala', 'Nairobi', 'Kisumu', 'Gaborone', 'Harare', 'Accra', 'Kintampo', 'Addis Ababa', 'Cape Town', 'Pretoria', 'London', 'Dhaka', 'Vellore', 'Bonn']
+    # city_data = city_data[city_data['city'].isin(city_lst)]
+    # city_data['text'] = df['city'] + ' Hyperfine scans: ' + city_data['scans'].astype(str)
+
+    ### Layer 2: development sites ###
+    # DS_lst = ['Leiden', 'Lund', 'Vancouver','London', 'Los Angelas', 'Melbourne', 'Wisconsin']
+    # DS_data['text'] = DS_df['city'] + ' Research focus: ' + DS_data['scans'].astype(str)
+
+    layers = [
+        (city_data, labels['sites'], 'square', 'rgb(60, 211, 113)', 'location'),
+        (DS_data, labels['development'], 'circle', 'rgb(255, 99, 71)', 'text'),
+    ]
+    post_script = None
+    if len(city_data) + len(DS_data) < cluster_min_sites:
+        fig.add_traces([
+            sites_scatter(data, name, symbol, color, hoverinfo=hoverinfo)
+            for data, name, symbol, color, hoverinfo in layers
+        ])
+    else:
+        tier_traces = [[] for _ in cluster_tiers]
+        for data, name, symbol, color, _ in layers:
+            for tier, (_, cell_size) in enumerate(cluster_tiers):
+                if cell_size:
+                    sites = cluster_sites(data, cell_size)
+                else:
+                    sites = data.assign(hovertext=data['city'])
+                tier_traces[tier].append(len(fig.data))
+                fig.add_trace(sites_scatter(
+                    sites, name, symbol, color,
+                    hovertext=sites['hovertext'], hoverinfo='text', visible=tier == 0,
+                ))
+        post_script = cluster_zoom_script([scale for scale, _ in cluster_tiers], tier_traces)
+    return fig, post_script
+
+
+def write_map_html(
+    fig: go.Figure,
+    output_path: str,
+    post_script: t.Optional[str] = None,
+    byte_budget: int = MAP_BYTE_BUDGET
+) -> int:
+    """Write a map figure to an HTML file (with Plotly from its CDN).
+
+    Args:
+        fig (go.Figure): The figure.
+        output_path (str): The path to the output HTML file.
+        post_script (t.Optional[str]): JavaScript to run after the plot is drawn.
+        byte_budget (int): The maximum expected size of the output, in bytes. A
+            warning is printed if the output is bigger.
+
+    Returns:
+        int: The size of the HTML file in bytes.
+    """
+    html = fig.to_html(include_plotlyjs='cdn', post_script=post_script).encode()
+    with open(output_path, 'wb') as f:
+        f.write(html)
+
+    print(f"Map written to {output_path}: {len(html) / 1024:.1f} KiB")
+    if len(html) > byte_budget:
+        print(f"WARNING: {output_path} is over the size budget "
+              f"({len(html)} > {byte_budget} bytes)")
+    return len(html)
+
+
+@dataclasses.dataclass(frozen=True)
+class MapVariant:
+    """A version of the map (see `render_map_variants`).
+
+    Attributes:
+        name (str): The name of the variant.
+        output_path (str): The path to the output HTML file.
+        layers (t.Tuple[str, ...]): The layers of sites to draw: "sites"
+            (data-contributing) and/or "development".
+        country (t.Optional[str]): The country to zoom on (its name in the
+            world data), with only its sites. If None, the whole world.
+        language (t.Optional[str]): The language of the labels (a key of
+            MAP_LABELS). If None, English with the country codes.
+    """
+    name: str
+    output_path: str
+    layers: t.Tuple[str, ...] = ('sites', 'development')
+    country: t.Optional[str] = None
+    language: t.Optional[str] = None
+
+
+def default_map_variants(
+    sites_csv_path: str = SITES_CSV_PATH,
+    output_dir: str = MAP_VARIANTS_DIR
+) -> t.List[MapVariant]:
+    """The standard set of map variants.
+
+    The global map, a map of each layer alone, a zoomed map of each country
+    with data-contributing sites, and the global map in each language of
+    MAP_LABELS.
+
+    Args:
+        sites_csv_path (str): The path to the CSV file with the data-contributing sites.
+        output_dir (str): The directory of the output HTML files.
+
+    Returns:
+        t.List[MapVariant]: The variants.
+    """
+    def path(name):
+        return os.path.join(output_dir, f"{name}.html")
+
+    variants = [
+        MapVariant('global', path('global')),
+        MapVariant('sites', path('sites'), layers=('sites',)),
+        MapVariant('development', path('development'), layers=('development',)),
+    ]
+    for country in sorted(pd.read_csv(sites_csv_path)['country'].dropna().unique()):
+        name = "country_" + "_".join(normalize_place_name(country).split())
+        variants.append(MapVariant(name, path(name), country=country))
+    for language in MAP_LABELS:
+        if language != 'en':
+            variants.append(MapVariant(f"global_{language}", path(f"global_{language}"), language=language))
+    return variants
+
+
+# Inputs of the map variants, loaded once per worker process (see
+# _init_map_variant_worker)
+_MAP_VARIANT_INPUTS: t.Dict[str, t.Any] = {}
+
+
+def _init_map_variant_worker(map_file: str, sites_csv_path: str, dev_sites_csv_path: str) -> None:
+    _MAP_VARIANT_INPUTS['world_data'] = read_world_data(map_file)
+    _MAP_VARIANT_INPUTS['city_data'] = pd.read_csv(sites_csv_path)
+    _MAP_VARIANT_INPUTS['DS_data'] = pd.read_csv(dev_sites_csv_path)
+
+
+def _render_map_variant(variant: MapVariant) -> t.Tuple[str, int, float]:
+    start = time.perf_counter()
+    world_data = _MAP_VARIANT_INPUTS['world_data']
+    city_data = _MAP_VARIANT_INPUTS['city_data']
+    DS_data = _MAP_VARIANT_INPUTS['DS_data']
+    if 'sites' not in variant.layers:
+        city_data = city_data.iloc[:0]
+    if 'development' not in variant.layers:
+        DS_data = DS_data.iloc[:0]
+    if variant.country is not None:
+        city_data = city_data[city_data['country'] == variant.country]
+        DS_data = DS_data[DS_data['country'] == variant.country]
+
+    label_column = 'iso_a3'
+    if variant.language is not None and f"name_{variant.language}" in world_data.columns:
+        label_column = f"name_{variant.language}"
+    fig, post_script = build_map_figure(
+        world_data, city_data, DS_data,
+        labels=MAP_LABELS[variant.language or 'en'], label_column=label_column
+    )
+    if variant.country is not None:
+        # Zoom on the country and its sites
+        fig.update_geos(fitbounds='locations')
+
+    os.makedirs(os.path.dirname(variant.output_path) or '.', exist_ok=True)
+    size = write_map_html(fig, variant.output_path, post_script)
+    return variant.name, size, time.perf_counter() - start
+
+
+def render_map_variants(
+    variants: t.List[MapVariant],
+    map_file: str,
+    sites_csv_path: str = SITES_CSV_PATH,
+    dev_sites_csv_path: str = DEV_SITES_CSV_PATH,
+    max_workers: int = MAP_VARIANT_WORKERS
+) -> t.Dict[str, t.Union[int, Exception]]:
+    """Render several versions of the map in parallel worker processes.
+
+    Building a Plotly figure is CPU-bound, so the variants are rendered in a
+    process pool. Each worker loads the world data and the CSV files once,
+    when it starts, and then renders its share of the variants.
+
+    Args:
+        variants (t.List[MapVariant]): The variants (see `default_map_variants`).
+        map_file (str): The path to the map file.
+        sites_csv_path (str): The path to the CSV file with the data-contributing sites.
+        dev_sites_csv_path (str): The path to the CSV file with the development sites.
+        max_workers (int): The number of worker processes (0 = one per CPU, 1 =
+            render in this process).
+
+    Returns:
+        t.Dict[str, t.Union[int, Exception]]: The size (in bytes) of the HTML
+            file of each variant, by name, or the exception raised.
+    """
+    start = time.perf_counter()
+    initargs = (map_file, sites_csv_path, dev_sites_csv_path)
+    max_workers = min(max_workers or os.cpu_count() or 1, len(variants))
+    results = {}
+    if max_workers <= 1:
+        _init_map_variant_worker(*initargs)
+        for variant in variants:
+            try:
+                results[variant.name] = _render_map_variant(variant)[1]
+            except Exception as e:
+                print(f"Failed to render the {variant.name} map: ", e)
+                results[variant.name] = e
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_map_variant_worker, initargs=initargs
+        ) as executor:
+            futures = {variant.name: executor.submit(_render_map_variant, variant) for variant in variants}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()[1]
+                except Exception as e:
+                    print(f"Failed to render the {name} map: ", e)
+                    results[name] = e
+
+    print(f"{len(variants)} map variants rendered in {time.perf_counter() - start:.2f} s "
+          f"({max(1, max_workers)} processes)")
+    return results
+
+
+def update_timeline_figure(
+    map_file: str,
+    sites_csv_path: str,
+    timeline_csv_path: str,
+    output_path: t.Optional[str] = None,
+    optimize: bool = MAP_OPTIMIZE
+) -> t.Optional[int]:
+    """Animated map of the cumulative number of scans per site, month by month.
+
+    The base layer (see `build_countries_figure`) is drawn once, and each
+    animation frame only replaces the markers of the sites.
+
+    Args:
+        map_file (str): The path to the map file.
+        sites_csv_path (str): The path to the CSV file with the sites (for
+            their coordinates).
+        timeline_csv_path (str): The path to the CSV file with the scans per
+            site per month (see `city_monthly_scans`).
+        output_path (t.Optional[str]): The path to the output HTML file. If None,
+            the figure is shown instead.
+        optimize (bool): Whether to optimize the size of the output (see
+            `update_map_figure`).
+
+    Returns:
+        t.Optional[int]: The size of the output HTML file in bytes, if written.
+    """
+    world_data = read_world_data(map_file)
+    city_data = pd.read_csv(sites_csv_path)
+    timeline = pd.read_csv(timeline_csv_path)
+
+    # Cumulative scans per city (rows) and month (columns), without gaps
+    monthly = timeline.pivot_table(
+        index='city', columns='month', values='scans', aggfunc='sum', fill_value=0
+    )
+    months = pd.period_range(min(monthly.columns), max(monthly.columns), freq='M').astype(str)
+    cumulative = monthly.reindex(columns=months, fill_value=0).cumsum(axis=1)
+    sites = city_data[['city', 'lat', 'lng']].dropna().merge(
+        cumulative, left_on='city', right_index=True
+    )
+
+    fig = build_countries_figure(world_data, set(city_data['country'].dropna()), optimize)
+    marker_trace = len(fig.data)
+
+    def month_scatter(month):
+        return sites_scatter(
+            sites.assign(scans=sites[month]), 'Data-contributing sites', 'square',
+            'rgb(60, 211, 113)', hovertext=sites['city'], hoverinfo='text',
+        )
+
+    fig.add_trace(month_scatter(months[-1]))
+    fig.frames = [
+        go.Frame(name=month, data=[month_scatter(month)], traces=[marker_trace])
+        for month in months
+    ]
+    frame_args = {'frame': {'duration': 300, 'redraw': True}, 'mode': 'immediate'}
+    fig.update_layout(
+        updatemenus=[{
+            'type': 'buttons',
+            'showactive': False,
+            'buttons': [
+                {'label': 'Play', 'method': 'animate', 'args': [None, {**frame_args, 'fromcurrent': True}]},
+                {'label': 'Pause', 'method': 'animate', 'args': [[None], frame_args]},
+            ],
+        }],
+        sliders=[{
+            'active': len(months) - 1,
+            'currentvalue': {'prefix': 'Month: '},
+            'steps': [
+                {'label': month, 'method': 'animate', 'args': [[month], frame_args]}
+                for month in months
+            ],
+        }],
+    )
+    if output_path is None:
+        fig.show()
+        return None
+
+    html = fig.to_html(include_plotlyjs='cdn', auto_play=False).encode()
+    with open(output_path, 'wb') as f:
+        f.write(html)
+    print(f"Timeline map written to {output_path}: {len(html) / 1024:.1f} KiB "
+          f"({len(months)} months)")
+    return len(html)
+
+
+def natural_earth_projection(
+    lon: np.ndarray,
+    lat: np.ndarray
+) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Project longitudes/latitudes (in degrees) with the Natural Earth projection.
+
+    Args:
+        lon (np.ndarray): The longitudes.
+        lat (np.ndarray): The latitudes.
+
+    Returns:
+        t.Tuple[np.ndarray, np.ndarray]: The projected x and y (y towards the
+            north), in units of the Earth radius.
+    """
+    lam = np.radians(lon)
+    phi = np.radians(lat)
+    phi2 = phi * phi
+    phi4 = phi2 * phi2
+    x = lam * (0.8707 - 0.131979 * phi2 + phi4 * (-0.013791 + phi4 * (0.003971 * phi2 - 0.001529 * phi4)))
+    y = phi * (1.007226 + phi2 * (0.015085 + phi4 * (-0.044475 + 0.028874 * phi2 - 0.005916 * phi4)))
+    return x, y
+
+
+def render_map_svg(
+    map_file: str,
+    sites_csv_path: str,
+    dev_sites_csv_path: str,
+    output_path: str = MAP_SVG_PATH,
+    width: int = MAP_SVG_WIDTH,
+    simplify_tolerance: float = MAP_SIMPLIFY_TOLERANCE
+) -> int:
+    """Render the map as a static SVG, without Plotly.
+
+    It draws the same layers as `update_map_figure`: all countries in grey with
+    the UNITY countries in color, the country codes, and the data-contributing
+    sites (squares) and development sites (circles), sized by `scans ** 0.5 * 2`
+    and labelled with their number of scans. The geometries are projected with
+    the Natural Earth projection.
+
+    Args:
+        map_file (str): The path to the map file (the world data or the geometry
+            artifact, see `read_world_data`).
+        sites_csv_path (str): The path to the CSV file with the data-contributing sites.
+        dev_sites_csv_path (str): The path to the CSV file with the development sites.
+        output_path (str): The path to the output SVG file.
+        width (int): The width of the SVG, in pixels.
+        simplify_tolerance (float): The simplification tolerance of the country
+            polygons, in degrees.
+
+    Returns:
+        int: The size of the SVG file in bytes.
+    """
+    world_data = read_world_data(map_file)
+    city_data = pd.read_csv(sites_csv_path)
+    DS_data = pd.read_csv(dev_sites_csv_path)
+    unity_names = set(city_data['country'].dropna()) | set(DS_data['country'].dropna())
+
+    x_max, _ = natural_earth_projection(np.array([180.0]), np.array([0.0]))
+    _, y_max = natural_earth_projection(np.array([0.0]), np.array([90.0]))
+    scale = width / (2 * x_max[0])
+    height = 2 * y_max[0] * scale
+
+    def to_svg(lon, lat):
+        x, y = natural_earth_projection(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        return (x + x_max[0]) * scale, (y_max[0] - y) * scale
+
+    def ring_path(ring):
+        coords = np.asarray(ring, dtype=float)
+        x, y = to_svg(coords[:, 0], coords[:, 1])
+        points = " ".join(f"{xi:.1f} {yi:.1f}" for xi, yi in zip(x, y))
+        return f"M{points}Z"
+
+    def geometry_path(geometry):
+        # Path of a GeoJSON (Multi)Polygon: its coordinates are projected
+        # directly, as in the HTML map
+        polygons = geometry['coordinates']
+        if geometry['type'] == 'Polygon':
+            polygons = [polygons]
+        return "".join(ring_path(ring) for polygon in polygons for ring in polygon)
+
+    # Palette of the px.choropleth colors (plotly.colors.qualitative.Plotly)
+    palette = [
+        '#636efa', '#EF553B', '#00cc96', '#ab63fa', '#FFA15A',
+        '#19d3f3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52',
+    ]
+    if 'feature' in world_data.columns:
+        # Geometry artifact (see build_geometry_artifact): already simplified,
+        # with the positions of the labels
+        geometries = [feature['geometry'] for feature in world_data['feature']]
+        label_points = zip(world_data['label_lng'], world_data['label_lat'])
+    else:
+        simplified = [
+            None if g is None or g.is_empty else g
+            for g in world_data.geometry.simplify(simplify_tolerance, preserve_topology=True)
+        ]
+        geometries = [None if g is None else g.__geo_interface__ for g in simplified]
+        label_points = [None if g is None else g.representative_point().coords[0] for g in simplified]
+    country_paths, unity_paths, labels = [], [], []
+    for name, iso_a3, geometry, label_point in zip(
+        world_data['name'], world_data['iso_a3'], geometries, label_points
+    ):
+        if not geometry or not geometry['coordinates']:
+            continue
+        d = geometry_path(geometry)
+        if name in unity_names:
+            color = palette[len(unity_paths) % len(palette)]
+            unity_paths.append(f'<path d="{d}" fill="{color}"><title>{escape(name)}</title></path>')
+            x, y = to_svg([label_point[0]], [label_point[1]])
+            labels.append(f'<text x="{x[0]:.1f}" y="{y[0]:.1f}">{escape(str(iso_a3))}</text>')
+        else:
+            country_paths.append(f'<path d="{d}"/>')
+
+    def site_markers(df, shape):
+        markers = []
+        x, y = to_svg(df['lng'], df['lat'])
+        for xi, yi, city, scans in zip(x, y, df['city'], df['scans']):
+            if np.isnan(xi) or np.isnan(yi):
+                continue
+            size = scans ** 0.5 * 2
+            title = f"<title>{escape(str(city))}: {scans}</title>"
+            if shape == 'square':
+                marker = (f'<rect x="{xi - size / 2:.1f}" y="{yi - size / 2:.1f}" '
+                          f'width="{size:.1f}" height="{size:.1f}"/>')
+            else:
+                marker = f'<circle cx="{xi:.1f}" cy="{yi:.1f}" r="{size / 2:.1f}"/>'
+            markers.append(
+                f'<g>{title}{marker}<text x="{xi:.1f}" y="{yi:.1f}">{scans}</text></g>'
+            )
+        return markers
+
+    svg = "".join([
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height:.0f}" '
+        f'viewBox="0 0 {width} {height:.0f}">',
+        '<style>'
+        'text{font:10px sans-serif;text-anchor:middle;dominant-baseline:central}'
+        '.w path{fill:#e5ecf6;stroke:#fff;stroke-width:.5}'
+        '.u path{stroke:#fff;stroke-width:.5}'
+        '.l text{fill:#444}'
+        '.m rect,.m circle{opacity:.8;stroke:#666;stroke-width:1}'
+        '.s rect{fill:rgb(60,211,113)}.d circle{fill:rgb(255,99,71)}'
+        '</style>',
+        '<g class="w">', *country_paths, '</g>',
+        '<g class="u">', *unity_paths, '</g>',
+        '<g class="l">', *labels, '</g>',
+        '<g class="m s">', *site_markers(city_data, 'square'), '</g>',
+        '<g class="m d">', *site_markers(DS_data, 'circle'), '</g>',
+        '</svg>',
+    ]).encode()
+    with open(output_path, 'wb') as f:
+        f.write(svg)
+
+    print(f"SVG map written to {output_path}: {len(svg) / 1024:.1f} KiB")
+    return len(svg)
+
+
+def publish_files(file_paths: t.List[str], backend: str = PUBLISH_BACKEND) -> dict|Exception:
+    """Upload the files to the configured publishing backend.
+
+    Arguments:
+        file_paths {t.List[str]} -- The paths to the files to upload.
+        backend {str} -- "s3" or "drive".
+
+    Returns:
+        dict|Exception -- The result of the upload of each file, or the
+            exception if the upload failed.
+    """
+    if backend == "s3":
+        try:
+            return {file_path: update_s3_bucket(file_path) for file_path in file_paths}
+        except Exception as e:
+            print("Failed to upload to S3: ", e)
+            return e
+    if backend == "drive":
+        return update_google_drive(file_paths)
+    raise ValueError(f"Unknown publishing backend: {backend}")
+
+
+def write_csv_to_bucket(csv_path: str) -> None:
+    
+    result = publish_files([csv_path])
+    print(result)
+
+
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    """Get the S3 client, built once per process (S3_ENDPOINT_URL, if set, points
+    it to an S3-compatible server such as MinIO)."""
+    return boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+
+
+def compress_payload(data: bytes, encoding: str) -> bytes:
+    """Compress data for serving with the given Content-Encoding.
+
+    Arguments:
+        data {bytes} -- The data to compress.
+        encoding {str} -- "br", "gzip" or "identity".
+
+    Returns:
+        bytes -- The compressed data.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    if encoding == "gzip":
+        # mtime=0 so that the same content always gives the same bytes
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "identity":
+        return data
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+
+def update_s3_bucket(
+    file_path: str,
+    bucket: t.Optional[str] = None,
+    key: t.Optional[str] = None,
+    s3_client=None,
+    compression: str = S3_COMPRESSION
+) -> str:
+    """Upload the file to an S3 bucket (served through CloudFront).
+
+    The object is pre-compressed (with its Content-Encoding set), gets a
+    Content-Type and a Cache-Control header, and stores the SHA-256 of the
+    uncompressed file in its metadata. The upload is skipped when the object in
+    the bucket already has the same SHA-256 and encoding. Large objects are
+    uploaded with multipart uploads (above S3_MULTIPART_THRESHOLD).
+    
+    Arguments:
+        file_path {str} -- The path to the file to upload.
+        bucket {t.Optional[str]} -- The bucket name (default: S3_BUCKET).
+        key {t.Optional[str]} -- The object key (default: S3_PREFIX + the file name).
+        s3_client -- The boto3 S3 client (default: get_s3_client()).
+        compression {str} -- "br", "gzip" or "identity". "br" falls back to
+            "gzip" if the brotli package isn't installed.
+
+    Returns:
+        str -- "unchanged" if the upload was skipped, otherwise "uploaded".
+    """
+    bucket = bucket or S3_BUCKET
+    if not bucket:
+        raise ValueError("No S3 bucket configured (set BUCKET_NAME)")
+    key = key or S3_PREFIX + os.path.basename(file_path)
+    s3_client = s3_client or get_s3_client()
+    if compression == "br" and brotli is None:
+        compression = "gzip"
+
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    # Skip the upload if the object is already up to date
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        if (
+            head.get('Metadata', {}).get('content-sha256') == sha256
+            and head.get('ContentEncoding', 'identity') == compression
+        ):
+            print(f"s3://{bucket}/{key} unchanged")
+            return "unchanged"
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+
+    body = compress_payload(data, compression)
+    extra_args = {
+        'ContentType': mimetypes.guess_type(file_path)[0] or 'application/octet-stream',
+        'CacheControl': S3_CACHE_CONTROL,
+        'Metadata': {'content-sha256': sha256},
+    }
+    if compression != "identity":
+        extra_args['ContentEncoding'] = compression
+    s3_client.upload_fileobj(
+        io.BytesIO(body),
+        bucket,
+        key,
+        ExtraArgs=extra_args,
+        Config=TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD),
+    )
+    print(f"Uploaded s3://{bucket}/{key} ({len(data)} -> {len(body)} bytes, {compression})")
+    return "uploaded"
+
+
+def file_md5(file_path: str) -> str:
+    """Compute the MD5 checksum of a file (as reported by Google Drive).
+
+    Args:
+        file_path (str): The path to the file.
+
+    Returns:
+        str: The MD5 hex digest.
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class GoogleDrivePublisher:
+    """Upload files to Google Drive folders, updating them in place.
+
+    The Drive service is built once and reused for all the uploads. A file that
+    already exists in its folder is updated in place (`files().update`), and not
+    uploaded at all if its MD5 checksum matches the local file. Independent files
+    are uploaded concurrently.
+
+    The service can be passed explicitly (e.g. a fake Drive API for testing);
+    otherwise it is built from the service account credentials, with one HTTP
+    connection per thread (`httplib2` is not thread-safe).
+    """
+
+    def __init__(
+        self,
+        service=None,
+        credentials_path: str = GOOGLE_CREDENTIALS_PATH,
+        max_workers: int = UPLOAD_MAX_WORKERS
+    ):
+        """Set up the publisher.
+
+        Args:
+            service: The Google Drive v3 service. If None, it is built from
+                `credentials_path`.
+            credentials_path (str): The path to the service account credentials.
+            max_workers (int): The maximum number of concurrent uploads.
+        """
+        self._credentials = None
+        self._local = threading.local()
+        if service is None:
+            self._credentials = service_account.Credentials.from_service_account_file(
+                credentials_path, scopes=['https://www.googleapis.com/auth/drive']
+            )
+            service = build('drive', 'v3', credentials=self._credentials)
+        self.service = service
+        self.max_workers = max_workers
+
+    def _execute(self, request):
+        """Execute a request, with the current thread's HTTP connection."""
+        if self._credentials is None:
+            return request.execute()
+        if not hasattr(self._local, 'http'):
+            self._local.http = google_auth_httplib2.AuthorizedHttp(
+                self._credentials, http=httplib2.Http()
+            )
+        return request.execute(http=self._local.http)
+
+    def upload(self, file_path: str, folder_id: str) -> t.Tuple[str, str]:
+        """Upload a file to a Drive folder, unless it is already up to date.
+
+        Args:
+            file_path (str): The path to the local file. The Drive file has the
+                same name.
+            folder_id (str): The ID of the Drive folder.
+
+        Returns:
+            t.Tuple[str, str]: The ID of the Drive file, and what was done:
+                "unchanged", "updated" or "created".
+        """
+        filename = os.path.basename(file_path)
+        query = f"name='{filename}' and '{folder_id}' in parents and trashed=false"
+        existing_files = self._execute(
+            self.service.files().list(q=query, fields="files(id, name, md5Checksum)")
+        ).get('files', [])
+
+        media = MediaFileUpload(file_path, resumable=False)
+        if not existing_files:
+            file = self._execute(self.service.files().create(
+                body={'name': filename, 'parents': [folder_id]},
+                media_body=media,
+                fields='id'
+            ))
+            print(f"New file uploaded: {filename} (ID: {file['id']})")
+            return file['id'], "created"
+
+        # Keep the first match, and remove the duplicates left by older uploads
+        file, duplicates = existing_files[0], existing_files[1:]
+        for duplicate in duplicates:
+            print(f"DELETING duplicated file: {duplicate['name']} (ID: {duplicate['id']})")
+            self._execute(self.service.files().delete(fileId=duplicate['id']))
+
+        if file.get('md5Checksum') == file_md5(file_path):
+            print(f"File unchanged: {filename} (ID: {file['id']})")
+            return file['id'], "unchanged"
+
+        self._execute(self.service.files().update(
+            fileId=file['id'], media_body=media, fields='id'
+        ))
+        print(f"File updated: {filename} (ID: {file['id']})")
+        return file['id'], "updated"
+
+    def publish(self, files: t.Dict[str, str]) -> t.Dict[str, t.Union[t.Tuple[str, str], Exception]]:
+        """Upload several files concurrently.
+
+        Args:
+            files (t.Dict[str, str]): The Drive folder ID for each local file path.
+
+        Returns:
+            t.Dict[str, t.Union[t.Tuple[str, str], Exception]]: The result of
+                `upload` for each file path, or the exception raised.
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(files)))) as executor:
+            futures = {
+                file_path: executor.submit(self.upload, file_path, folder_id)
+                for file_path, folder_id in files.items()
+            }
+            for file_path, future in futures.items():
+                try:
+                    results[file_path] = future.result()
+                except Exception as e:
+                    print(f"Failed to upload {file_path} to drive: ", e)
+                    results[file_path] = e
+        return results
+
+
+@functools.lru_cache(maxsize=1)
+def get_drive_publisher() -> GoogleDrivePublisher:
+    """Get the Google Drive publisher, built once per process."""
+    return GoogleDrivePublisher()
+
+
+def update_google_drive(file_paths: t.List[str]) -> dict|Exception:
+    """Upload the files to their Google Drive folders (see DRIVE_FOLDERS).
+
+    Arguments:
+        file_paths {t.List[str]} -- The paths to the files to upload. The
+            folder is chosen by file name.
+
+    Returns:
+        dict|Exception -- The Drive file ID and the action taken ("unchanged",
+            "updated" or "created") for each file, or the exception if the
+            upload failed.
+    """
+    
+    try:
+        files = {}
+        for file_path in file_paths:
+            filename = os.path.basename(file_path)
+            if filename not in DRIVE_FOLDERS:
+                raise ValueError(f"No Google Drive folder for {filename}")
+            files[file_path] = DRIVE_FOLDERS[filename]
+
+        results = get_drive_publisher().publish(files)
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
+        return results
         
     except Exception as e:
         print("Failed to upload to drive: ", e)
@@ -369,9 +2881,61 @@ def update_google_drive(file_path: str) -> str|Exception:
 
     # Only execute if file is run as main, not when imported by another module
 if __name__ == "__main__":  # pragma: no cover
-        
-    API = os.getenv("FW_BMGF_KEY")
-    fw = flywheel.Client(api_key=API)
-       
-    # Pass the Flywheel SDK client to "main".
-    main(fw)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Update the UNITY sites map.")
+    parser.add_argument(
+        "stage",
+        nargs="?",
+        default="all",
+        choices=["all", "collect", "render", "publish", "timeline", "variants", "geometry"],
+        help="Pipeline stage to run: 'collect' (Flywheel -> CSV files and "
+             f"{COLLECT_ARTIFACT_PATH}), 'render' (-> {MAP_HTML_PATH}), 'publish' "
+             "(uploads), 'all' (collect + render, the default), or 'timeline' "
+             f"(scans per site per month -> {TIMELINE_CSV_PATH} and {TIMELINE_HTML_PATH}), "
+             f"'variants' (all the map variants -> {MAP_VARIANTS_DIR}/, from the CSV files), "
+             f"or 'geometry' (compact country geometry for the map -> {GEOMETRY_ARTIFACT_PATH})."
+    )
+    parser.add_argument(
+        "--from-history",
+        action="store_true",
+        help="'collect' stage: use the latest counts of the scan history "
+             "(SCAN_HISTORY_TABLE) instead of querying Flywheel."
+    )
+    parser.add_argument(
+        "--async",
+        dest="run_async",
+        action="store_true",
+        help="'all' stage: overlap the Flywheel requests, the world data loading "
+             "and the uploads (see run_pipeline_async), and report the timing."
+    )
+    parser.add_argument(
+        "--publish",
+        action="store_true",
+        help="'all' stage: also publish the CSV file and the map."
+    )
+    args = parser.parse_args()
+
+    if args.stage == "render":
+        render_stage()
+    elif args.stage == "variants":
+        render_map_variants(default_map_variants(), map_geometry_path(None) or fetch_world_data(WORLD_DATA_SRC)[0])
+    elif args.stage == "geometry":
+        build_geometry_artifact(fetch_world_data(WORLD_DATA_SRC)[0])
+    elif args.stage == "publish":
+        publish_stage()
+    elif args.stage == "collect" and args.from_history:
+        collect_stage(None, source="history")
+    else:
+        API = os.getenv("FW_BMGF_KEY")
+        fw = flywheel.Client(api_key=API)
+
+        if args.stage == "collect":
+            collect_stage(fw)
+        elif args.stage == "timeline":
+            timeline_stage(fw)
+        elif args.run_async:
+            asyncio.run(run_pipeline_async(fw, publish=args.publish))
+        else:
+            # Pass the Flywheel SDK client to "main".
+            main(fw)
+            if args.publish:
+                publish_stage()
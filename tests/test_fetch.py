@@ -0,0 +1,185 @@
+import functools
+import time
+
+import requests
+from flywheel.models import ProjectListOutput
+
+import test_update_map as tum
+from benchmark_update_map import FakeFlywheelClient
+
+
+def test_fetch_projects_sessions_doesnt_use_unvalidated_cache(tmp_path):
+    # Without the modified timestamp, a cached count may be out of date: the
+    # concurrent mode queries every label, and refreshes the cache
+    fw = FakeFlywheelClient(['Bonn', 'Zomba'], latency=0)
+    cache = tum.ProjectStatsCache(str(tmp_path / 'stats.sqlite'))
+    cache.set('Bonn', 'old-id', '2023-01-01T00:00:00+00:00', 1)
+
+    counts, errors = tum.fetch_projects_sessions(fw, ['Bonn', 'Zomba'], cache=cache)
+    sessions = {label: p['stats']['number_of']['sessions'] for label, p in fw.project_index.items()}
+    assert (counts, errors) == (sessions, {})
+    assert fw.requests == 2
+    project = fw.project_index['Bonn']
+    assert cache.get('Bonn', project['_id'], str(project['modified'])) == sessions['Bonn']
+
+
+
+class DelayedFinder:
+    """Projects finder of a fake client, with a delay per label."""
+
+    def __init__(self, finder, delays):
+        self.finder = finder
+        self.delays = delays
+        self.finished = []
+
+    def find_one(self, query, exhaustive=False):
+        label = query.split('=', 1)[1]
+        time.sleep(self.delays.get(label, 0))
+        self.finished.append(label)
+        return self.finder.find_one(query, exhaustive)
+
+
+def test_fetch_projects_sessions():
+    labels = ['Bonn', 'Zomba', 'Leiden', 'Lund']
+    fw = FakeFlywheelClient(labels, latency=0)
+    # The first labels are the slowest
+    fw.projects = DelayedFinder(fw.projects, {label: 0.05 * (4 - i) for i, label in enumerate(labels)})
+    sessions = {label: p['stats']['number_of']['sessions'] for label, p in fw.project_index.items()}
+
+    counts, errors = tum.fetch_projects_sessions(
+        fw, ['Bonn', 'Zomba', 'Unknown', 'Bonn', 'Leiden', 'Lund', 'Zomba'], max_workers=8
+    )
+    # In the order of the labels, whatever the order the queries finished in
+    assert fw.projects.finished[-1] == 'Bonn'
+    assert list(counts.items()) == [(label, sessions[label]) for label in labels]
+    # Duplicates are only queried once; a failed label doesn't stop the others
+    assert fw.requests == 5
+    assert list(errors) == ['Unknown']
+    assert isinstance(errors['Unknown'], ValueError)
+
+
+class RecordingFlywheelClient(FakeFlywheelClient):
+    """Fake client recording the arguments of each project listing."""
+
+    def __init__(self, labels):
+        super().__init__(labels, latency=0)
+        self.listings = []
+
+    def get_all_projects(self, limit=0, after_id=None, **kwargs):
+        self.listings.append({'after_id': after_id, **kwargs})
+        return super().get_all_projects(limit=limit, after_id=after_id, **kwargs)
+
+
+def test_build_project_sessions_index_pages():
+    labels = [f"Project {i}" for i in range(5)]
+    fw = RecordingFlywheelClient(labels)
+    # A label shared by two projects can't be resolved
+    duplicate = ProjectListOutput(
+        id=f"{99:024x}", label='Project 3', modified='2024-01-01T00:00:00+00:00',
+        stats={'number_of': {'sessions': 1}},
+    )
+    fw.project_index['Project 3 (copy)'] = duplicate
+    fw._ids.append(duplicate['_id'])
+    sessions = {label: p['stats']['number_of']['sessions'] for label, p in fw.project_index.items()}
+
+    counts, errors = tum.build_project_sessions_index(
+        fw, ['Project 4', 'Project 0', 'Project 3', 'Unknown', 'Project 0'], page_size=2
+    )
+    assert counts == {'Project 4': sessions['Project 4'], 'Project 0': sessions['Project 0']}
+    assert sorted(errors) == ['Project 3', 'Unknown']
+    # 6 projects in pages of 2, each page listed after the last project of the previous one
+    assert [listing['after_id'] for listing in fw.listings] == [None, fw._ids[1], fw._ids[3], fw._ids[5]]
+    assert all(listing['stats'] for listing in fw.listings)
+
+
+def test_build_project_sessions_index_cache(tmp_path, monkeypatch):
+    # With a cache, the listing is done without stats, and only the stats of
+    # the new or changed projects are fetched, by chunks of ids
+    monkeypatch.setattr(tum, 'STATS_FETCH_CHUNK', 2)
+    labels = [f"Project {i}" for i in range(5)]
+    fw = RecordingFlywheelClient(labels)
+    sessions = {label: p['stats']['number_of']['sessions'] for label, p in fw.project_index.items()}
+    cache = tum.ProjectStatsCache(str(tmp_path / 'stats.sqlite'))
+
+    def fetched_ids():
+        listings = [listing for listing in fw.listings if 'filter' in listing]
+        fw.listings.clear()
+        assert all(listing['stats'] for listing in listings)
+        return [listing['filter'].split('[', 1)[1].rstrip(']').split(',') for listing in listings]
+
+    assert tum.build_project_sessions_index(fw, labels, page_size=10, cache=cache) == (sessions, {})
+    assert not fw.listings[0]['stats']
+    assert fetched_ids() == [fw._ids[:2], fw._ids[2:4], fw._ids[4:]]
+
+    assert tum.build_project_sessions_index(fw, labels, page_size=10, cache=cache) == (sessions, {})
+    assert fetched_ids() == []
+
+    fw.project_index['Project 2']['modified'] = '2024-02-01T00:00:00+00:00'
+    fw.project_index['Project 2']['stats'] = {'number_of': {'sessions': 1000}}
+    counts, _ = tum.build_project_sessions_index(fw, labels, page_size=10, cache=cache)
+    assert counts == {**sessions, 'Project 2': 1000}
+    assert fetched_ids() == [[fw._ids[2]]]
+
+
+def world_data_response(status_code, content=b'', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers.update(headers or {})
+    return response
+
+
+def test_fetch_world_data_revalidation(tmp_path, monkeypatch):
+    url = 'https://example.com/ne_110m_admin_0_countries.zip'
+    requests_sent = []
+    responses = []
+
+    def get(url, headers, timeout):
+        requests_sent.append(headers)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(tum.requests, 'get', get)
+    fetch = functools.partial(
+        tum.fetch_world_data, url, cache_dir=str(tmp_path / 'cache'), fallback_path='bundled.zip'
+    )
+    cached_path = str(tmp_path / 'cache' / 'ne_110m_admin_0_countries.zip')
+
+    # Nothing cached and no network: the bundled copy
+    responses.append(requests.ConnectionError("offline"))
+    assert fetch() == ('bundled.zip', "fallback")
+
+    responses.append(world_data_response(
+        200, b'v1', {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+    ))
+    assert fetch() == (cached_path, "download")
+    assert requests_sent[-1] == {}
+
+    # Fresh: not requested again
+    assert fetch() == (cached_path, "hit")
+    assert len(requests_sent) == 2
+
+    # Too old: conditional request
+    responses.append(world_data_response(304))
+    assert fetch(max_age=0) == (cached_path, "revalidated")
+    assert requests_sent[-1] == {
+        'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'
+    }
+    assert fetch() == (cached_path, "hit")
+
+    # Server errors: the cached copy is used, and revalidated next time
+    responses.append(world_data_response(500))
+    responses.append(requests.Timeout("timeout"))
+    assert fetch(max_age=0) == (cached_path, "stale")
+    assert fetch(max_age=0) == (cached_path, "stale")
+    assert requests_sent[-1]['If-None-Match'] == '"v1"'
+
+    responses.append(world_data_response(200, b'v2', {'ETag': '"v2"'}))
+    assert fetch(max_age=0) == (cached_path, "download")
+    with open(cached_path, 'rb') as f:
+        assert f.read() == b'v2'
+    responses.append(world_data_response(304))
+    assert fetch(max_age=0) == (cached_path, "revalidated")
+    assert requests_sent[-1] == {'If-None-Match': '"v2"'}
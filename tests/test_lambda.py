@@ -0,0 +1,247 @@
+import base64
+import functools
+import gzip
+import json
+import time
+
+import moto
+import pytest
+
+import app
+from benchmark_update_map import FakeFlywheelClient
+
+
+class ListingDeadline(app.Deadline):
+    """Deadline that expires once `pages` pages of projects were listed."""
+
+    def __init__(self, fw, pages):
+        super().__init__()
+        self.fw = fw
+        self.pages = pages
+
+    def remaining(self):
+        return 0.0 if self.fw.pages >= self.pages else float('inf')
+
+
+class PagedFlywheelClient(FakeFlywheelClient):
+    def __init__(self, labels):
+        super().__init__(labels, latency=0)
+        self.pages = 0
+
+    def get_all_projects(self, limit=0, after_id=None, **kwargs):
+        if 'filter' not in kwargs:
+            self.pages += 1
+        return super().get_all_projects(limit=limit, after_id=after_id, **kwargs)
+
+
+def test_fetch_project_counts_resumes_unfetched_stats(tmp_path, monkeypatch):
+    # The deadline stops the run after the listing matched the first projects,
+    # but before the stats of the changed ones were fetched: the next run must
+    # fetch them, although it resumes the listing after them
+    monkeypatch.setattr(app, 'FW_FETCH_MODE', 'bulk')
+    labels = [f"Project {i}" for i in range(25)]
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    cache = app.ProjectStatsCache(str(tmp_path / 'stats.sqlite'))
+
+    cursor = {}
+    fw = PagedFlywheelClient(labels)
+    counts, errors = app.build_project_sessions_index(
+        fw, labels, page_size=10, cache=cache, deadline=ListingDeadline(fw, 1), cursor=cursor
+    )
+    assert not counts
+    assert all(isinstance(e, app.DeadlineExceeded) for e in errors.values())
+    assert sorted(cursor['matches']) == labels[:10]
+
+    app.write_checkpoint({}, cursor['after_id'], {}, checkpoint_path, cursor['matches'])
+    fw = PagedFlywheelClient(labels)
+    counts, errors = app.fetch_project_counts(
+        fw, labels, cache=cache, deadline=app.Deadline(), checkpoint_path=checkpoint_path
+    )
+    assert not errors
+    assert counts == {label: p['stats']['number_of']['sessions'] for label, p in fw.project_index.items()}
+    assert fw.pages == 1  # The listing resumed after the cursor
+    assert app.read_checkpoint(checkpoint_path)['matches'] == {}
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        app.get_s3_client.cache_clear()
+        app.get_s3_client().create_bucket(Bucket='unity-map')
+        monkeypatch.setattr(app, 'S3_BUCKET', 'unity-map')
+        monkeypatch.setattr(app, 'SERVE_REVALIDATE', 0)
+        monkeypatch.setattr(app, '_SERVE_CACHE', {})
+        yield app.get_s3_client()
+    app.get_s3_client.cache_clear()
+
+
+def get(path, headers=None):
+    return app.lambda_handler({
+        'rawPath': path,
+        'headers': headers or {},
+        'requestContext': {'http': {'method': 'GET', 'path': path}},
+    }, None)
+
+
+def test_serve_published_files_from_s3(s3_bucket, tmp_path, monkeypatch):
+    # The read path of any container serves what the pipeline published, not
+    # its local files
+    monkeypatch.setattr(app, 'SERVE_DIR', str(tmp_path))
+    assert get('/unity_map.html')['statusCode'] == 404
+
+    map_path = tmp_path / 'unity_map.html'
+    map_path.write_text('<html>map</html>')
+    assert app.update_s3([str(map_path)]) == {str(map_path): "uploaded"}
+    assert app.update_s3([str(map_path)]) == {str(map_path): "unchanged"}
+    map_path.unlink()
+
+    response = get('/unity_map.html', {'Accept-Encoding': 'gzip'})
+    assert response['statusCode'] == 200
+    assert response['headers']['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(base64.b64decode(response['body'])) == b'<html>map</html>'
+    etag = response['headers']['ETag']
+
+    monkeypatch.setattr(app, '_SERVE_CACHE', {})  # Another container
+    assert get('/', {'If-None-Match': etag, 'Accept-Encoding': 'gzip'})['statusCode'] == 304
+
+    s3_bucket.put_object(Bucket='unity-map', Key='unity_map.html', Body=b'<html>new map</html>')
+    response = get('/')
+    assert response['statusCode'] == 200
+    assert base64.b64decode(response['body']) == b'<html>new map</html>'
+
+
+@pytest.fixture
+def scan_history(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        app.get_dynamodb_client.cache_clear()
+        app.create_scan_history_table('unity-scans')
+        yield app.get_dynamodb_client()
+    app.get_dynamodb_client.cache_clear()
+
+
+def post_event(payload, token):
+    return app.lambda_handler({
+        'rawPath': app.WEBHOOK_PATH,
+        'headers': {'X-Webhook-Token': token},
+        'requestContext': {'http': {'method': 'POST', 'path': app.WEBHOOK_PATH}},
+        'body': json.dumps(payload),
+    }, None)
+
+
+def test_webhook_rejects_unauthenticated_requests(monkeypatch):
+    monkeypatch.setattr(app, 'SCAN_HISTORY_TABLE', 'unity-scans')
+    payload = {'id': 'e1', 'type': 'session.created', 'project_label': 'Bonn'}
+    monkeypatch.setattr(app, 'WEBHOOK_TOKEN', '')
+    assert post_event(payload, '')['statusCode'] == 503
+    monkeypatch.setattr(app, 'WEBHOOK_TOKEN', 'secret')
+    assert post_event(payload, 'guess')['statusCode'] == 401
+
+
+def session_event(event_id, event_type, label):
+    return app.parse_flywheel_event({'id': event_id, 'type': event_type, 'project_label': label})
+
+
+def test_apply_session_event(scan_history):
+    app.write_scan_history(
+        {'Bonn': 10}, {'sites': {'Bonn': 10}}, table_name='unity-scans', dynamodb_client=scan_history
+    )
+    apply = functools.partial(app.apply_session_event, table_name='unity-scans', dynamodb_client=scan_history)
+
+    assert apply(session_event('e1', 'session.created', 'Bonn')) == "applied"
+    assert apply(session_event('e1', 'session.created', 'Bonn')) == "duplicate"
+    assert apply(session_event('e2', 'session.deleted', 'Bonn')) == "applied"
+    assert apply(session_event('e3', 'session.created', 'Bonn')) == "applied"
+    assert apply(session_event('e4', 'session.created', 'Unknown project')) == "ignored"
+    # No count in the history: a full count is needed, not just this event
+    assert apply(session_event('e5', 'session.created', 'PRISMA-AKU')) == "reconcile"
+    assert apply(session_event('e5', 'session.created', 'PRISMA-AKU')) == "duplicate"
+
+    assert app.read_latest_snapshot('unity-scans', scan_history) == ({'Bonn': 11}, {'sites': {'Bonn': 11}})
+    state = scan_history.get_item(
+        TableName='unity-scans', Key={'pk': {'S': 'events'}, 'sk': {'S': 'render'}}
+    )['Item']
+    assert 'dirty_since' in state and state['reconcile'] == {'BOOL': True}
+
+
+def test_checkpoint_in_scan_history_table(scan_history, tmp_path):
+    # Any container resumes the checkpoint, not just a warm one
+    checkpoint = functools.partial(app.read_checkpoint, table_name='unity-scans', dynamodb_client=scan_history)
+    assert checkpoint()['after_id'] is None
+    app.write_checkpoint(
+        {'Bonn': 10}, 'p1', {'Bonn': [1, None]}, checkpoint_path=str(tmp_path / 'checkpoint.json'),
+        table_name='unity-scans', dynamodb_client=scan_history
+    )
+    assert not (tmp_path / 'checkpoint.json').exists()
+    resumed = checkpoint()
+    assert (resumed['counts'], resumed['after_id'], resumed['breaker']) == ({'Bonn': 10}, 'p1', {'Bonn': [1, None]})
+    assert checkpoint(max_age=-1)['counts'] == {}
+
+
+def test_fetch_and_merge_raises_unexpected_errors(monkeypatch):
+    # Only the errors of single projects are tolerated: stale counts are not published
+    def fetch_project_counts(fw, labels, **kwargs):
+        raise ConnectionError("Flywheel is down")
+
+    monkeypatch.setattr(app, 'STATS_CACHE_PATH', '')
+    monkeypatch.setattr(app, 'fetch_project_counts', fetch_project_counts)
+    with pytest.raises(ConnectionError):
+        app.fetch_and_merge(None, None, app.SITES_CITIES)
+
+
+def test_maybe_render_events(scan_history, monkeypatch):
+    renders = []
+    monkeypatch.setattr(
+        app, 'fetch_and_merge',
+        lambda fw, df, sites_cities, from_history, deadline: renders.append((fw, from_history)) or ({}, df)
+    )
+    monkeypatch.setattr(app, 'publish_outputs', lambda project_counts, df: "Success")
+    monkeypatch.setattr(app, 'get_flywheel_client', lambda: 'flywheel')
+    render = functools.partial(app.maybe_render_events, table_name='unity-scans', dynamodb_client=scan_history)
+    apply = functools.partial(app.apply_session_event, table_name='unity-scans', dynamodb_client=scan_history)
+    app.write_scan_history(
+        {'Bonn': 10}, {'sites': {'Bonn': 10}}, table_name='unity-scans', dynamodb_client=scan_history
+    )
+
+    app.start_stages()
+    assert render() == "clean"
+    apply(session_event('e1', 'session.created', 'Bonn'))
+    now = time.time()
+    assert render(now=now) == "waiting"
+    assert render(now=now + app.EVENT_RENDER_DEBOUNCE) == "Success"
+    assert render(now=now + app.EVENT_RENDER_DEBOUNCE) == "clean"
+    assert renders == [(None, True)]
+
+    apply(session_event('e2', 'session.created', 'PRISMA-AKU'))
+    assert render(force=True) == "Success"
+    assert renders[-1] == ('flywheel', False)
+
+
+def test_publish_outputs_keeps_fingerprint_on_failed_upload(monkeypatch):
+    # A failed upload must be retried by the next run, not skipped as "Unchanged"
+    saved = []
+    monkeypatch.setattr(app, 'compute_fingerprint', lambda *args: 'fingerprint')
+    monkeypatch.setattr(app, 'read_fingerprint', lambda: None)
+    monkeypatch.setattr(app, 'write_fingerprint', saved.append)
+    monkeypatch.setattr(app, 'write_csv', lambda df: None)
+    monkeypatch.setattr(app, 'update_data', lambda world_data_path: None)
+    monkeypatch.setattr(app, 'update_s3', lambda file_paths: {'unity_map.html': "uploaded"})
+    app.start_stages()
+
+    monkeypatch.setattr(app, 'update_drive', lambda file_paths: ConnectionError("Drive is down"))
+    with pytest.raises(RuntimeError, match="Drive is down"):
+        app.publish_outputs({}, None)
+    monkeypatch.setattr(app, 'update_drive', lambda file_paths: {})
+    monkeypatch.setattr(app, 'update_s3', lambda file_paths: {'unity_map.html': OSError("S3 is down")})
+    with pytest.raises(RuntimeError, match="S3 is down"):
+        app.publish_outputs({}, None)
+    assert saved == []
+
+    monkeypatch.setattr(app, 'update_s3', lambda file_paths: {'unity_map.html': "uploaded"})
+    assert app.publish_outputs({}, None) == "Success"
+    assert saved == ['fingerprint']
@@ -0,0 +1,279 @@
+import collections
+import functools
+import io
+import os
+import re
+
+import pandas as pd
+import plotly.graph_objects as go
+
+import test_update_map as tum
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORLD_DATA = os.path.join(ROOT, 'ne_110m_admin_0_countries.zip')
+
+
+def write_sites(path, rows):
+    pd.DataFrame(rows, columns=['city', 'lat', 'lng', 'country', 'scans']).to_csv(path, index=False)
+
+
+def test_update_map_figure_site_without_country(tmp_path):
+    # A site that isn't in the gazetteer has no country nor coordinates
+    sites_csv = tmp_path / 'site_scans.csv'
+    dev_sites_csv = tmp_path / 'developmentSites.csv'
+    write_sites(sites_csv, [
+        ('Zomba', -15.3833, 35.3333, 'Malawi', 918),
+        ('Soweto', None, None, None, 1),
+    ])
+    write_sites(dev_sites_csv, [('Leiden', 52.16, 4.49, 'Netherlands', 1)])
+
+    for _ in range(2):  # Building, then loading the base layer from the cache
+        size = tum.update_map_figure(
+            WORLD_DATA, str(sites_csv), str(dev_sites_csv), str(tmp_path / 'map.html'),
+            base_cache_dir=str(tmp_path / 'cache')
+        )
+        assert size == os.path.getsize(tmp_path / 'map.html')
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+
+
+def test_render_stage_uses_geometry_artifact(tmp_path, monkeypatch):
+    # With the geometry artifact, the world data isn't downloaded, and the
+    # artifact is what the fingerprint depends on
+    def fetch_world_data(*args, **kwargs):
+        raise AssertionError("The world data was downloaded")
+
+    monkeypatch.setattr(tum, 'fetch_world_data', fetch_world_data)
+    monkeypatch.setattr(tum, 'FINGERPRINT_PATH', str(tmp_path / 'fingerprint.json'))
+    monkeypatch.setattr(tum, 'MAP_SVG_PATH', str(tmp_path / 'map.svg'))
+    sites_csv = tmp_path / 'site_scans.csv'
+    dev_sites_csv = tmp_path / 'developmentSites.csv'
+    write_sites(sites_csv, [('Zomba', -15.3833, 35.3333, 'Malawi', 918)])
+    write_sites(dev_sites_csv, [('Leiden', 52.16, 4.49, 'Netherlands', 1)])
+    artifact_path = tmp_path / 'site_counts.json'
+    tum.write_json_atomic(str(artifact_path), {
+        'project_counts': {'Malawi (REVAMP)': 918},
+        'sites_csv_path': str(sites_csv),
+        'dev_sites_csv_path': str(dev_sites_csv),
+    })
+    map_path = str(tmp_path / 'map.html')
+
+    assert tum.render_stage(str(artifact_path), map_path)
+    assert os.path.exists(tmp_path / 'map.svg')
+    assert tum.read_fingerprint(tum.FINGERPRINT_PATH) == tum.compute_fingerprint(
+        {'Malawi (REVAMP)': 918}, [str(sites_csv), str(dev_sites_csv)],
+        tum.get_world_data_version(tum.GEOMETRY_ARTIFACT_PATH)
+    )
+    assert not tum.render_stage(str(artifact_path), map_path)
+
+
+def test_load_world_data_uses_geometry_artifact(monkeypatch):
+    def fetch_world_data(*args, **kwargs):
+        raise AssertionError("The world data was downloaded")
+
+    monkeypatch.setattr(tum, 'fetch_world_data', fetch_world_data)
+    assert tum.load_world_data() == tum.GEOMETRY_ARTIFACT_PATH
+
+
+def test_render_map_svg_from_geometry_artifact(tmp_path):
+    # The artifact's GeoJSON is drawn like the (simplified) world data, up to
+    # the rounding of the coordinates
+    sites_csv = tmp_path / 'site_scans.csv'
+    write_sites(sites_csv, [('Zomba', -15.3833, 35.3333, 'Malawi', 918)])
+    artifact = str(tmp_path / 'countries.geojson')
+    tum.build_geometry_artifact(WORLD_DATA, artifact)
+
+    svgs = []
+    for map_file in (WORLD_DATA, artifact):
+        output_path = tmp_path / 'map.svg'
+        tum.render_map_svg(map_file, str(sites_csv), str(sites_csv), str(output_path))
+        svgs.append(output_path.read_text())
+    texts = [re.findall(r'<(?:title|text[^>]*)>([^<]*)<', svg) for svg in svgs]
+    assert texts[0] == texts[1]
+    assert svgs[0].count('<path') == svgs[1].count('<path')
+    assert '<title>Malawi</title>' in svgs[1]
+
+
+def sites_frame(rows):
+    return pd.DataFrame(rows, columns=['city', 'lat', 'lng', 'country', 'scans'])
+
+
+def test_cluster_sites():
+    sites = sites_frame([
+        ('Blantyre', -15.78, 35.00, 'Malawi', 10),
+        ('Zomba', -15.38, 35.33, 'Malawi', 20),
+        ('Lilongwe', -13.96, 33.79, 'Malawi', 30),
+        ('Bonn', 50.73, 7.10, 'Germany', 5),
+        ('Soweto', None, None, None, 1),
+    ])
+
+    clusters = tum.cluster_sites(sites, 10.0)
+    assert len(clusters) == 2
+    malawi = clusters.loc[clusters['n_sites'] == 3].iloc[0]
+    assert malawi['scans'] == 60
+    assert malawi['lat'] == (-15.78 - 15.38 - 13.96) / 3
+    assert malawi['hovertext'] == "3 sites: Blantyre, Zomba, Lilongwe"
+    # A site alone in its cell isn't a cluster: just the site
+    bonn = clusters.loc[clusters['n_sites'] == 1].iloc[0]
+    assert (bonn['lat'], bonn['lng'], bonn['scans'], bonn['hovertext']) == (50.73, 7.10, 5, 'Bonn')
+
+    clusters = tum.cluster_sites(sites, 1.0)
+    assert sorted(clusters['n_sites']) == [1, 1, 2]
+    assert set(clusters['hovertext']) == {"2 sites: Blantyre, Zomba", "Lilongwe", "Bonn"}
+
+
+def test_build_map_figure_cluster_tiers():
+    city_data = sites_frame([(f"City {i}", i * 0.1, i * 0.1, 'Malawi', 1) for i in range(30)])
+    DS_data = sites_frame([('Leiden', 52.16, 4.49, 'Netherlands', 1)])
+    tiers = [(1, 10.0), (9, 0.0)]
+
+    fig, post_script = tum.build_map_figure(None, city_data, DS_data, base_figure=go.Figure())
+    assert post_script is None and len(fig.data) == 2
+
+    fig, post_script = tum.build_map_figure(
+        None, city_data, DS_data, cluster_min_sites=10, cluster_tiers=tiers, base_figure=go.Figure()
+    )
+    # One trace per layer and tier, only the first tier visible
+    assert [len(trace.lat) for trace in fig.data] == [1, 30, 1, 1]
+    assert [trace.visible for trace in fig.data] == [True, False, True, False]
+    assert list(fig.data[0].text) == [30]
+    assert "scales = [1, 9], tiers = [[0, 2], [1, 3]]" in post_script
+
+
+class FakeViewClient:
+    def __init__(self, csv_text):
+        self.csv_text = csv_text
+        self.stream = None
+
+    def read_view_data(self, view, project_id, format):
+        self.stream = io.StringIO(self.csv_text)
+        return self.stream
+
+
+def test_count_sessions_by_month():
+    fw = FakeViewClient(
+        "timestamp,created\n"
+        "2024-01-31T23:59:59+00:00,2024-02-02T00:00:00+00:00\n"
+        "2024-02-01T00:00:00+00:00,2024-02-01T00:00:00+00:00\n"
+        ",2024-04-15T10:00:00+00:00\n"  # No timestamp: the creation date
+        ",\n"
+        "2024-01-02T08:00:00+00:00,2024-05-01T00:00:00+00:00\n"
+    )
+    months = tum.count_sessions_by_month(fw, 'project', view=object())
+    assert months == {'2024-01': 2, '2024-02': 1, '2024-04': 1}
+    assert fw.stream.closed
+
+
+def test_city_monthly_scans():
+    timeline = tum.city_monthly_scans(
+        {'Zomba': ['Malawi (REVAMP)', 'Malawi (other)'], 'Bonn': ['Bonn'], 'Leiden': ['Leiden']},
+        {
+            'Malawi (REVAMP)': collections.Counter({'2024-03': 2, '2024-01': 1}),
+            'Malawi (other)': collections.Counter({'2024-01': 4}),
+            'Bonn': collections.Counter({'2024-02': 3}),
+        },
+    )
+    assert timeline.values.tolist() == [
+        ['Zomba', '2024-01', 5], ['Zomba', '2024-03', 2], ['Bonn', '2024-02', 3],
+    ]
+
+
+def test_update_timeline_figure(tmp_path, monkeypatch):
+    figures = []
+    monkeypatch.setattr(go.Figure, 'to_html', lambda fig, **kwargs: figures.append(fig) or "")
+    sites_csv = tmp_path / 'site_scans.csv'
+    write_sites(sites_csv, [
+        ('Zomba', -15.3833, 35.3333, 'Malawi', 7),
+        ('Bonn', 50.73, 7.10, 'Germany', 3),
+    ])
+    timeline_csv = tmp_path / 'timeline.csv'
+    pd.DataFrame(
+        [('Zomba', '2024-01', 5), ('Zomba', '2024-03', 2), ('Bonn', '2024-02', 3)],
+        columns=['city', 'month', 'scans']
+    ).to_csv(timeline_csv, index=False)
+
+    tum.update_timeline_figure(
+        tum.GEOMETRY_ARTIFACT_PATH, str(sites_csv), str(timeline_csv), str(tmp_path / 'timeline.html')
+    )
+    fig, = figures
+    # One frame per month, without gaps, with the cumulative scans per site
+    assert [frame.name for frame in fig.frames] == ['2024-01', '2024-02', '2024-03']
+    scans = {
+        frame.name: dict(zip(frame.data[0].hovertext, frame.data[0].text)) for frame in fig.frames
+    }
+    assert scans == {
+        '2024-01': {'Zomba': 5, 'Bonn': 0},
+        '2024-02': {'Zomba': 5, 'Bonn': 3},
+        '2024-03': {'Zomba': 7, 'Bonn': 3},
+    }
+    assert list(fig.data[-1].text) == [7, 3]
+
+
+def test_gazetteer(tmp_path):
+    source_csv = tmp_path / 'worldcities.csv'
+    pd.DataFrame([
+        ('London', 'London', 51.5072, -0.1275, 'UK', 'GB', 'GBR', 'London, City of', 'primary', 11262000, 1, ''),
+        ('London', 'London', 42.9836, -81.2497, 'Canada', 'CA', 'CAN', 'Ontario', '', 422324, 2, ''),
+        ('Lomé', 'Lome', 6.1375, 1.2125, 'Togo', 'TG', 'TGO', 'Maritime', 'primary', 1785000, 3, 'Lomé-Tokoin'),
+    ], columns=['city', *tum.GAZETTEER_COLUMNS, 'aliases']).to_csv(source_csv, index=False)
+    gazetteer_path = str(tmp_path / 'gazetteer.csv')
+
+    assert tum.build_gazetteer(str(source_csv), gazetteer_path, WORLD_DATA) == 4
+    gazetteer = tum.load_gazetteer(gazetteer_path)
+    assert sorted(gazetteer) == ['lome', 'lome tokoin', 'london']
+
+    # The country names are those of the world data
+    assert tum.lookup_place(gazetteer, 'LOME.')['country'] == 'Togo'
+    assert tum.lookup_place(gazetteer, 'Lomé-Tokoin')['id'] == 3
+    # Same name: the most populated city, unless the country tells them apart
+    assert tum.lookup_place(gazetteer, 'London')['country'] == 'United Kingdom'
+    assert tum.lookup_place(gazetteer, 'London', 'Canada')['iso3'] == 'CAN'
+    assert tum.lookup_place(gazetteer, 'London', 'CA')['admin_name'] == 'Ontario'
+    assert tum.lookup_place(gazetteer, 'London', 'Togo') is None
+    assert tum.lookup_place(gazetteer, 'Atlantis') is None
+
+    sites = pd.DataFrame([
+        ('London', 51.0, 0.0, 'United Kingdom', 'GB', 1),  # Already located: kept as is
+        ('London', None, None, 'Canada', None, 2),
+        ('Lome', None, None, None, None, 3),
+        ('Atlantis', None, None, None, None, 4),
+    ], columns=['city', 'lat', 'lng', 'country', 'iso2', 'scans'])
+    sites = tum.fill_site_locations(sites, gazetteer_path)
+    assert sites[['lat', 'lng']].values.tolist()[:3] == [[51.0, 0.0], [42.9836, -81.2497], [6.1375, 1.2125]]
+    assert sites['iso2'].tolist()[:3] == ['GB', 'CA', 'TG']
+    assert sites.loc[2, 'country'] == 'Togo'
+    assert sites.loc[3, ['lat', 'lng', 'country']].isna().all()
+
+
+def test_render_map_variants_in_worker_processes(tmp_path):
+    sites_csv = tmp_path / 'site_scans.csv'
+    dev_sites_csv = tmp_path / 'developmentSites.csv'
+    write_sites(sites_csv, [
+        ('Zomba', -15.3833, 35.3333, 'Malawi', 918),
+        ('Bonn', 50.73, 7.10, 'Germany', 5),
+    ])
+    write_sites(dev_sites_csv, [('Leiden', 52.16, 4.49, 'Netherlands', 1)])
+    (tmp_path / 'not_a_directory').write_text('')
+    render = functools.partial(
+        tum.render_map_variants, map_file=tum.GEOMETRY_ARTIFACT_PATH,
+        sites_csv_path=str(sites_csv), dev_sites_csv_path=str(dev_sites_csv), max_workers=2
+    )
+
+    # The workers render from the inputs loaded by their initializer
+    results = render([
+        tum.MapVariant('sites', str(tmp_path / 'sites.html'), layers=('sites',)),
+        tum.MapVariant('malawi', str(tmp_path / 'malawi.html'), country='Malawi'),
+    ])
+    assert results == {
+        'sites': os.path.getsize(tmp_path / 'sites.html'),
+        'malawi': os.path.getsize(tmp_path / 'malawi.html'),
+    }
+    assert '"fitbounds":"locations"' in (tmp_path / 'malawi.html').read_text()
+    assert '"fitbounds"' not in (tmp_path / 'sites.html').read_text()
+
+    # The error of a variant is returned, without stopping the others
+    results = render([
+        tum.MapVariant('global', str(tmp_path / 'global.html')),
+        tum.MapVariant('broken', str(tmp_path / 'not_a_directory' / 'broken.html')),
+    ])
+    assert results['global'] == os.path.getsize(tmp_path / 'global.html')
+    assert isinstance(results['broken'], OSError)
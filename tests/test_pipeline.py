@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import pytest
+
+import test_update_map as tum
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    # Stubbed stages of run_pipeline_async, recording when they start and end
+    events = []
+    published = []
+    outcome = {'render': True}
+
+    def stub(name, seconds, result=None):
+        def run(*args, **kwargs):
+            events.append((name, 'start'))
+            time.sleep(seconds)
+            events.append((name, 'end'))
+            if isinstance(outcome.get(name), Exception):
+                raise outcome[name]
+            return outcome.get(name, result)
+        return run
+
+    monkeypatch.setattr(tum, 'collect_stage', stub('collect', 0.05, {'sites_csv_path': 'site_scans.csv'}))
+    monkeypatch.setattr(tum, 'load_world_data', stub('world_data', 0.2, 'countries.geojson'))
+    monkeypatch.setattr(tum, 'render_stage', stub('render', 0.05))
+    monkeypatch.setattr(tum, 'publish_files', lambda file_paths: published.extend(file_paths) or {})
+    return events, published, outcome
+
+
+def test_run_pipeline_async(stages):
+    events, published, _ = stages
+    report = asyncio.run(tum.run_pipeline_async(None))
+
+    # The render waits for the counts and the world data; the CSV file is
+    # published without waiting for the render
+    assert events.index(('render', 'start')) > events.index(('world_data', 'end'))
+    assert events.index(('render', 'start')) > events.index(('collect', 'end'))
+    assert published == ['site_scans.csv', tum.MAP_HTML_PATH]
+    spans = report['spans_ms']
+    assert spans['publish_csv'][0] >= spans['collect'][1]
+    assert spans['publish_csv'][1] < spans['world_data'][1]
+    assert spans['publish_map'][0] >= spans['render'][1]
+    # The world data is the slowest input of the render
+    assert report['critical_path'] == ['world_data', 'render', 'publish_map']
+    assert report['wall_ms'] < report['sequential_ms']
+
+
+def test_run_pipeline_async_publishes_rendered_map_only(stages):
+    _, published, outcome = stages
+    # Map up to date: not rendered, so not published
+    outcome['render'] = False
+    asyncio.run(tum.run_pipeline_async(None))
+    assert published == ['site_scans.csv']
+
+    # Failed render: the error is raised, after publishing the CSV file
+    published.clear()
+    outcome['render'] = RuntimeError("render failed")
+    with pytest.raises(RuntimeError, match="render failed"):
+        asyncio.run(tum.run_pipeline_async(None))
+    assert published == ['site_scans.csv']
+
+    published.clear()
+    outcome['render'] = True
+    asyncio.run(tum.run_pipeline_async(None, publish=False))
+    assert published == []
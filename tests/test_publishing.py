@@ -0,0 +1,167 @@
+import functools
+import gzip
+import hashlib
+import os
+import re
+
+import boto3
+import moto
+import pytest
+
+import test_update_map as tum
+
+
+class FakeRequest:
+    def __init__(self, func):
+        self.func = func
+
+    def execute(self, http=None):
+        return self.func()
+
+
+class FakeDriveFiles:
+    """Stand-in for `service.files()` of the Drive v3 API, in memory."""
+
+    def __init__(self):
+        self.files = {}
+        self.calls = []
+
+    def _store(self, file_id, name, folder_id, media_body):
+        content = media_body.getbytes(0, media_body.size())
+        self.files[file_id] = {
+            'id': file_id, 'name': name, 'parents': [folder_id],
+            'md5Checksum': hashlib.md5(content).hexdigest(), 'content': content,
+        }
+
+    def list(self, q, fields):
+        name, folder_id = re.match(r"name='(.*)' and '(.*)' in parents", q).groups()
+        self.calls.append('list')
+        return FakeRequest(lambda: {'files': [
+            {key: file[key] for key in ('id', 'name', 'md5Checksum')}
+            for file in self.files.values()
+            if file['name'] == name and folder_id in file['parents']
+        ]})
+
+    def create(self, body, media_body, fields):
+        self.calls.append('create')
+        file_id = f"file{len(self.files)}"
+        self._store(file_id, body['name'], body['parents'][0], media_body)
+        return FakeRequest(lambda: {'id': file_id})
+
+    def update(self, fileId, media_body, fields):
+        self.calls.append('update')
+        file = self.files[fileId]
+        self._store(fileId, file['name'], file['parents'][0], media_body)
+        return FakeRequest(lambda: {'id': fileId})
+
+    def delete(self, fileId):
+        self.calls.append('delete')
+        return FakeRequest(lambda: self.files.pop(fileId))
+
+
+class FakeDriveService:
+    def __init__(self):
+        self._files = FakeDriveFiles()
+
+    def files(self):
+        return self._files
+
+
+def test_google_drive_publisher(tmp_path):
+    drive = FakeDriveService()
+    publisher = tum.GoogleDrivePublisher(service=drive)
+    csv_path = tmp_path / 'site_scans.csv'
+    csv_path.write_text('city,scans\nBonn,1\n')
+
+    file_id, action = publisher.upload(str(csv_path), 'folder')
+    assert action == "created"
+    # Same content: not uploaded again
+    assert publisher.upload(str(csv_path), 'folder') == (file_id, "unchanged")
+    assert drive.files().calls == ['list', 'create', 'list']
+
+    # New content: the same Drive file is updated
+    csv_path.write_text('city,scans\nBonn,2\n')
+    assert publisher.publish({str(csv_path): 'folder'}) == {str(csv_path): (file_id, "updated")}
+    assert list(drive.files().files) == [file_id]
+    assert drive.files().files[file_id]['content'] == b'city,scans\nBonn,2\n'
+
+
+def test_google_drive_publisher_removes_duplicates(tmp_path):
+    drive = FakeDriveService()
+    publisher = tum.GoogleDrivePublisher(service=drive)
+    map_path = tmp_path / 'unity_map.html'
+    map_path.write_text('<html></html>')
+    for _ in range(2):  # Left by older uploads
+        drive.files().create(
+            {'name': 'unity_map.html', 'parents': ['folder']}, tum.MediaFileUpload(str(map_path)), 'id'
+        )
+
+    assert publisher.upload(str(map_path), 'folder') == ('file0', "unchanged")
+    assert list(drive.files().files) == ['file0']
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='unity-map')
+        yield client
+
+
+def test_update_s3_bucket(s3_client, tmp_path):
+    csv_path = tmp_path / 'site_scans.csv'
+    data = b'city,scans\nBonn,1\n' * 100
+    csv_path.write_bytes(data)
+    upload = functools.partial(
+        tum.update_s3_bucket, str(csv_path), bucket='unity-map', s3_client=s3_client, compression='gzip'
+    )
+
+    assert upload() == "uploaded"
+    obj = s3_client.get_object(Bucket='unity-map', Key='site_scans.csv')
+    assert obj['ContentType'] == 'text/csv'
+    assert obj['ContentEncoding'] == 'gzip'
+    assert obj['CacheControl'] == tum.S3_CACHE_CONTROL
+    assert obj['Metadata'] == {'content-sha256': hashlib.sha256(data).hexdigest()}
+    assert gzip.decompress(obj['Body'].read()) == data
+
+    # Unchanged: skipped, unless the encoding changes
+    assert upload() == "unchanged"
+    assert upload(compression='identity') == "uploaded"
+    obj = s3_client.get_object(Bucket='unity-map', Key='site_scans.csv')
+    assert 'ContentEncoding' not in obj
+    assert obj['Body'].read() == data
+
+    csv_path.write_bytes(data + b'Zomba,2\n')
+    assert upload() == "uploaded"
+
+
+@pytest.mark.skipif(tum.brotli is None, reason="brotli isn't installed")
+def test_update_s3_bucket_brotli(s3_client, tmp_path):
+    map_path = tmp_path / 'unity_map.html'
+    map_path.write_bytes(b'<html>map</html>')
+    assert tum.update_s3_bucket(
+        str(map_path), bucket='unity-map', key='maps/unity_map.html', s3_client=s3_client, compression='br'
+    ) == "uploaded"
+    obj = s3_client.get_object(Bucket='unity-map', Key='maps/unity_map.html')
+    assert obj['ContentType'] == 'text/html'
+    assert obj['ContentEncoding'] == 'br'
+    assert tum.brotli.decompress(obj['Body'].read()) == b'<html>map</html>'
+
+
+def test_update_s3_bucket_multipart(s3_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(tum, 'S3_MULTIPART_THRESHOLD', 5 * 1024 * 1024)
+    map_path = tmp_path / 'unity_map.html'
+    data = os.urandom(6 * 1024 * 1024)
+    map_path.write_bytes(data)
+
+    assert tum.update_s3_bucket(
+        str(map_path), bucket='unity-map', s3_client=s3_client, compression='identity'
+    ) == "uploaded"
+    obj = s3_client.get_object(Bucket='unity-map', Key='unity_map.html')
+    # The ETag of a multipart upload ends with the number of parts
+    assert re.search(r'-\d+"$', obj['ETag'])
+    assert obj['Body'].read() == data
+    assert obj['Metadata'] == {'content-sha256': hashlib.sha256(data).hexdigest()}
@@ -0,0 +1,54 @@
+import boto3
+import moto
+import pytest
+
+import test_update_map as tum
+
+TABLE = 'unity-scans'
+
+
+@pytest.fixture
+def dynamodb_client(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        client = boto3.client('dynamodb')
+        tum.create_scan_history_table(TABLE, client)
+        # Creating it again is a no-op
+        tum.create_scan_history_table(TABLE, client)
+        yield client
+
+
+def test_scan_history(dynamodb_client):
+    tum.write_scan_history(
+        {'Bonn': 10, 'PRISMA-AKU': 5}, {'sites': {'Bonn': 10, 'Karachi': 5}, 'development': {'Leiden': 1}},
+        run_at='2026-01-01T00:00:00Z', table_name=TABLE, dynamodb_client=dynamodb_client
+    )
+    tum.write_scan_history(
+        {'Bonn': 12, 'PRISMA-AKU': 5}, {'sites': {'Bonn': 12, 'Karachi': 5}},
+        run_at='2026-01-02T00:00:00Z', table_name=TABLE, dynamodb_client=dynamodb_client
+    )
+
+    assert tum.read_latest_snapshot(TABLE, dynamodb_client) == (
+        {'Bonn': 12, 'PRISMA-AKU': 5},
+        {'sites': {'Bonn': 12, 'Karachi': 5}, 'development': {'Leiden': 1}},
+    )
+    assert tum.read_site_history('Bonn', table_name=TABLE, dynamodb_client=dynamodb_client) == [
+        ('2026-01-01T00:00:00Z', 10), ('2026-01-02T00:00:00Z', 12)
+    ]
+    assert tum.read_site_history(
+        'Leiden', registry='development', table_name=TABLE, dynamodb_client=dynamodb_client
+    ) == [('2026-01-01T00:00:00Z', 1)]
+    assert tum.read_site_history('Nowhere', table_name=TABLE, dynamodb_client=dynamodb_client) == []
+
+
+def test_scan_history_many_sites(dynamodb_client):
+    # Many more items than a batch_write_item (25 at a time)
+    project_counts = {f"Project {i}": i for i in range(300)}
+    city_scans = {'sites': tum.city_scans_from_counts(
+        {f"City {i}": [f"Project {i}"] for i in range(300)}, project_counts
+    )}
+    tum.write_scan_history(project_counts, city_scans, table_name=TABLE, dynamodb_client=dynamodb_client)
+
+    assert tum.read_latest_snapshot(TABLE, dynamodb_client) == (project_counts, city_scans)